@@ -1,11 +1,12 @@
 from django.contrib import admin
-from .models import EncryptedFile, Directory
+from .models import EncryptedFile, Directory, Chunk, UploadSession
 
 
 # Customize EncruptedFile admin interface
 class EncryptedFileAdmin(admin.ModelAdmin):
-    list_display = ('original_filename', 'upload_date', 'status', 'directory', 'mark_deleted')
-    list_filter = ('status', 'mark_deleted', 'upload_date')
+    list_display = ('original_filename', 'upload_date', 'status', 'directory', 'mark_deleted', 'verification_status',
+                    'encryption_mb_per_s', 'decryption_mb_per_s')
+    list_filter = ('status', 'mark_deleted', 'upload_date', 'verification_status', 'master_key_version')
     search_fields = ('original_filename',)
     ordering = ('-upload_date',)
 
@@ -22,3 +23,23 @@ class DirectoryAdmin(admin.ModelAdmin):
 
 
 admin.site.register(Directory, DirectoryAdmin)
+
+
+# Customize Chunk admin interface
+class ChunkAdmin(admin.ModelAdmin):
+    list_display = ('digest', 'size', 'stored_size', 'ref_count', 'created_on')
+    search_fields = ('digest',)
+    ordering = ('-created_on',)
+
+
+admin.site.register(Chunk, ChunkAdmin)
+
+
+# Customize UploadSession admin interface
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ('original_filename', 'total_size', 'directory', 'created_on', 'updated_on')
+    search_fields = ('original_filename',)
+    ordering = ('-updated_on',)
+
+
+admin.site.register(UploadSession, UploadSessionAdmin)
@@ -0,0 +1,321 @@
+import hashlib
+import hmac
+import os
+from collections import Counter
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.db import transaction
+
+from .crypto import KEY_LENGTH, TAG_LENGTH
+
+try:
+    import numpy
+except ImportError:  # chunk boundaries are then found byte by byte in Python, at a few MB/s
+    numpy = None
+
+# --- Configuration
+STORAGE_BLOB = 'blob'
+STORAGE_CHUNKED = 'chunked'
+STORAGE_CHOICES = [(STORAGE_BLOB, 'Single blob'), (STORAGE_CHUNKED, 'Deduplicated chunks')]
+
+# FastCDC parameters: chunk boundaries depend on content, so an insert early in a file
+# only changes the chunks around it and everything after still deduplicates.
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+# Normalized chunking: harder to cut before the average size, easier after it
+_MASK_S = (1 << 18) - 1  # 18 bits, below AVG_CHUNK_SIZE
+_MASK_L = (1 << 14) - 1  # 14 bits, above AVG_CHUNK_SIZE
+_MASK_64 = (1 << 64) - 1
+_GEAR = [int.from_bytes(hashlib.sha256(b'fileguard gear %d' % i).digest()[:8], 'big') for i in range(256)]
+
+CHUNK_NONCE_LENGTH = 12
+CHUNK_ID_CONTEXT = b'fileguard chunk id'
+CHUNK_KEY_CONTEXT = b'fileguard chunk key'
+DB_BATCH_SIZE = 256  # chunks committed to the database per transaction
+CHUNKS_DIR = 'chunks'
+
+
+# Only the low 14 bits of each gear value reach the cheaper cut test, so 16-bit sums are enough
+_GEAR_ARRAY = numpy.array([g & 0xFFFF for g in _GEAR], dtype=numpy.uint16) if numpy is not None else None
+_WINDOW_S = _MASK_S.bit_length()  # bytes the low 18 bits of the fingerprint depend on
+
+
+def _gear_hashes(data):
+    """
+    Low 14 bits of the gear fingerprint ending at every byte of `data`. The fingerprint shifts left
+    once per byte, so those bits only depend on the last 14 bytes. They are summed for the whole
+    buffer at once by doubling windows of 1, 2, 4, 8 and 16 bytes; older bytes shift out of 16 bits.
+    """
+    hashes = _GEAR_ARRAY.take(numpy.frombuffer(data, dtype=numpy.uint8))
+    shifted = numpy.empty_like(hashes)
+    width = 1
+    while width < 16:
+        numpy.left_shift(hashes[:-width], width, out=shifted[width:])
+        hashes[width:] += shifted[width:]
+        width *= 2
+    return numpy.bitwise_and(hashes, _MASK_L, out=hashes)
+
+
+def _window_fingerprint(data, position):
+    fingerprint = 0
+    for byte in data[position - _WINDOW_S + 1:position + 1]:
+        fingerprint = (fingerprint << 1) + _GEAR[byte]
+    return fingerprint
+
+
+class _CutIndex:
+    """
+    Positions in a buffer where a chunk may end, for either mask of normalized chunking. A position
+    passing the 18-bit mask also passes the 14-bit one, so only those few are checked against it.
+    """
+
+    def __init__(self, data):
+        self.large = numpy.flatnonzero(_gear_hashes(data) == 0)
+        self.small = numpy.array([
+            position for position in self.large.tolist()
+            if position >= _WINDOW_S - 1 and not _window_fingerprint(data, position) & _MASK_S
+        ], dtype=numpy.int64)
+
+    @staticmethod
+    def first(positions, low, high):
+        """
+        First candidate position in [low, high), or None.
+        """
+        i = numpy.searchsorted(positions, low)
+        if i < len(positions) and positions[i] < high:
+            return int(positions[i])
+        return None
+
+
+def _cut_point(data, start, end, index=None):
+    """
+    Returns the length of the next chunk in data[start:end] (FastCDC with normalized chunking).
+    With a _CutIndex of `data` the boundary is looked up instead of hashed byte by byte.
+    """
+    length = end - start
+    if length <= MIN_CHUNK_SIZE:
+        return length
+    normal = min(AVG_CHUNK_SIZE, length)
+    limit = min(MAX_CHUNK_SIZE, length)
+    if index is None:
+        return _scan_cut_point(data, start, normal, limit)
+    # The fingerprint starts over at every chunk, so until it has seen 18 bytes it is hashed here
+    full = min(MIN_CHUNK_SIZE + _WINDOW_S - 1, normal)
+    cut = _scan_cut_point(data, start, full, full)
+    if cut < full:
+        return cut
+    position = _CutIndex.first(index.small, start + full, start + normal)
+    if position is None:
+        position = _CutIndex.first(index.large, start + normal, start + limit)
+    return position - start + 1 if position is not None else limit
+
+
+def _scan_cut_point(data, start, normal, limit):
+    gear = _GEAR
+    fingerprint = 0
+    i = MIN_CHUNK_SIZE
+    for byte in data[start + MIN_CHUNK_SIZE:start + normal]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & _MASK_64
+        i += 1
+        if not fingerprint & _MASK_S:
+            return i
+    for byte in data[start + normal:start + limit]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & _MASK_64
+        i += 1
+        if not fingerprint & _MASK_L:
+            return i
+    return limit
+
+
+def iter_cdc_chunks(fileobj, read_size=MAX_CHUNK_SIZE * 4):
+    """
+    Splits a file-like object into content-defined chunks.
+    """
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_CHUNK_SIZE:
+            data = fileobj.read(read_size)
+            if not data:
+                eof = True
+            buffer += data
+        if not buffer:
+            return
+        index = _CutIndex(buffer) if numpy is not None else None
+        position = 0
+        # Cut every complete chunk in the buffer; keep the tail for the next read unless at EOF
+        while len(buffer) - position >= MAX_CHUNK_SIZE or (eof and position < len(buffer)):
+            size = _cut_point(buffer, position, len(buffer), index)
+            yield bytes(buffer[position:position + size])
+            position += size
+        del buffer[:position]
+
+
+def _id_key(master_key):
+    return HKDF(master_key, KEY_LENGTH, b'', SHA256, context=CHUNK_ID_CONTEXT)
+
+
+def chunk_id(id_key, data):
+    """
+    Keyed chunk ID, so IDs on disk don't reveal hashes of known content.
+    """
+    return hmac.new(id_key, data, hashlib.sha256).hexdigest()
+
+
+def _chunk_key(master_key, cid):
+    return HKDF(master_key, KEY_LENGTH, bytes.fromhex(cid), SHA256, context=CHUNK_KEY_CONTEXT)
+
+
+def chunk_path(cid):
+    return os.path.join(settings.MEDIA_ROOT, CHUNKS_DIR, cid[:2], cid[2:4], f"{cid}.chunk")
+
+
+def _write_chunk(master_key, cid, data):
+    """
+    Encrypts a chunk to `nonce | ciphertext | tag`, bound to its ID, and moves it into place atomically.
+    """
+    path = chunk_path(cid)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cipher = AES.new(_chunk_key(master_key, cid), AES.MODE_GCM, nonce=get_random_bytes(CHUNK_NONCE_LENGTH))
+    cipher.update(cid.encode('ascii'))
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as outfile:
+        outfile.write(cipher.nonce + ciphertext + tag)
+    os.replace(temp_path, path)
+    return CHUNK_NONCE_LENGTH + len(ciphertext) + TAG_LENGTH
+
+
+def read_chunk(master_key, cid):
+    """
+    Reads and verifies a chunk. Raises ValueError on tag mismatch.
+    """
+    with open(chunk_path(cid), 'rb') as infile:
+        blob = infile.read()
+    cipher = AES.new(_chunk_key(master_key, cid), AES.MODE_GCM, nonce=blob[:CHUNK_NONCE_LENGTH])
+    cipher.update(cid.encode('ascii'))
+    return cipher.decrypt_and_verify(blob[CHUNK_NONCE_LENGTH:-TAG_LENGTH], blob[-TAG_LENGTH:])
+
+
+def _commit_batch(encrypted_file, master_key, batch):
+    """
+    Adds references for a batch of (index, offset, cid, data) and stores any chunk not seen before.
+    Chunk rows are locked, so a concurrent release can't remove a chunk we are referencing.
+    """
+    from .models import Chunk, FileChunk
+
+    counts = Counter(cid for _, _, cid, _ in batch)
+    data_by_id = {cid: data for _, _, cid, data in batch}
+    with transaction.atomic():
+        chunks = {}
+        # A row another transaction skipped us past can be released before we lock it, so insert
+        # whatever the locking select didn't find and lock again until every chunk is held
+        while len(chunks) < len(counts):
+            missing = [cid for cid in counts if cid not in chunks]
+            Chunk.objects.bulk_create(
+                [Chunk(digest=cid, size=len(data_by_id[cid])) for cid in missing],
+                ignore_conflicts=True,
+            )
+            chunks.update((c.digest, c) for c in Chunk.objects.select_for_update().filter(digest__in=missing))
+        stored_bytes = 0
+        for cid, chunk in chunks.items():
+            if chunk.ref_count == 0 or not os.path.exists(chunk_path(cid)):
+                chunk.stored_size = _write_chunk(master_key, cid, data_by_id[cid])
+                stored_bytes += chunk.stored_size
+            chunk.ref_count += counts[cid]
+        Chunk.objects.bulk_update(chunks.values(), ['ref_count', 'stored_size'])
+        FileChunk.objects.bulk_create([
+            FileChunk(file=encrypted_file, chunk=chunks[cid], index=index, offset=offset)
+            for index, offset, cid, _ in batch
+        ])
+    return stored_bytes
+
+
+def save_file_chunks(encrypted_file, fileobj, master_key):
+    """
+    Stores a file as a manifest of deduplicated, encrypted chunks.
+
+    Args:
+        encrypted_file: EncryptedFile row the chunk references belong to.
+        fileobj: File-like object to read the plaintext from.
+        master_key: Key chunk IDs and chunk keys are derived from.
+
+    Returns:
+        Tuple: (plaintext_size, bytes_newly_stored)
+    """
+    id_key = _id_key(master_key)
+    offset = 0
+    stored_bytes = 0
+    batch = []
+    for index, data in enumerate(iter_cdc_chunks(fileobj)):
+        batch.append((index, offset, chunk_id(id_key, data), data))
+        offset += len(data)
+        if len(batch) >= DB_BATCH_SIZE:
+            stored_bytes += _commit_batch(encrypted_file, master_key, batch)
+            batch = []
+    if batch:
+        stored_bytes += _commit_batch(encrypted_file, master_key, batch)
+    return offset, stored_bytes
+
+
+def release_file_chunks(encrypted_file):
+    """
+    Drops the chunk references of a file and removes chunks nobody references any more.
+    """
+    from .models import Chunk, FileChunk
+
+    with transaction.atomic():
+        counts = Counter(FileChunk.objects.filter(file=encrypted_file).values_list('chunk_id', flat=True))
+        if not counts:
+            return
+        chunks = list(Chunk.objects.select_for_update().filter(pk__in=counts))
+        for chunk in chunks:
+            chunk.ref_count = max(chunk.ref_count - counts[chunk.pk], 0)
+        Chunk.objects.bulk_update(chunks, ['ref_count'])
+        FileChunk.objects.filter(file=encrypted_file).delete()
+        orphaned = [chunk.digest for chunk in chunks if chunk.ref_count == 0]
+        Chunk.objects.filter(digest__in=orphaned, ref_count=0).delete()
+        if orphaned:
+            # Only once the rows are gone for good; a rollback must find its chunks still on disk
+            transaction.on_commit(lambda: _remove_chunk_files(orphaned))
+
+
+def _remove_chunk_files(digests):
+    """
+    Removes the files of released chunks. Their rows are taken back and locked first, the same lock
+    _commit_batch holds while writing a chunk, so a chunk stored again meanwhile is left alone.
+    """
+    from .models import Chunk
+
+    with transaction.atomic():
+        Chunk.objects.bulk_create([Chunk(digest=cid, size=0) for cid in digests], ignore_conflicts=True)
+        unused = list(Chunk.objects.select_for_update().filter(digest__in=digests, ref_count=0)
+                      .values_list('digest', flat=True))
+        for cid in unused:
+            if os.path.exists(chunk_path(cid)):
+                os.remove(chunk_path(cid))
+        Chunk.objects.filter(digest__in=unused, ref_count=0).delete()
+
+
+def iter_chunked_file(encrypted_file, master_key, start=0, end=None):
+    """
+    Yields the plaintext of a chunked file in [start, end). Only chunks covering the range are read,
+    and each is verified before it is yielded.
+    """
+    from .models import FileChunk
+
+    refs = FileChunk.objects.filter(file=encrypted_file).select_related('chunk').order_by('index')
+    if start > 0:
+        # No chunk is larger than MAX_CHUNK_SIZE, so earlier ones can't overlap the range
+        refs = refs.filter(offset__gt=start - MAX_CHUNK_SIZE)
+    if end is not None:
+        refs = refs.filter(offset__lt=end)
+    for ref in refs.iterator():
+        if ref.offset + ref.chunk.size <= start:
+            continue
+        data = read_chunk(master_key, ref.chunk.digest)
+        yield data[max(start - ref.offset, 0):None if end is None else end - ref.offset]
@@ -0,0 +1,224 @@
+import lzma
+import zlib
+
+# --- Configuration
+COMPRESSION_NONE = 'none'
+SAMPLE_SIZE = 256 * 1024  # plaintext sampled to decide whether compressing is worth it
+MIN_RATIO = 0.9  # keep compression only if the sample shrinks to 90% of its size or less
+READ_SIZE = 64 * 1024
+OUTPUT_CHUNK_SIZE = 1024 * 1024  # most decompressed bytes produced per step, guards against zip bombs
+
+
+class _ZlibDecompressor:
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+
+    def feed(self, data):
+        while data:
+            out = self._decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+            if out:
+                yield out
+            data = self._decompressor.unconsumed_tail
+
+    def finish(self):
+        out = self._decompressor.flush()
+        if out:
+            yield out
+        if not self._decompressor.eof:
+            raise ValueError("Compressed stream is truncated.")
+
+
+class _LzmaDecompressor:
+    def __init__(self):
+        self._decompressor = lzma.LZMADecompressor()
+
+    def feed(self, data):
+        out = self._decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+        while True:
+            if out:
+                yield out
+            if self._decompressor.needs_input or self._decompressor.eof:
+                return
+            out = self._decompressor.decompress(b'', OUTPUT_CHUNK_SIZE)
+
+    def finish(self):
+        if not self._decompressor.eof:
+            raise ValueError("Compressed stream is truncated.")
+        return iter(())
+
+
+class ZlibCodec:
+    name = 'zlib'
+
+    def compressor(self):
+        return zlib.compressobj(6)
+
+    def decompressor(self):
+        return _ZlibDecompressor()
+
+
+class LzmaCodec:
+    name = 'lzma'
+
+    def compressor(self):
+        return lzma.LZMACompressor(preset=1)
+
+    def decompressor(self):
+        return _LzmaDecompressor()
+
+
+CODECS = {}
+
+
+def register_codec(codec):
+    """
+    Makes a codec available by name. A codec provides compressor(), returning an object with
+    compress(data)/flush(), and decompressor(), returning an object with feed(data)/finish()
+    that yield decompressed chunks.
+    """
+    CODECS[codec.name] = codec
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"Unknown compression codec '{name}'.")
+
+
+register_codec(ZlibCodec())
+register_codec(LzmaCodec())
+
+COMPRESSION_CHOICES = [(COMPRESSION_NONE, 'None')] + [(name, name) for name in CODECS]
+
+
+def is_compressible(sample, codec_name, min_ratio=MIN_RATIO):
+    """
+    Compresses a sample of the data and reports whether it shrank enough to be worth it.
+    Media files and archives are already compressed and come out at ~100%.
+    """
+    if not sample:
+        return False
+    compressor = get_codec(codec_name).compressor()
+    compressed_size = len(compressor.compress(sample)) + len(compressor.flush())
+    return compressed_size <= len(sample) * min_ratio
+
+
+class CompressingReader:
+    """
+    File-like wrapper that compresses what is read from `fileobj`. The first SAMPLE_SIZE bytes
+    are sampled up front; if they do not compress well, data is passed through untouched and
+    `codec` is set to 'none'.
+    """
+
+    def __init__(self, fileobj, codec=COMPRESSION_NONE, sample_size=SAMPLE_SIZE, min_ratio=MIN_RATIO):
+        self.fileobj = fileobj
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self._head = fileobj.read(sample_size)
+        self._pending = bytearray()
+        self._eof = False
+        if codec != COMPRESSION_NONE and not is_compressible(self._head, codec, min_ratio):
+            codec = COMPRESSION_NONE
+        self.codec = codec
+        self._compressor = get_codec(codec).compressor() if codec != COMPRESSION_NONE else None
+
+    def _fill(self):
+        if self._head is not None:
+            data, self._head = self._head, None
+        else:
+            data = self.fileobj.read(READ_SIZE)
+        if not data:
+            self._eof = True
+            if self._compressor:
+                self._pending += self._compressor.flush()
+            return
+        self.input_bytes += len(data)
+        self._pending += self._compressor.compress(data) if self._compressor else data
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._pending) < size) and not self._eof:
+            self._fill()
+        if size < 0:
+            size = len(self._pending)
+        out = bytes(self._pending[:size])
+        del self._pending[:size]
+        self.output_bytes += len(out)
+        return out
+
+
+class CompressingWriter:
+    """
+    Writer that compresses everything written to it into `outfile`, for data that is pushed rather
+    than read. The first SAMPLE_SIZE bytes are held back and sampled; if they do not compress well,
+    everything is passed through untouched and `codec` is set to 'none'.
+    """
+
+    def __init__(self, outfile, codec=COMPRESSION_NONE, sample_size=SAMPLE_SIZE, min_ratio=MIN_RATIO):
+        self.outfile = outfile
+        self.codec = codec
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self._sample_size = sample_size
+        self._min_ratio = min_ratio
+        self._head = bytearray() if codec != COMPRESSION_NONE else None
+        self._compressor = None
+
+    def _emit(self, data):
+        if data:
+            self.outfile.write(data)
+            self.output_bytes += len(data)
+
+    def _start(self):
+        head, self._head = self._head, None
+        if is_compressible(bytes(head[:self._sample_size]), self.codec, self._min_ratio):
+            self._compressor = get_codec(self.codec).compressor()
+        else:
+            self.codec = COMPRESSION_NONE
+        self._feed(head)
+
+    def _feed(self, data):
+        self._emit(self._compressor.compress(data) if self._compressor else data)
+
+    def write(self, data):
+        self.input_bytes += len(data)
+        if self._head is None:
+            self._feed(data)
+            return
+        self._head += data
+        if len(self._head) >= self._sample_size:
+            self._start()
+
+    def close(self):
+        if self._head is not None:
+            self._start()
+        if self._compressor:
+            self._emit(self._compressor.flush())
+
+
+class DecompressingWriter:
+    """
+    Writer that decompresses everything written to it into `outfile`.
+    """
+
+    def __init__(self, outfile, codec):
+        self.outfile = outfile
+        self._decompressor = get_codec(codec).decompressor()
+
+    def write(self, data):
+        for out in self._decompressor.feed(data):
+            self.outfile.write(out)
+
+    def close(self):
+        for out in self._decompressor.finish():
+            self.outfile.write(out)
+
+
+def iter_decompressed(chunks, codec):
+    """
+    Decompresses an iterable of compressed chunks, yielding at most OUTPUT_CHUNK_SIZE bytes at a time.
+    """
+    decompressor = get_codec(codec).decompressor()
+    for chunk in chunks:
+        yield from decompressor.feed(chunk)
+    yield from decompressor.finish()
@@ -1,22 +1,302 @@
 import os
+import struct
+from functools import lru_cache
 from Crypto.Cipher import AES
-from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Protocol.KDF import PBKDF2, HKDF
 from Crypto.Random import get_random_bytes
 from Crypto.Hash import SHA256
 
+from .compression import COMPRESSION_NONE, DecompressingWriter, iter_decompressed
+from .fileio import adaptive_chunk_size, iter_views, preallocate, readinto, remaining_size
+
 # --- Configuration
 KEY_LENGTH = 32
 SALT_LENGTH = 16
 NONCE_LENGTH = 16
+TAG_LENGTH = 16
 ITERATIONS = 100000
 CHUNK_SIZE = 64 * 1024  # 64 KB chunks
 
+# --- Key derivation
+# PBKDF2 stretches low-entropy passwords. The master key is 32 random bytes, so new files
+# use HKDF, which costs microseconds instead of tens of milliseconds per file.
+KDF_PBKDF2 = 'pbkdf2'
+KDF_HKDF = 'hkdf'
+KDF_CHOICES = [(KDF_PBKDF2, 'PBKDF2-SHA256'), (KDF_HKDF, 'HKDF-SHA256')]
+HKDF_CONTEXT = b'fileguard file key'
+DERIVED_KEY_CACHE_SIZE = 1024  # derived keys kept per worker process
+
+PREVIEW_MAX_BYTES = 8 * 1024 * 1024  # most plaintext a preview may hold in memory
+
+# --- Container formats
+# v1: salt | nonce | ciphertext | tag  (one GCM stream, verified only at the very end)
+# v2: header | segment_0 | segment_1 | ... (each segment sealed on its own: ciphertext | tag)
+FORMAT_V1 = 1
+FORMAT_V2 = 2
+FORMAT_CHOICES = [(FORMAT_V1, 'v1 (single stream)'), (FORMAT_V2, 'v2 (segmented)')]
+
+SEGMENT_SIZE = 1024 * 1024  # 1 MB of plaintext per v2 segment
+V2_MAGIC = b'FGE'
+V2_NONCE_PREFIX_LENGTH = 8  # + 4 byte segment index = 12 byte GCM nonce
+# magic | version | segment size | salt | nonce prefix
+_V2_HEADER = struct.Struct(f'>3sBI{SALT_LENGTH}s{V2_NONCE_PREFIX_LENGTH}s')
+V2_HEADER_LENGTH = _V2_HEADER.size
+
 
 def derive_key(password, salt, iterations=ITERATIONS, key_len=KEY_LENGTH):
     return PBKDF2(password, salt, dkLen=key_len, count=iterations, hmac_hash_module=SHA256)
 
 
-def save_encrypted_file_to_disk(uploaded_file_obj, output_path, password):
+@lru_cache(maxsize=DERIVED_KEY_CACHE_SIZE)
+def _derive_file_key(password, salt, kdf):
+    if kdf == KDF_HKDF:
+        return HKDF(password, KEY_LENGTH, salt, SHA256, context=HKDF_CONTEXT)
+    if kdf == KDF_PBKDF2:
+        return derive_key(password, salt)
+    raise ValueError(f"Unknown key derivation function '{kdf}'.")
+
+
+def get_file_key(password, salt, kdf=KDF_PBKDF2):
+    """
+    Derives the AES key of a file with the key derivation function it was encrypted with.
+    Keys are cached by salt, so repeated reads of the same file skip the derivation.
+    """
+    # Salts come back from the database as memoryview, which is not hashable
+    return _derive_file_key(bytes(password), bytes(salt), kdf)
+
+
+def pack_v2_header(salt, nonce_prefix, segment_size=SEGMENT_SIZE):
+    return _V2_HEADER.pack(V2_MAGIC, FORMAT_V2, segment_size, salt, nonce_prefix)
+
+
+def unpack_v2_header(header):
+    """
+    Parses a v2 header.
+
+    Returns:
+        Tuple: (salt, nonce_prefix, segment_size)
+    """
+    if len(header) != V2_HEADER_LENGTH:
+        raise ValueError("Encrypted file is too small or corrupted.")
+    magic, version, segment_size, salt, nonce_prefix = _V2_HEADER.unpack(header)
+    if magic != V2_MAGIC or version != FORMAT_V2 or segment_size <= 0:
+        raise ValueError("Not a v2 encrypted file.")
+    return salt, nonce_prefix, segment_size
+
+
+def _segment_cipher(key, header, nonce_prefix, index, final):
+    # The nonce is derived from the segment index, so segments cannot be reordered.
+    # The header and a final-segment flag are authenticated, so it cannot be swapped or the file truncated.
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce_prefix + struct.pack('>I', index))
+    cipher.update(header + (b'\x01' if final else b'\x00'))
+    return cipher
+
+
+def seal_segment(key, header, nonce_prefix, index, plaintext, final):
+    """
+    Encrypts one v2 segment and returns ciphertext followed by its tag.
+    """
+    cipher = _segment_cipher(key, header, nonce_prefix, index, final)
+    ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+    return ciphertext + tag
+
+
+def seal_segment_in_place(key, header, nonce_prefix, index, view, final):
+    """
+    Encrypts one v2 segment in a writable buffer, overwriting the plaintext, and returns its tag.
+    """
+    cipher = _segment_cipher(key, header, nonce_prefix, index, final)
+    cipher.encrypt(view, output=view)
+    return cipher.digest()
+
+
+def open_segment(key, header, nonce_prefix, index, sealed, final):
+    """
+    Decrypts and verifies one v2 segment. Raises ValueError on tag mismatch.
+    """
+    if len(sealed) < TAG_LENGTH:
+        raise ValueError("Encrypted segment is truncated.")
+    cipher = _segment_cipher(key, header, nonce_prefix, index, final)
+    return cipher.decrypt_and_verify(sealed[:-TAG_LENGTH], sealed[-TAG_LENGTH:])
+
+
+def v2_segment_count(body_size, segment_size):
+    """
+    Number of segments stored in `body_size` bytes following the header.
+    """
+    return max(1, -(-body_size // (segment_size + TAG_LENGTH)))
+
+
+def v2_sizes(infile, segment_size, file_size=None):
+    """
+    Returns:
+        Tuple: (segment_count, plaintext_size) of an open v2 file.
+    """
+    if file_size is None:
+        file_size = os.fstat(infile.fileno()).st_size
+    body_size = file_size - V2_HEADER_LENGTH
+    if body_size < TAG_LENGTH:
+        raise ValueError("Encrypted file is too small or corrupted.")
+    segment_count = v2_segment_count(body_size, segment_size)
+    return segment_count, body_size - segment_count * TAG_LENGTH
+
+
+class SegmentedEncryptor:
+    """
+    Writes a v2 container incrementally. Feed plaintext with write() as it becomes
+    available and call close() once to seal the final segment.
+    """
+
+    def __init__(self, outfile, key, salt, segment_size=SEGMENT_SIZE):
+        self.outfile = outfile
+        self.key = key
+        self.segment_size = segment_size
+        self.nonce_prefix = get_random_bytes(V2_NONCE_PREFIX_LENGTH)
+        self.header = pack_v2_header(salt, self.nonce_prefix, segment_size)
+        self.bytes_written = 0
+        self._index = 0
+        # Plaintext collects in one preallocated segment buffer, which is encrypted in place
+        self._buffer = memoryview(bytearray(segment_size))
+        self._filled = 0
+        self._write(self.header)
+
+    def _write(self, data):
+        self.outfile.write(data)
+        self.bytes_written += len(data)
+
+    def _seal(self, view, final):
+        tag = seal_segment_in_place(self.key, self.header, self.nonce_prefix, self._index, view, final)
+        self._write(view)
+        self._write(tag)
+        self._index += 1
+
+    def write(self, data):
+        data = memoryview(data)
+        while len(data):
+            # A full segment is only sealed once more data arrives, so the last one can be flagged as final on close()
+            if self._filled == self.segment_size:
+                self._seal(self._buffer, final=False)
+                self._filled = 0
+            count = min(len(data), self.segment_size - self._filled)
+            self._buffer[self._filled:self._filled + count] = data[:count]
+            self._filled += count
+            data = data[count:]
+
+    def close(self):
+        self._seal(self._buffer[:self._filled], final=True)
+        self._filled = 0
+
+
+class SegmentedReader:
+    """
+    Random access to the plaintext of a v2 container. Every segment is verified
+    on its own, so reading a byte range only touches the segments covering it.
+    """
+
+    def __init__(self, infile, password, file_size=None, kdf=KDF_PBKDF2):
+        self.infile = infile
+        self.header = infile.read(V2_HEADER_LENGTH)
+        salt, self.nonce_prefix, self.segment_size = unpack_v2_header(self.header)
+        self.salt = salt
+        self.segment_count, self.plaintext_size = v2_sizes(infile, self.segment_size, file_size)
+        self.key = get_file_key(password, salt, kdf)
+
+    def read_segment(self, index):
+        if not 0 <= index < self.segment_count:
+            raise IndexError(f"Segment {index} out of range.")
+        self.infile.seek(V2_HEADER_LENGTH + index * (self.segment_size + TAG_LENGTH))
+        sealed = self.infile.read(self.segment_size + TAG_LENGTH)
+        return open_segment(self.key, self.header, self.nonce_prefix, index, sealed,
+                            final=index == self.segment_count - 1)
+
+    def iter_range(self, start=0, end=None):
+        """
+        Yields the plaintext bytes in [start, end), segment by segment.
+        """
+        end = self.plaintext_size if end is None else min(end, self.plaintext_size)
+        if start >= end:
+            return
+        for index in range(start // self.segment_size, (end - 1) // self.segment_size + 1):
+            segment = self.read_segment(index)
+            offset = index * self.segment_size
+            yield segment[max(start - offset, 0):end - offset]
+
+
+def plaintext_size(input_path, format_version=FORMAT_V1):
+    """
+    Size of the decrypted content, computed from the container without decrypting anything.
+    """
+    file_size = os.path.getsize(input_path)
+    if format_version == FORMAT_V2:
+        with open(input_path, 'rb') as infile:
+            _, _, segment_size = unpack_v2_header(infile.read(V2_HEADER_LENGTH))
+            return v2_sizes(infile, segment_size, file_size)[1]
+    return max(file_size - SALT_LENGTH - NONCE_LENGTH - TAG_LENGTH, 0)
+
+
+def encrypted_size(size, format_version=FORMAT_V2, segment_size=SEGMENT_SIZE):
+    """
+    Size on disk of a container holding `size` bytes of plaintext.
+    """
+    if format_version == FORMAT_V2:
+        return V2_HEADER_LENGTH + size + max(1, -(-size // segment_size)) * TAG_LENGTH
+    return SALT_LENGTH + NONCE_LENGTH + size + TAG_LENGTH
+
+
+def _slice_stream(chunks, start, end):
+    position = 0
+    for chunk in chunks:
+        if end is not None and position >= end:
+            return
+        piece = chunk[max(start - position, 0):None if end is None else max(end - position, 0)]
+        position += len(chunk)
+        if piece:
+            yield piece
+
+
+def iter_decrypted_file(input_path, password, salt, nonce, format_version=FORMAT_V1, start=0, end=None,
+                        kdf=KDF_PBKDF2, compression=COMPRESSION_NONE):
+    """
+    Yields the decrypted content of a file chunk by chunk, without writing plaintext to disk.
+
+    v2 files can be read from any byte range [start, end) and each segment is verified before
+    it is yielded. v1 files can only be streamed whole; their tag is verified after the last
+    chunk, so a ValueError is raised at the end of the stream if the file was tampered with.
+    Compressed files are decompressed transparently; since a compressed stream can only be
+    decoded from its beginning, ranges are served by decompressing and skipping up to `start`.
+    """
+    if compression != COMPRESSION_NONE:
+        chunks = _iter_decrypted_container(input_path, password, salt, nonce, format_version, 0, None, kdf)
+        yield from _slice_stream(iter_decompressed(chunks, compression), start, end)
+        return
+    yield from _iter_decrypted_container(input_path, password, salt, nonce, format_version, start, end, kdf)
+
+
+def _iter_decrypted_container(input_path, password, salt, nonce, format_version, start, end, kdf):
+    with open(input_path, 'rb') as infile:
+        if format_version == FORMAT_V2:
+            yield from SegmentedReader(infile, password, kdf=kdf).iter_range(start, end)
+            return
+        if start != 0 or end is not None:
+            raise ValueError("Byte ranges are only supported for v2 encrypted files.")
+        key = get_file_key(password, salt, kdf)
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        tag_start_offset = os.fstat(infile.fileno()).st_size - TAG_LENGTH
+        if tag_start_offset < (SALT_LENGTH + NONCE_LENGTH):
+            raise ValueError("Encrypted file is too small or corrupted.")
+        remaining = tag_start_offset - SALT_LENGTH - NONCE_LENGTH
+        infile.seek(SALT_LENGTH + NONCE_LENGTH)
+        while remaining > 0:
+            chunk = infile.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise ValueError("Unexpected end of encrypted file before tag.")
+            remaining -= len(chunk)
+            yield cipher.decrypt(chunk)
+        cipher.verify(infile.read(TAG_LENGTH))
+
+
+def save_encrypted_file_to_disk(uploaded_file_obj, output_path, password, format_version=FORMAT_V2, kdf=KDF_HKDF,
+                                chunk_size=None, segment_size=SEGMENT_SIZE):
     """
     Encrypts an UploadedFile chunk by chunk and saves it to disk.
 
@@ -24,32 +304,55 @@ def save_encrypted_file_to_disk(uploaded_file_obj, output_path, password):
         uploaded_file_obj: File-like object to read the file from.
         output_path: Path where the encrypted file will be saved.
         password: The password used for encryption.
+        format_version: Container format to write, v2 (segmented) unless told otherwise.
+        kdf: Key derivation function, HKDF unless told otherwise.
+        chunk_size: Bytes read from the input at a time, picked from the input size if not given.
+        segment_size: Plaintext bytes per v2 segment.
 
     Returns:
         Tuple: (salt, nonce, file_size_on_disk)
+        For v2 files the nonce is the per-file prefix the segment nonces are derived from.
     """
     salt = get_random_bytes(SALT_LENGTH)
-    key = derive_key(password, salt)
-    cipher = AES.new(key, AES.MODE_GCM)
-    nonce = cipher.nonce
+    key = get_file_key(password, salt, kdf)
+    input_size = remaining_size(uploaded_file_obj)
+    # One buffer is read into and reused for the whole file
+    buffer = memoryview(bytearray(chunk_size or adaptive_chunk_size(input_size)))
 
-    # We need to write salt, nonce, encrypted_chunks, and tag
-    # Salt and nonce go at the beginning of the file, tag at the end
     try:
         with open(output_path, 'wb') as outfile:
-            outfile.write(salt)
-            outfile.write(nonce)
-
-            while True:
-                # Use read(CHUNK_SIZE) instead of .chunks()
-                chunk = uploaded_file_obj.read(CHUNK_SIZE)
-                if not chunk:
-                    break
-                encrypted_chunk = cipher.encrypt(chunk)
-                outfile.write(encrypted_chunk)
-
-            tag = cipher.digest()
-            outfile.write(tag)
+            if input_size is not None:
+                preallocate(outfile, encrypted_size(input_size, format_version, segment_size))
+            if format_version == FORMAT_V2:
+                encryptor = SegmentedEncryptor(outfile, key, salt, segment_size)
+                while True:
+                    count = readinto(uploaded_file_obj, buffer)
+                    if not count:
+                        break
+                    encryptor.write(buffer[:count])
+                encryptor.close()
+                nonce = encryptor.nonce_prefix
+            else:
+                cipher = AES.new(key, AES.MODE_GCM)
+                nonce = cipher.nonce
+
+                # We need to write salt, nonce, encrypted_chunks, and tag
+                # Salt and nonce go at the beginning of the file, tag at the end
+                outfile.write(salt)
+                outfile.write(nonce)
+
+                while True:
+                    # Use readinto() instead of .chunks(), and encrypt in place
+                    count = readinto(uploaded_file_obj, buffer)
+                    if not count:
+                        break
+                    cipher.encrypt(buffer[:count], output=buffer[:count])
+                    outfile.write(buffer[:count])
+
+                tag = cipher.digest()
+                outfile.write(tag)
+            # Drop whatever was preallocated but not written
+            outfile.truncate()
 
         return salt, nonce, os.path.getsize(output_path)
     except Exception as e:
@@ -59,7 +362,77 @@ def save_encrypted_file_to_disk(uploaded_file_obj, output_path, password):
         raise e
 
 
-def decrypt_file_from_disk(input_filepath, output_filepath, password, salt, nonce):
+def _decrypt_v1_to_file(infile, outfile, password, salt, nonce, kdf, chunk_size=None, use_mmap=False, progress=None):
+    key = get_file_key(password, salt, kdf)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+
+    # Calculate where the tag should be (16 bytes from end)
+    file_size = os.fstat(infile.fileno()).st_size
+    tag_start_offset = file_size - TAG_LENGTH
+
+    if tag_start_offset < (SALT_LENGTH + NONCE_LENGTH):  # Ensure file is large enough for header + tag
+        raise ValueError("Encrypted file is too small or corrupted.")
+
+    # Read ciphertext in chunks past the salt and nonce (they are passed as arguments), but not the tag.
+    # Every chunk is decrypted into the same output buffer.
+    ciphertext_length = tag_start_offset - SALT_LENGTH - NONCE_LENGTH
+    chunk_size = chunk_size or adaptive_chunk_size(ciphertext_length)
+    output = memoryview(bytearray(min(chunk_size, ciphertext_length)))
+    preallocate(outfile, ciphertext_length)
+    for chunk in iter_views(infile, SALT_LENGTH + NONCE_LENGTH, ciphertext_length, chunk_size, use_mmap):
+        decrypted_chunk = output[:len(chunk)]
+        cipher.decrypt(chunk, output=decrypted_chunk)
+        outfile.write(decrypted_chunk)
+        if progress:
+            progress(len(chunk))
+
+    # Read the tag from the end of the file
+    infile.seek(tag_start_offset)
+    tag = infile.read(TAG_LENGTH)
+
+    if len(tag) != TAG_LENGTH:
+        raise ValueError("Failed to read complete cipher tag.")
+    # Verify the tag
+    cipher.verify(tag)
+
+
+def _decrypt_compressed_to_file(input_filepath, outfile, password, salt, nonce, format_version, kdf, compression,
+                                progress=None):
+    writer = DecompressingWriter(outfile, compression)
+    for chunk in _iter_decrypted_container(input_filepath, password, salt, nonce, format_version, 0, None, kdf):
+        writer.write(chunk)
+        if progress:
+            progress(len(chunk))
+    writer.close()
+
+
+def _decrypt_v2_to_file(infile, outfile, password, kdf, use_mmap=False, progress=None):
+    header = infile.read(V2_HEADER_LENGTH)
+    salt, nonce_prefix, segment_size = unpack_v2_header(header)
+    file_size = os.fstat(infile.fileno()).st_size
+    segment_count, size = v2_sizes(infile, segment_size, file_size)
+    key = get_file_key(password, salt, kdf)
+    # Segments are read back to back and decrypted into the same output buffer, which is
+    # only written out once the segment's tag has been verified
+    output = memoryview(bytearray(min(segment_size, size)))
+    preallocate(outfile, size)
+    sealed_segments = iter_views(infile, V2_HEADER_LENGTH, file_size - V2_HEADER_LENGTH,
+                                 segment_size + TAG_LENGTH, use_mmap)
+    for index, sealed in enumerate(sealed_segments):
+        if len(sealed) < TAG_LENGTH:
+            raise ValueError("Encrypted segment is truncated.")
+        plaintext = output[:len(sealed) - TAG_LENGTH]
+        cipher = _segment_cipher(key, header, nonce_prefix, index, final=index == segment_count - 1)
+        cipher.decrypt(sealed[:-TAG_LENGTH], output=plaintext)
+        cipher.verify(sealed[-TAG_LENGTH:])
+        outfile.write(plaintext)
+        if progress:
+            progress(len(sealed))
+
+
+def decrypt_file_from_disk(input_filepath, output_filepath, password, salt, nonce, format_version=FORMAT_V1,
+                           kdf=KDF_PBKDF2, compression=COMPRESSION_NONE, chunk_size=None, use_mmap=False,
+                           progress=None):
     """
     Decrypts an encrypted file from input_filepath and writes the decrypted
     content to output_filepath.
@@ -70,48 +443,28 @@ def decrypt_file_from_disk(input_filepath, output_filepath, password, salt, nonc
         password (str): The password used for decryption.
         salt (bytes): The salt used during encryption (retrieved from DB).
         nonce (bytes): The nonce used during encryption (retrieved from DB).
+        format_version (int): Container format of the encrypted file (retrieved from DB).
+            v2 files carry their salt and nonce prefix in the authenticated header.
+        kdf (str): Key derivation function used during encryption (retrieved from DB).
+        compression (str): Codec the plaintext was compressed with before encryption (retrieved from DB).
+        chunk_size (int): Bytes of v1 ciphertext decrypted at a time, picked from the file size if not given.
+            v2 files are read segment by segment.
+        use_mmap (bool): Map the encrypted file into memory instead of reading it into a buffer.
+        progress (callable): Called with the number of encrypted bytes processed after every chunk.
 
     Returns:
         bool: True if decryption was successful, False otherwise.
               (Raises ValueError on tag mismatch/wrong password, which can be caught by caller)
     """
     try:
-        key = derive_key(password, salt)
-        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-
         with open(input_filepath, 'rb') as infile, open(output_filepath, 'wb') as outfile:
-            # Read and discard the salt and nonce (they are passed as arguments)
-            # Ensure the file pointer is at the start of the ciphertext
-            infile.seek(SALT_LENGTH + NONCE_LENGTH)  # Move past salt and nonce
-
-            # Calculate where the tag should be (16 bytes from end)
-            file_size = os.path.getsize(input_filepath)
-            tag_start_offset = file_size - 16
-
-            if tag_start_offset < (SALT_LENGTH + NONCE_LENGTH):  # Ensure file is large enough for header + tag
-                raise ValueError("Encrypted file is too small or corrupted.")
-
-            # Read ciphertext in chunks, but be careful not to read the tag
-            current_pos = infile.tell()
-            while current_pos < tag_start_offset:
-                bytes_to_read = min(CHUNK_SIZE, tag_start_offset - current_pos)
-                chunk = infile.read(bytes_to_read)
-                if not chunk:
-                    raise ValueError("Unexpected end of encrypted file before tag.")
-                decrypted_chunk = cipher.decrypt(chunk)
-                outfile.write(decrypted_chunk)
-                current_pos = infile.tell()
-
-            # TODO: Setup Celery task to delete the temporary decrypted file after a certain time (time defined in settings.py)
-
-            # Read the tag from the end of the file
-            infile.seek(tag_start_offset)
-            tag = infile.read(16)
-
-            if len(tag) != 16:
-                raise ValueError("Failed to read complete cipher tag.")
-            # Verify the tag
-            cipher.verify(tag)
+            if compression != COMPRESSION_NONE:
+                _decrypt_compressed_to_file(input_filepath, outfile, password, salt, nonce, format_version, kdf,
+                                            compression, progress)
+            elif format_version == FORMAT_V2:
+                _decrypt_v2_to_file(infile, outfile, password, kdf, use_mmap, progress)
+            else:
+                _decrypt_v1_to_file(infile, outfile, password, salt, nonce, kdf, chunk_size, use_mmap, progress)
 
         return True
 
@@ -133,37 +486,41 @@ def decrypt_file_from_disk(input_filepath, output_filepath, password, salt, nonc
         return False
 
 
-def decrypt_file_from_disk_to_memory(input_path, password, salt, nonce):
+def iter_decrypted_preview(input_path, password, salt, nonce, format_version=FORMAT_V1, kdf=KDF_PBKDF2,
+                           start=0, length=PREVIEW_MAX_BYTES, max_bytes=PREVIEW_MAX_BYTES,
+                           compression=COMPRESSION_NONE):
     """
-    Decrypts a file from disk and returns its content as bytes. Useful to show data within the browser.
+    Yields the decrypted bytes in [start, start + length) without ever holding more than
+    `max_bytes` of plaintext in memory. Useful to show data within the browser.
+
+    v2 files only read and verify the segments covering the window. v1 files have a single tag
+    at the end, so the whole file is streamed through GCM and only the window is kept; nothing
+    is yielded until the tag has been verified.
 
     Args:
         input_path (str): Path to the encrypted file.
         password (str): The password used for decryption.
         salt (bytes): The salt used during encryption (retrieved from DB).
         nonce (bytes): The nonce used during encryption (retrieved from DB).
-
-    Returns:
-        bytes: The decrypted content of the file.
+        format_version (int): Container format of the encrypted file (retrieved from DB).
+        kdf (str): Key derivation function used during encryption (retrieved from DB).
+        compression (str): Codec the plaintext was compressed with before encryption (retrieved from DB).
+        start (int): Offset of the first plaintext byte to return.
+        length (int): Number of bytes requested, capped to `max_bytes`.
+        max_bytes (int): Hard cap on the plaintext returned and held in memory.
     """
-    try:
-        with open(input_path, 'rb') as infile:
-            # Skip salt and nonce already passed as arguments
-            infile.read(SALT_LENGTH)
-            infile.read(NONCE_LENGTH)
-
-            encrypted_content_remaining = infile.read()
-            tag = encrypted_content_remaining[-16:]
-            ciphertext = encrypted_content_remaining[:-16]
-
-            key = derive_key(password, salt)
-            cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-
-            decrypted_data = cipher.decrypt(ciphertext)
-            cipher.verify(tag)
-
-            return decrypted_data
-    except ValueError:
-        raise ValueError("Decryption failed: Incorrect password or file corruption.")
-    except Exception as e:
-        raise Exception(f"Error during decryption: {e}")
+    end = start + max(min(length, max_bytes), 0)
+    if format_version == FORMAT_V2:
+        yield from iter_decrypted_file(input_path, password, salt, nonce, format_version, start=start, end=end,
+                                       kdf=kdf, compression=compression)
+        return
+
+    window = bytearray()
+    position = 0
+    for chunk in iter_decrypted_file(input_path, password, salt, nonce, format_version, kdf=kdf,
+                                     compression=compression):
+        window += chunk[max(start - position, 0):max(end - position, 0)]
+        position += len(chunk)
+    # The generator above only finishes once the tag has been verified
+    for offset in range(0, len(window), CHUNK_SIZE):
+        yield bytes(window[offset:offset + CHUNK_SIZE])
@@ -0,0 +1,119 @@
+import os
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.db.models.functions import Coalesce
+
+from .expiry import decrypted_file_expiry, release_decrypted_files, remove_decrypted_file
+
+# Decrypted files under MEDIA_ROOT/decrypted_temp double as a cache: a file that is still there is
+# handed out again instead of being decrypted once more. Expiry is pushed back on every hit, so
+# ordering by `decrypted_expires_at` is also least-recently-used order, and eviction follows it.
+LOCK_KEY = 'decrypt-lock:{}'
+STATS_KEY = 'decrypt-cache:{}'
+STAT_HITS = 'hits'
+STAT_MISSES = 'misses'
+STAT_JOINED = 'joined'  # requests that attached to a decryption already running
+
+
+def record(stat):
+    key = STATS_KEY.format(stat)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The counter was evicted between add() and incr()
+        cache.set(key, 1, timeout=None)
+
+
+def cached_decryption(encrypted_file):
+    """
+    Path of a decrypted copy of `encrypted_file` that can be downloaded right away, or None.
+    A hit keeps the copy around for another DECRYPTED_FILE_TTL_MINUTES.
+    """
+    path = encrypted_file.decrypted_temp_path
+    if encrypted_file.status != 'DECRYPTED' or not path or not os.path.exists(path):
+        return None
+    encrypted_file.decrypted_expires_at = decrypted_file_expiry()
+    encrypted_file.__class__.objects.filter(pk=encrypted_file.pk, decrypted_temp_path=path).update(
+        decrypted_expires_at=encrypted_file.decrypted_expires_at)
+    return path
+
+
+def acquire_decryption(file_id, task_id):
+    """
+    Claims the decryption of a file for `task_id`, unless another task is already decrypting it.
+    The claim is a Redis key, so it holds across web processes; it lapses after
+    DECRYPT_LOCK_TIMEOUT seconds in case the worker dies.
+
+    Returns:
+        tuple: (task_id, started). The ID of the task to follow, and whether the caller has to start it.
+    """
+    key = LOCK_KEY.format(file_id)
+    for _ in range(2):
+        if cache.add(key, task_id, timeout=settings.DECRYPT_LOCK_TIMEOUT):
+            return task_id, True
+        running = cache.get(key)
+        if running is not None:
+            return running, False
+        # The running task finished between add() and get(), try once more
+    return task_id, cache.add(key, task_id, timeout=settings.DECRYPT_LOCK_TIMEOUT)
+
+
+def release_decryption(file_id, task_id):
+    key = LOCK_KEY.format(file_id)
+    if cache.get(key) == task_id:
+        cache.delete(key)
+
+
+def _cached_files():
+    from .models import EncryptedFile
+
+    return EncryptedFile.objects.filter(decrypted_temp_path__isnull=False)
+
+
+def _cached_size_expression():
+    # Compressed files are only sized by original_file_size; the ciphertext size is close enough otherwise
+    return Coalesce('original_file_size', 'file_size')
+
+
+def cached_bytes():
+    return _cached_files().aggregate(total=Sum(_cached_size_expression()))['total'] or 0
+
+
+def evict_over_budget(max_bytes=None, keep=None):
+    """
+    Removes least recently used decrypted files until they fit in DECRYPTED_CACHE_MAX_BYTES.
+    The file with ID `keep`, typically the one just decrypted, is never evicted.
+
+    Returns:
+        int: Number of files evicted.
+    """
+    max_bytes = settings.DECRYPTED_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    total = cached_bytes()
+    if total <= max_bytes:
+        return 0
+    count = 0
+    candidates = (_cached_files().exclude(pk=keep).annotate(cached_size=_cached_size_expression())
+                  .order_by('decrypted_expires_at').values_list('pk', 'decrypted_temp_path', 'cached_size'))
+    for pk, path, size in candidates.iterator():
+        if total <= max_bytes:
+            break
+        remove_decrypted_file(path)
+        # Only reset the row if it still points at the file that was removed
+        if release_decrypted_files(_cached_files().filter(pk=pk, decrypted_temp_path=path)):
+            count += 1
+        total -= size or 0
+    return count
+
+
+def cache_stats():
+    counters = cache.get_many([STATS_KEY.format(stat) for stat in (STAT_HITS, STAT_MISSES, STAT_JOINED)])
+    return {
+        'hits': counters.get(STATS_KEY.format(STAT_HITS), 0),
+        'misses': counters.get(STATS_KEY.format(STAT_MISSES), 0),
+        'joined': counters.get(STATS_KEY.format(STAT_JOINED), 0),
+        'files': _cached_files().count(),
+        'bytes': cached_bytes(),
+        'max_bytes': settings.DECRYPTED_CACHE_MAX_BYTES,
+    }
@@ -0,0 +1,187 @@
+import asyncio
+import json
+from functools import lru_cache, partial
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+import redis
+import redis.asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+# Tasks publish every status change of a file on its own Redis channel, and the SSE endpoint
+# (core/asgi.py) relays them to browsers, so pages don't have to poll for task status.
+CHANNEL_PREFIX = 'fileguard:file:'
+SETTLED_STATUSES = ('COMPLETED', 'DECRYPTED', 'FAILED')  # no task is working on the file
+HEARTBEAT_SECONDS = 15
+
+
+def file_channel(file_id):
+    return f"{CHANNEL_PREFIX}{file_id}"
+
+
+def file_event(file_id, status, **fields):
+    """
+    The payload sent to browsers for a file; extra fields such as progress are passed through.
+    """
+    return {'file_id': int(file_id), 'status': status, 'settled': status in SETTLED_STATUSES, **fields}
+
+
+@lru_cache(maxsize=1)
+def _redis_client():
+    return redis.Redis.from_url(settings.EVENTS_REDIS_URL)
+
+
+def _publish(file_id, status, **fields):
+    try:
+        _redis_client().publish(file_channel(file_id), json.dumps(file_event(file_id, status, **fields)))
+    except redis.RedisError as e:
+        print(f"Celery: Could not publish status of file {file_id}: {e}")
+
+
+def publish_file_event(file_id, status, **fields):
+    """
+    Announces a file's new status once the surrounding transaction commits, so pages reacting to
+    it read the new row. Events are a courtesy to open pages, so a Redis outage is logged rather
+    than failing the task that changed the status.
+    """
+    transaction.on_commit(partial(_publish, file_id, status, **fields))
+
+
+def publish_file_progress(file_id, status, progress):
+    """
+    Announces how far a running task has got. Progress doesn't change the row, so it is
+    published right away rather than on commit.
+    """
+    _publish(file_id, status, progress=progress)
+
+
+def format_sse(event):
+    return f"data: {json.dumps(event)}\n\n".encode()
+
+
+async def stream_file_events(file_ids):
+    """
+    Yields SSE messages for `file_ids`, starting with their current status, until every file
+    has settled, then a `done` event. A comment is sent every HEARTBEAT_SECONDS so proxies keep
+    the connection open. Files deleted meanwhile stop being watched, and after
+    EVENTS_STREAM_MAX_SECONDS the stream ends without `done`, so the browser reconnects afresh.
+    """
+    deadline = asyncio.get_running_loop().time() + settings.EVENTS_STREAM_MAX_SECONDS
+    client = redis.asyncio.Redis.from_url(settings.EVENTS_REDIS_URL)
+    pubsub = client.pubsub()
+    try:
+        # Subscribe before reading the current status, so no change in between is missed
+        if file_ids:
+            await pubsub.subscribe(*(file_channel(file_id) for file_id in file_ids))
+        pending = set()
+        for file_id, event in (await sync_to_async(file_snapshot)(file_ids)).items():
+            yield format_sse(event)
+            if not event['settled']:
+                pending.add(file_id)
+        while pending:
+            if asyncio.get_running_loop().time() >= deadline:
+                return
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=HEARTBEAT_SECONDS)
+            if message is None:
+                # A file deleted while a task was pending never announces a settled status
+                current = await sync_to_async(file_snapshot)(pending)
+                for file_id in list(pending):
+                    if file_id not in current:
+                        pending.discard(file_id)
+                    elif current[file_id]['settled']:
+                        yield format_sse(current[file_id])
+                        pending.discard(file_id)
+                yield b": heartbeat\n\n"
+                continue
+            event = json.loads(message['data'])
+            yield format_sse(event)
+            if event['settled']:
+                pending.discard(event['file_id'])
+        # Browsers reconnect whenever a stream ends, unless told there is nothing more to wait for
+        yield b"event: done\ndata: {}\n\n"
+    finally:
+        await pubsub.aclose()
+        await client.aclose()
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def sse_response(send, receive, messages):
+    """
+    Sends `messages` (an async iterator of bytes) as a text/event-stream ASGI response,
+    stopping as soon as the browser goes away.
+    """
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+
+    async def relay():
+        async for message in messages:
+            await send({'type': 'http.response.body', 'body': message, 'more_body': True})
+
+    relay_task = asyncio.ensure_future(relay())
+    disconnect_task = asyncio.ensure_future(wait_for_disconnect(receive))
+    done, _ = await asyncio.wait({relay_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    for task in (relay_task, disconnect_task):
+        task.cancel()
+    # Let the stream unsubscribe and close its Redis connection
+    await asyncio.gather(relay_task, disconnect_task, return_exceptions=True)
+    if relay_task in done:
+        relay_task.result()
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+def parse_file_ids(value):
+    """
+    Parses a comma-separated list of file IDs, ignoring anything that is not one.
+    """
+    ids = []
+    for part in (value or '').split(','):
+        if part.strip().isdigit() and len(ids) < settings.EVENTS_MAX_FILES:
+            ids.append(int(part))
+    return ids
+
+
+def file_snapshot(file_ids):
+    """
+    Current event of every existing file in `file_ids`, read with a single query.
+    """
+    from .models import EncryptedFile
+
+    files = EncryptedFile.objects.filter(pk__in=file_ids).values_list('pk', 'status')
+    return {pk: file_event(pk, status) for pk, status in files}
+
+
+def _is_authenticated(cookie_header):
+    from apps.security.models import Session
+
+    cookies = SimpleCookie()
+    cookies.load(cookie_header)
+    morsel = cookies.get('fileguard_session')
+    session = Session.manage.authenticate_session(morsel.value) if morsel else None
+    return bool(session and session.is_valid)
+
+
+async def file_events_app(scope, receive, send):
+    """
+    ASGI endpoint streaming status events for the files in `?ids=1,2,3`. The session is checked
+    and the current statuses are read once when the stream opens; after that the connection only
+    waits on Redis, so open tabs cost neither database queries nor a web worker.
+    """
+    headers = dict(scope['headers'])
+    if not await sync_to_async(_is_authenticated)(headers.get(b'cookie', b'').decode('latin-1')):
+        await send({'type': 'http.response.start', 'status': 403, 'headers': [(b'content-type', b'text/plain')]})
+        await send({'type': 'http.response.body', 'body': b'Not authenticated.'})
+        return
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    await sse_response(send, receive, stream_file_events(parse_file_ids(query.get('ids', [''])[0])))
@@ -0,0 +1,97 @@
+import os
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Case, F, Value, When
+from django.utils.timezone import now
+
+# Decrypted plaintext only lives under MEDIA_ROOT/decrypted_temp until it expires
+DECRYPTED_TEMP_DIR = 'decrypted_temp'
+EXPIRY_BATCH_SIZE = 500
+
+
+def decrypted_temp_dir():
+    return os.path.join(settings.MEDIA_ROOT, DECRYPTED_TEMP_DIR)
+
+
+def decrypted_file_expiry():
+    """
+    When a decrypted file written now has to be removed.
+    """
+    return now() + timedelta(minutes=settings.DECRYPTED_FILE_TTL_MINUTES)
+
+
+def remove_decrypted_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def release_decrypted_files(queryset):
+    """
+    Resets rows whose decrypted files were removed. Returns the number of rows updated.
+    """
+    return queryset.update(
+        decrypted_temp_path=None,
+        decrypted_expires_at=None,
+        status=Case(When(status='DECRYPTED', then=Value('COMPLETED')), default=F('status')),
+    )
+
+
+def expire_decrypted_files(batch_size=EXPIRY_BATCH_SIZE):
+    """
+    Removes decrypted files whose expiry has passed and resets their rows, a batch at a time.
+    Only the index on `decrypted_expires_at` is consulted, the directory is never listed.
+
+    Returns:
+        int: Number of files expired.
+    """
+    from .models import EncryptedFile
+
+    cutoff = now()
+    count = 0
+    while True:
+        expired = list(EncryptedFile.objects.filter(decrypted_expires_at__lte=cutoff)
+                       .values_list('pk', 'decrypted_temp_path')[:batch_size])
+        if not expired:
+            return count
+        for _, path in expired:
+            if path:
+                remove_decrypted_file(path)
+        # A file decrypted again in the meantime has a new path and expiry, and is left alone
+        count += release_decrypted_files(EncryptedFile.objects.filter(
+            pk__in=[pk for pk, _ in expired], decrypted_expires_at__lte=cutoff))
+
+
+def remove_orphan_decrypted_files(min_age=None):
+    """
+    Removes files in the decrypted directory that no row references, e.g. left behind by a
+    worker that died mid-decryption. Files younger than `min_age` may still be being written.
+
+    Returns:
+        int: Number of files removed.
+    """
+    from .models import EncryptedFile
+
+    directory = decrypted_temp_dir()
+    if not os.path.isdir(directory):
+        return 0
+    min_age = min_age or timedelta(minutes=settings.DECRYPTED_FILE_TTL_MINUTES)
+    cutoff = time.time() - min_age.total_seconds()
+    candidates = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff:
+                candidates.append(entry.path)
+
+    count = 0
+    for start in range(0, len(candidates), EXPIRY_BATCH_SIZE):
+        batch = candidates[start:start + EXPIRY_BATCH_SIZE]
+        referenced = set(EncryptedFile.objects.filter(
+            decrypted_temp_path__in=batch).values_list('decrypted_temp_path', flat=True))
+        for path in batch:
+            if path not in referenced:
+                remove_decrypted_file(path)
+                count += 1
+    return count
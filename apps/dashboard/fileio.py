@@ -0,0 +1,121 @@
+import mmap
+import os
+
+# --- Configuration
+MIN_IO_CHUNK_SIZE = 64 * 1024
+MAX_IO_CHUNK_SIZE = 4 * 1024 * 1024
+READS_PER_FILE = 64  # adaptive chunk sizes grow until a file takes about this many reads
+
+
+def adaptive_chunk_size(file_size):
+    """
+    Picks a read size for a file: 64 KB for small files, doubling up to 4 MB for large ones,
+    so large files cost fewer system calls while small ones don't over-allocate.
+    """
+    size = MIN_IO_CHUNK_SIZE
+    while file_size and size < MAX_IO_CHUNK_SIZE and size * READS_PER_FILE < file_size:
+        size *= 2
+    return size
+
+
+def remaining_size(fileobj):
+    """
+    Bytes left to read in a file-like object, or None if it can't be told without reading.
+    """
+    try:
+        return os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+    except (AttributeError, OSError, ValueError):
+        pass
+    size = getattr(fileobj, 'size', None)  # Django's UploadedFile
+    if size is not None:
+        return size
+    try:
+        position = fileobj.tell()
+        end = fileobj.seek(0, os.SEEK_END)
+        fileobj.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def readinto(fileobj, view):
+    """
+    Fills `view` from fileobj, returning the number of bytes read; fewer than len(view) only at EOF.
+    Objects without readinto() are read and copied into the view.
+    """
+    reader = getattr(fileobj, 'readinto', None)
+    total = 0
+    while total < len(view):
+        if reader is not None:
+            count = reader(view[total:]) or 0
+        else:
+            data = fileobj.read(len(view) - total)
+            count = len(data)
+            view[total:total + count] = data
+        if not count:
+            break
+        total += count
+    return total
+
+
+def advise_sequential(fileobj):
+    """
+    Tells the kernel the file will be read front to back, so it reads ahead more aggressively.
+    """
+    try:
+        os.posix_fadvise(fileobj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+def preallocate(fileobj, size):
+    """
+    Reserves `size` bytes for an output file up front, so it is laid out contiguously on disk.
+    The caller truncates the file to what was actually written once done.
+    """
+    if not size:
+        return
+    try:
+        os.posix_fallocate(fileobj.fileno(), 0, size)
+    except (AttributeError, OSError, ValueError):
+        pass
+
+
+def iter_views(fileobj, offset, length, chunk_size, use_mmap=False):
+    """
+    Yields memoryviews over `length` bytes of fileobj starting at `offset`, `chunk_size` at a time.
+    One buffer is reused for every read, so each view is only valid until the next is requested.
+    With use_mmap the views point straight into the page cache and nothing is copied at all.
+    Raises ValueError if the file ends early.
+    """
+    if length <= 0:
+        return
+    if use_mmap:
+        mapped = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mapped, 'madvise'):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapped)
+        try:
+            if offset + length > len(view):
+                raise ValueError("Unexpected end of encrypted file.")
+            for start in range(offset, offset + length, chunk_size):
+                yield view[start:min(start + chunk_size, offset + length)]
+        finally:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                # The caller still holds the last view; the mapping goes away when it is collected
+                pass
+        return
+
+    advise_sequential(fileobj)
+    buffer = memoryview(bytearray(min(chunk_size, length)))
+    fileobj.seek(offset)
+    remaining = length
+    while remaining > 0:
+        count = readinto(fileobj, buffer[:min(len(buffer), remaining)])
+        if not count:
+            raise ValueError("Unexpected end of encrypted file.")
+        remaining -= count
+        yield buffer[:count]
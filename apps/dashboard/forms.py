@@ -18,6 +18,12 @@ class EncryptFileForm(forms.Form):
         return cleaned_data
 
 
+class CreateUploadSessionForm(forms.Form):
+    filename = forms.CharField(max_length=255)
+    size = forms.IntegerField(min_value=1, help_text='Size of the file in bytes')
+    parent_directory = forms.IntegerField(required=False)
+
+
 class CreateDirectoryForm(forms.Form):
     directory_name = forms.CharField(
         label='Directory Name',
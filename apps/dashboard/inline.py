@@ -0,0 +1,144 @@
+import os
+import uuid
+from django.conf import settings
+from django.db.models import Sum
+
+from .chunkstore import STORAGE_CHUNKED, save_file_chunks
+from .compression import COMPRESSION_NONE, CompressingReader
+from .crypto import FORMAT_V2, KDF_HKDF, save_encrypted_file_to_disk
+from .events import publish_file_event
+from .keyring import chunk_store_key
+from .models import EncryptedFile
+from .progress import ProgressReader, ProgressReporter
+
+# Files up to INLINE_CRYPTO_MAX_BYTES are encrypted and decrypted in the request itself. Their crypto
+# takes microseconds, far less than the broker round trip and status writes of a Celery task.
+
+
+def runs_inline(size):
+    """
+    Whether a file of `size` bytes is small enough to be handled in the request.
+    """
+    return settings.INLINE_CRYPTO_MAX_BYTES > 0 and size is not None and size <= settings.INLINE_CRYPTO_MAX_BYTES
+
+
+def finalize_upload_inline(uploaded_file, directory):
+    """
+    Records a file that was encrypted while it was received, without finalize_encrypted_upload_task.
+
+    Args:
+        uploaded_file: EncryptedUploadedFile from the encrypting upload handler.
+        directory: Directory the file goes in, or None.
+
+    Returns:
+        EncryptedFile: The saved entry, COMPLETED, or FAILED if its ciphertext is incomplete.
+    """
+    encrypted_file_instance = EncryptedFile(
+        original_filename=uploaded_file.name,
+        original_file_size=uploaded_file.size,
+        directory=directory,
+        **uploaded_file.encryption_fields(),
+    )
+    encrypted_file_instance.status = 'COMPLETED' if encrypted_file_instance.has_complete_content() else 'FAILED'
+    encrypted_file_instance.save()
+    publish_file_event(encrypted_file_instance.pk, encrypted_file_instance.status)
+    return encrypted_file_instance
+
+
+def finalize_resumable_upload_inline(encrypted_file_instance):
+    """
+    Finishes a completed resumable upload, without finalize_encrypted_upload_task. Its chunks
+    were encrypted into place as they arrived, so only the size of the ciphertext is checked.
+
+    Returns:
+        EncryptedFile: The entry, COMPLETED, or FAILED if its ciphertext is incomplete.
+    """
+    encrypted_file_instance.status = 'COMPLETED' if encrypted_file_instance.has_complete_content() else 'FAILED'
+    encrypted_file_instance.save(update_fields=['status'])
+    publish_file_event(encrypted_file_instance.pk, encrypted_file_instance.status)
+    return encrypted_file_instance
+
+
+def encrypt_upload_inline(uploaded_file, directory):
+    """
+    Encrypts an upload straight from the request, without a temporary file or perform_encryption_task.
+
+    Args:
+        uploaded_file: Django UploadedFile holding the plaintext.
+        directory: Directory the file goes in, or None.
+
+    Returns:
+        EncryptedFile: The saved, COMPLETED entry.
+
+    Raises:
+        Exception: Whatever the encryption raised. No ciphertext is left behind, and a chunked
+        entry is marked FAILED.
+    """
+    encrypted_file_instance = EncryptedFile(
+        original_filename=uploaded_file.name,
+        original_file_size=uploaded_file.size,
+        directory=directory,
+    )
+    progress = ProgressReporter(uploaded_file.size)
+    uploaded_file.seek(0)
+    reader = ProgressReader(uploaded_file, progress)
+    if settings.STORAGE_MODE == STORAGE_CHUNKED:
+        _encrypt_to_chunks(encrypted_file_instance, reader)
+    else:
+        _encrypt_to_blob(encrypted_file_instance, reader)
+    encrypted_file_instance.status = 'COMPLETED'
+    encrypted_file_instance.encryption_mb_per_s = progress.finish()['avg_mb_per_s']
+    encrypted_file_instance.save()
+    publish_file_event(encrypted_file_instance.pk, encrypted_file_instance.status)
+    return encrypted_file_instance
+
+
+def _encrypt_to_blob(encrypted_file_instance, reader):
+    data_key = encrypted_file_instance.new_data_key()
+    encrypted_file_name = os.path.join('encrypted_files', f"{uuid.uuid4().hex}.enc")
+    encrypted_file_path = os.path.join(settings.MEDIA_ROOT, encrypted_file_name)
+    os.makedirs(os.path.dirname(encrypted_file_path), exist_ok=True)
+    reader = CompressingReader(reader, settings.COMPRESSION_CODEC)
+    try:
+        salt, nonce, encrypted_file_size = save_encrypted_file_to_disk(reader, encrypted_file_path, data_key)
+    except Exception:
+        if os.path.exists(encrypted_file_path):
+            os.remove(encrypted_file_path)
+        raise
+    encrypted_file_instance.encrypted_file = encrypted_file_name
+    encrypted_file_instance.file_size = encrypted_file_size
+    encrypted_file_instance.salt = salt
+    encrypted_file_instance.nonce = nonce
+    encrypted_file_instance.format_version = FORMAT_V2
+    encrypted_file_instance.kdf = KDF_HKDF
+    encrypted_file_instance.compression = reader.codec
+    encrypted_file_instance.compressed_size = reader.output_bytes if reader.codec != COMPRESSION_NONE else None
+
+
+def _encrypt_to_chunks(encrypted_file_instance, reader):
+    # Chunk references need the row to exist first
+    encrypted_file_instance.storage_mode = STORAGE_CHUNKED
+    encrypted_file_instance.encrypted_file = ''
+    encrypted_file_instance.file_size = 0
+    encrypted_file_instance.status = 'PROCESSING'
+    encrypted_file_instance.save()
+    try:
+        save_file_chunks(encrypted_file_instance, reader, chunk_store_key())
+    except Exception:
+        encrypted_file_instance.status = 'FAILED'
+        encrypted_file_instance.save()
+        publish_file_event(encrypted_file_instance.pk, encrypted_file_instance.status)
+        raise
+    encrypted_file_instance.file_size = encrypted_file_instance.chunk_refs.aggregate(
+        total=Sum('chunk__stored_size'))['total'] or 0
+
+
+def decrypt_inline(encrypted_file_instance):
+    """
+    Decrypts a small file into memory. Unlike streaming it, this verifies a v1 file's tag before
+    any plaintext is sent.
+
+    Raises:
+        ValueError: If the file fails authentication.
+    """
+    return b''.join(encrypted_file_instance.iter_plaintext())
@@ -0,0 +1,183 @@
+import os
+import re
+import time
+from functools import lru_cache
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from core.settings import BASE_DIR
+
+# Envelope encryption: every file is encrypted under its own random data key, and only that key is
+# stored, wrapped (AES-GCM) by a versioned master key. Rotating the master key rewraps the small
+# per-file records instead of re-encrypting the files. The original config/encryption_key.key is
+# master key version 0; files encrypted before data keys existed use it as their data key.
+LEGACY_KEY_PATH = BASE_DIR / 'config' / 'encryption_key.key'
+MASTER_KEY_DIR = BASE_DIR / 'config' / 'master_keys'
+LEGACY_KEY_VERSION = 0
+KEY_LENGTH = 32
+WRAP_NONCE_LENGTH = 12
+WRAP_TAG_LENGTH = 16
+WRAPPED_KEY_LENGTH = WRAP_NONCE_LENGTH + KEY_LENGTH + WRAP_TAG_LENGTH
+KEY_RING_MAX_AGE = 60  # seconds a process goes without re-reading the master keys
+_MASTER_KEY_NAME = re.compile(r'^(\d+)\.key$')
+
+
+def master_key_path(version):
+    return LEGACY_KEY_PATH if version == LEGACY_KEY_VERSION else MASTER_KEY_DIR / f"{version}.key"
+
+
+class KeyRing:
+    """
+    The master keys by version. New data keys are wrapped with the newest one.
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise FileNotFoundError("Encryption key file does not exist. Please generate it first.")
+        self.keys = keys
+        self.current_version = max(keys)
+
+    def _aad(self, version):
+        return b'fileguard data key v%d' % version
+
+    def wrap(self, data_key, version=None):
+        """
+        Returns:
+            tuple: (wrapped_key, master_key_version)
+        """
+        version = self.current_version if version is None else version
+        nonce = get_random_bytes(WRAP_NONCE_LENGTH)
+        cipher = AES.new(self.keys[version], AES.MODE_GCM, nonce=nonce)
+        cipher.update(self._aad(version))
+        ciphertext, tag = cipher.encrypt_and_digest(data_key)
+        return nonce + ciphertext + tag, version
+
+    def unwrap(self, wrapped_key, version):
+        """
+        Raises:
+            KeyError: If the master key `version` is not in the ring.
+            ValueError: If the wrapped key was tampered with or wrapped by another key.
+        """
+        wrapped_key = bytes(wrapped_key)
+        cipher = AES.new(self.keys[version], AES.MODE_GCM, nonce=wrapped_key[:WRAP_NONCE_LENGTH])
+        cipher.update(self._aad(version))
+        return cipher.decrypt_and_verify(wrapped_key[WRAP_NONCE_LENGTH:-WRAP_TAG_LENGTH],
+                                         wrapped_key[-WRAP_TAG_LENGTH:])
+
+
+def read_master_keys():
+    """
+    Reads every master key from the config folder.
+
+    Returns:
+        dict: {version: key}
+    """
+    keys = {}
+    if os.path.exists(LEGACY_KEY_PATH):
+        with open(LEGACY_KEY_PATH, 'rb') as f:
+            keys[LEGACY_KEY_VERSION] = f.read()
+    if os.path.isdir(MASTER_KEY_DIR):
+        for name in os.listdir(MASTER_KEY_DIR):
+            match = _MASTER_KEY_NAME.match(name)
+            if match:
+                with open(MASTER_KEY_DIR / name, 'rb') as f:
+                    keys[int(match.group(1))] = f.read()
+    return keys
+
+
+def _key_files_stamp():
+    """
+    Changes whenever a master key is added or deleted, as both move the key folder's mtime, and
+    at least every KEY_RING_MAX_AGE seconds in case two changes fell in one mtime tick.
+    """
+    stamp = [int(time.monotonic() // KEY_RING_MAX_AGE)]
+    for path in (LEGACY_KEY_PATH, MASTER_KEY_DIR):
+        try:
+            stamp.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+@lru_cache(maxsize=1)
+def _key_ring(stamp):
+    return KeyRing(read_master_keys())
+
+
+def load_key_ring():
+    """
+    The master key ring. It is read from disk again once a key was added or deleted, so a rotation
+    reaches running processes on their next wrap, without a restart.
+    """
+    return _key_ring(_key_files_stamp())
+
+
+def reload_key_ring():
+    _key_ring.cache_clear()
+    return load_key_ring()
+
+
+def legacy_master_key():
+    """
+    Master key version 0, the data key of files encrypted before envelope encryption.
+    """
+    return load_key_ring().keys[LEGACY_KEY_VERSION]
+
+
+def generate_data_key():
+    """
+    A new random data key, wrapped with the current master key.
+
+    Returns:
+        tuple: (data_key, wrapped_key, master_key_version)
+    """
+    data_key = get_random_bytes(KEY_LENGTH)
+    wrapped_key, version = load_key_ring().wrap(data_key)
+    return data_key, wrapped_key, version
+
+
+def unwrap_data_key(wrapped_key, version):
+    ring = load_key_ring()
+    if version not in ring.keys:
+        # Another process rotated the master key since this one read the ring
+        ring = reload_key_ring()
+    return ring.unwrap(wrapped_key, version)
+
+
+def add_master_key():
+    """
+    Writes a new master key, one version above the newest, and reloads the ring with it.
+
+    Returns:
+        int: The new version.
+    """
+    version = max(read_master_keys() or {LEGACY_KEY_VERSION: None}) + 1
+    os.makedirs(MASTER_KEY_DIR, exist_ok=True)
+    # Written under a temporary name first, so no process reads the key before it is complete
+    partial = MASTER_KEY_DIR / f".{version}.key.{os.getpid()}"
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(get_random_bytes(KEY_LENGTH))
+            f.flush()
+            os.fsync(f.fileno())
+        # A link fails if the name exists, so two rotations at once can't overwrite each other's key
+        os.link(partial, master_key_path(version))
+    finally:
+        os.remove(partial)
+    reload_key_ring()
+    return version
+
+
+@lru_cache(maxsize=1)
+def chunk_store_key():
+    """
+    Data key of the chunk store, shared by all chunks so identical chunks deduplicate across
+    files. Stores created before envelope encryption were keyed by master key version 0, so
+    that is what the key starts as.
+    """
+    from .models import ChunkStoreKey
+
+    wrapped_key, version = load_key_ring().wrap(legacy_master_key())
+    record, _ = ChunkStoreKey.objects.get_or_create(
+        pk=1, defaults={'wrapped_data_key': wrapped_key, 'master_key_version': version})
+    return record.data_key()
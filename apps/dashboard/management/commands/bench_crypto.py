@@ -0,0 +1,246 @@
+import itertools
+import json
+import math
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+import Crypto
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.utils.timezone import now
+
+from apps.dashboard.crypto import (
+    CHUNK_SIZE, FORMAT_V1, FORMAT_V2, KDF_CHOICES, KDF_HKDF, SEGMENT_SIZE, _derive_file_key,
+    decrypt_file_from_disk, save_encrypted_file_to_disk,
+)
+from apps.dashboard.parallel import EXECUTOR_PROCESS, EXECUTOR_THREAD, parallel_decrypt_file, parallel_encrypt_file
+
+_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+_MB = 1024 * 1024
+
+
+def parse_size(value):
+    """
+    Parses '64KB', '1MB', '2GB' or a plain number of bytes.
+    """
+    value = value.strip().upper()
+    for unit in ('GB', 'MB', 'KB', 'B'):
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * _UNITS[unit])
+    return int(value)
+
+
+def _size_list(value):
+    return [parse_size(v) for v in value.split(',') if v.strip()]
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def _str_list(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+
+def _percentile(values, pct):
+    # Nearest-rank percentile, exact for the handful of samples a benchmark takes
+    ordered = sorted(values)
+    return ordered[max(math.ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+
+def _cpu_seconds():
+    # Children are included so process pools are accounted for once they shut down
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def _reset_peak_rss():
+    # Linux lets the high-water mark be reset, so every run reports its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _write_synthetic_file(path, size):
+    # Random data is incompressible and gives no cache-friendly patterns, so it is the worst case
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            block = os.urandom(min(remaining, 4 * _MB))
+            f.write(block)
+            remaining -= len(block)
+
+
+class Command(BaseCommand):
+    help = 'Measure encryption and decryption throughput across file sizes, chunk sizes, KDFs and worker counts.'
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--sizes', type=_size_list, default='1MB,16MB,64MB',
+                            help='Comma-separated synthetic file sizes, e.g. 1MB,256MB.')
+        parser.add_argument('--chunk-sizes', type=_size_list, default=f'16KB,{CHUNK_SIZE // 1024}KB,256KB,1MB',
+                            help='Comma-separated read sizes of the single-threaded path.')
+        parser.add_argument('--segment-sizes', type=_size_list, default=f'{SEGMENT_SIZE // 1024}KB',
+                            help='Comma-separated plaintext sizes of a v2 segment.')
+        parser.add_argument('--kdfs', type=_str_list, default=KDF_HKDF,
+                            help=f"Comma-separated key derivation functions: {', '.join(k for k, _ in KDF_CHOICES)}.")
+        parser.add_argument('--formats', type=_int_list, default=str(FORMAT_V2),
+                            help='Comma-separated container formats, 1 and/or 2.')
+        parser.add_argument('--workers', type=_int_list, default='1',
+                            help='Comma-separated worker counts. 1 runs the single-threaded path, '
+                                 'more runs the parallel engine (v2 only).')
+        parser.add_argument('--executor', choices=[EXECUTOR_THREAD, EXECUTOR_PROCESS], default=EXECUTOR_THREAD,
+                            help='Pool used by the parallel engine.')
+        parser.add_argument('--mmap', action='store_true',
+                            help='Map encrypted files into memory on the single-threaded decrypt path.')
+        parser.add_argument('--repeat', type=int, default=5, help='Files encrypted and decrypted per configuration.')
+        parser.add_argument('--dir', help='Directory for the synthetic and encrypted files, '
+                                          'put it on the disk you want to measure. Defaults to a temp directory.')
+        parser.add_argument('--json', dest='json_path', help="Write results as JSON to this path, '-' for stdout.")
+
+    def handle(self, *args, **kwargs):
+        for kdf in kwargs['kdfs']:
+            if kdf not in dict(KDF_CHOICES):
+                raise CommandError(f"Unknown key derivation function '{kdf}'.")
+        for format_version in kwargs['formats']:
+            if format_version not in (FORMAT_V1, FORMAT_V2):
+                raise CommandError(f"Unknown container format '{format_version}'.")
+        if kwargs['repeat'] < 1:
+            raise CommandError("--repeat must be at least 1.")
+
+        # Keep stdout clean when the JSON report goes there
+        self.log = self.stderr if kwargs['json_path'] == '-' else self.stdout
+        work_dir = tempfile.mkdtemp(prefix='bench_crypto_', dir=kwargs['dir'])
+        password = os.urandom(32)
+        results = []
+        try:
+            for size in kwargs['sizes']:
+                source_path = os.path.join(work_dir, f'plain_{size}')
+                _write_synthetic_file(source_path, size)
+                for config in self._configs(kwargs):
+                    result = self._run(config, source_path, size, work_dir, password, kwargs)
+                    results.append(result)
+                    self._report(result)
+                os.remove(source_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if kwargs['json_path']:
+            report = json.dumps({'environment': self._environment(), 'results': results}, indent=2)
+            if kwargs['json_path'] == '-':
+                self.stdout.write(report)
+            else:
+                with open(kwargs['json_path'], 'w') as f:
+                    f.write(report)
+
+    def _configs(self, options):
+        """
+        Yields every distinct (format, kdf, workers, chunk_size, segment_size) combination.
+        Chunk size only applies to the single-threaded path and segment size only to v2.
+        """
+        seen = set()
+        for format_version, kdf, workers, chunk_size, segment_size in itertools.product(
+                options['formats'], options['kdfs'], options['workers'],
+                options['chunk_sizes'], options['segment_sizes']):
+            if workers > 1 and format_version != FORMAT_V2:
+                continue
+            config = (format_version, kdf, workers,
+                      chunk_size if workers == 1 else None,
+                      segment_size if format_version == FORMAT_V2 else None)
+            if config not in seen:
+                seen.add(config)
+                yield config
+
+    def _run(self, config, source_path, size, work_dir, password, options):
+        format_version, kdf, workers, chunk_size, segment_size = config
+        encrypted_path = os.path.join(work_dir, 'bench.enc')
+        decrypted_path = os.path.join(work_dir, 'bench.out')
+        timings = {'encrypt': [], 'decrypt': []}
+        cpu = {'encrypt': 0.0, 'decrypt': 0.0}
+        _reset_peak_rss()
+        for _ in range(options['repeat']):
+            # Keys are cached per salt; clear so every file pays for its key derivation, as on a cold worker
+            _derive_file_key.cache_clear()
+            cpu_started, started = _cpu_seconds(), time.perf_counter()
+            with open(source_path, 'rb') as infile:
+                if workers > 1:
+                    salt, nonce, _, _ = parallel_encrypt_file(
+                        infile, encrypted_path, password, workers=workers, executor=options['executor'],
+                        segment_size=segment_size, kdf=kdf)
+                else:
+                    salt, nonce, _ = save_encrypted_file_to_disk(
+                        infile, encrypted_path, password, format_version, kdf,
+                        chunk_size=chunk_size, segment_size=segment_size or SEGMENT_SIZE)
+            timings['encrypt'].append(time.perf_counter() - started)
+            cpu['encrypt'] += _cpu_seconds() - cpu_started
+
+            _derive_file_key.cache_clear()
+            cpu_started, started = _cpu_seconds(), time.perf_counter()
+            if workers > 1:
+                parallel_decrypt_file(encrypted_path, decrypted_path, password, workers=workers,
+                                      executor=options['executor'], kdf=kdf)
+            elif not decrypt_file_from_disk(encrypted_path, decrypted_path, password, salt, nonce,
+                                            format_version, kdf, chunk_size=chunk_size,
+                                            use_mmap=options['mmap']):
+                raise CommandError("Decryption failed, the benchmark output is not trustworthy.")
+            timings['decrypt'].append(time.perf_counter() - started)
+            cpu['decrypt'] += _cpu_seconds() - cpu_started
+            os.remove(decrypted_path)
+        os.remove(encrypted_path)
+
+        result = {
+            'size': size,
+            'format_version': format_version,
+            'kdf': kdf,
+            'workers': workers,
+            'executor': options['executor'] if workers > 1 else None,
+            'chunk_size': chunk_size,
+            'segment_size': segment_size,
+            'repeat': options['repeat'],
+            'peak_rss_kb': _peak_rss_kb(),
+        }
+        for operation, seconds in timings.items():
+            total = sum(seconds)
+            result[operation] = {
+                'mb_per_s': round(size * len(seconds) / max(total, 1e-9) / _MB, 2),
+                'cpu_seconds': round(cpu[operation], 4),
+                'latency_ms': {f'p{pct}': round(_percentile(seconds, pct) * 1000, 2) for pct in (50, 90, 99)},
+            }
+        return result
+
+    def _report(self, result):
+        self.log.write(
+            f"{result['size'] / _MB:>9.2f} MB  v{result['format_version']}  {result['kdf']:<6}  "
+            f"workers={result['workers']:<2}  chunk={result['chunk_size'] or '-'}  "
+            f"segment={result['segment_size'] or '-'}  rss={result['peak_rss_kb'] // 1024} MB"
+        )
+        for operation in ('encrypt', 'decrypt'):
+            stats = result[operation]
+            latency = stats['latency_ms']
+            self.log.write(
+                f"    {operation}: {stats['mb_per_s']:>9.2f} MB/s  cpu={stats['cpu_seconds']:.3f}s  "
+                f"p50={latency['p50']}ms  p90={latency['p90']}ms  p99={latency['p99']}ms"
+            )
+
+    def _environment(self):
+        return {
+            'timestamp': now().isoformat(),
+            'python': platform.python_version(),
+            'pycryptodome': Crypto.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        }
@@ -0,0 +1,122 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandParser
+
+from apps.dashboard.chunkstore import STORAGE_CHUNKED
+from apps.dashboard.keyring import (
+    LEGACY_KEY_VERSION, add_master_key, chunk_store_key, legacy_master_key, master_key_path, read_master_keys,
+    reload_key_ring,
+)
+from apps.dashboard.models import ChunkStoreKey, EncryptedFile, UploadSession
+
+KEYED_MODELS = (EncryptedFile, UploadSession, ChunkStoreKey)
+
+
+def rewrap_model(model, ring, batch_size):
+    """
+    Rewraps the data keys of `model` that aren't under the current master key, `batch_size`
+    rows at a time. Only the wrapped keys change; the encrypted content is never touched.
+
+    Returns:
+        int: Rows rewrapped.
+    """
+    stale = (model.objects
+             .filter(wrapped_data_key__isnull=False)
+             .exclude(master_key_version=ring.current_version)
+             .order_by('pk'))
+    count = 0
+    last_pk = 0
+    while True:
+        rows = list(stale.filter(pk__gt=last_pk).values_list('pk', 'wrapped_data_key', 'master_key_version')[:batch_size])
+        if not rows:
+            return count
+        batch = []
+        for pk, wrapped_key, version in rows:
+            wrapped_key, version = ring.wrap(ring.unwrap(wrapped_key, version))
+            batch.append(model(pk=pk, wrapped_data_key=wrapped_key, master_key_version=version))
+        model.objects.bulk_update(batch, ['wrapped_data_key', 'master_key_version'])
+        count += len(batch)
+        last_pk = rows[-1][0]
+
+
+def wrap_legacy_keys(ring):
+    """
+    Gives records from before envelope encryption, whose data key is master key version 0 itself,
+    that key wrapped under the current master key, so they stop depending on the version 0 file.
+
+    Returns:
+        int: Rows updated.
+    """
+    wrapped_key, version = ring.wrap(legacy_master_key())
+    fields = {'wrapped_data_key': wrapped_key, 'master_key_version': version}
+    # Chunked files take their key from the chunk store, not from a key of their own
+    count = (EncryptedFile.objects
+             .filter(wrapped_data_key__isnull=True)
+             .exclude(storage_mode=STORAGE_CHUNKED)
+             .update(**fields))
+    return count + UploadSession.objects.filter(wrapped_data_key__isnull=True).update(**fields)
+
+
+def referenced_versions():
+    versions = set()
+    for model in KEYED_MODELS:
+        versions.update(model.objects.filter(master_key_version__isnull=False)
+                        .values_list('master_key_version', flat=True).distinct())
+    return versions
+
+
+class Command(BaseCommand):
+    help = 'Add a new master key and rewrap every data key with it. Encrypted files are not rewritten.'
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            '--rewrap-only',
+            action='store_true',
+            help='Rewrap with the newest existing master key instead of adding a new one, '
+                 'e.g. to finish an interrupted rotation.'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows rewrapped per query.')
+        parser.add_argument(
+            '--retire-old',
+            action='store_true',
+            help='Delete master key files no data key is wrapped with any more, except the one this run '
+                 'superseded: processes may still wrap with it until they reload, so it is only retired by '
+                 'a later run, after restarting the web and Celery workers. '
+                 'Version 0 is kept, as it also protects the login pass file.'
+        )
+
+    def handle(self, *args, **kwargs):
+        started = time.monotonic()
+        previous_version = max(read_master_keys() or {LEGACY_KEY_VERSION: None})
+        if kwargs['rewrap_only']:
+            ring = reload_key_ring()
+        else:
+            add_master_key()
+            ring = reload_key_ring()
+            self.stdout.write(f"Added master key version {ring.current_version}.")
+
+        legacy = wrap_legacy_keys(ring)
+        rewrapped = {model.__name__: rewrap_model(model, ring, kwargs['batch_size']) for model in KEYED_MODELS}
+        chunk_store_key.cache_clear()
+
+        self.stdout.write(
+            f"Rewrapped {', '.join(f'{count} {name}' for name, count in rewrapped.items())} "
+            f"and wrapped {legacy} legacy keys under master key version {ring.current_version} "
+            f"in {time.monotonic() - started:.2f}s."
+        )
+        self.stdout.write("Running processes wrap new data keys with it once they notice the new key file.")
+
+        if kwargs['retire_old']:
+            in_use = referenced_versions()
+            # Data keys wrapped by processes that haven't reloaded yet, or by uploads still in
+            # flight, may still land under the version just superseded; the next run rewraps them
+            for version in sorted(ring.keys):
+                if version == LEGACY_KEY_VERSION or version >= previous_version or version in in_use:
+                    continue
+                os.remove(master_key_path(version))
+                self.stdout.write(f"Deleted master key version {version}.")
+            reload_key_ring()
+        if previous_version not in (LEGACY_KEY_VERSION, ring.current_version):
+            self.stdout.write(
+                f"Restart the web and Celery workers, then run with --rewrap-only --retire-old to "
+                f"retire master key version {previous_version}.")
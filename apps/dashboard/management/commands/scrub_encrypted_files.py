@@ -0,0 +1,41 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from apps.dashboard.scrub import scrub_files
+
+
+class Command(BaseCommand):
+    help = 'Verify the GCM tags of stored encrypted files and record the result.'
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--start-id', type=int, help='First file ID to verify (inclusive).')
+        parser.add_argument('--end-id', type=int, help='Last file ID to verify (inclusive).')
+        parser.add_argument(
+            '--rate',
+            type=int,
+            default=settings.SCRUB_BYTES_PER_SECOND,
+            help='Read budget in bytes per second, 0 for unthrottled.'
+        )
+        parser.add_argument('--limit', type=int, help='Verify at most this many files.')
+        parser.add_argument('--max-seconds', type=int, help='Stop starting new files after this many seconds.')
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Verify files even if they were verified recently.'
+        )
+
+    def handle(self, *args, **kwargs):
+        summary = scrub_files(
+            start_id=kwargs['start_id'],
+            end_id=kwargs['end_id'],
+            bytes_per_second=kwargs['rate'],
+            reverify_after=None if kwargs['all'] else timedelta(days=settings.SCRUB_REVERIFY_DAYS),
+            max_seconds=kwargs['max_seconds'],
+            limit=kwargs['limit'],
+            log=self.stderr.write,
+        )
+        self.stdout.write(
+            f"Verified {summary['OK']} OK, {summary['CORRUPT']} corrupt, {summary['MISSING']} missing "
+            f"({summary['bytes']} bytes in {summary['seconds']}s)."
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0007_directory_mark_deleted_directory_mark_deleted_date_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='format_version',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'v1 (single stream)'), (2, 'v2 (segmented)')], default=1, help_text='Container format of the encrypted file on disk'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0008_encryptedfile_format_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='kdf',
+            field=models.CharField(choices=[('pbkdf2', 'PBKDF2-SHA256'), ('hkdf', 'HKDF-SHA256')], default='pbkdf2', help_text='Key derivation function used to derive the file key', max_length=16),
+        ),
+    ]
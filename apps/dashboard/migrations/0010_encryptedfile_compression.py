@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0009_encryptedfile_kdf'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='compressed_size',
+            field=models.BigIntegerField(blank=True, help_text='Size of the file after compression, before encryption', null=True),
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='compression',
+            field=models.CharField(choices=[('none', 'None'), ('zlib', 'zlib'), ('lzma', 'lzma')], default='none', help_text='Codec the file was compressed with before encryption', max_length=16),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0010_encryptedfile_compression'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Chunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(help_text='Keyed hash of the chunk plaintext', max_length=64, unique=True)),
+                ('size', models.IntegerField(help_text='Size of the chunk plaintext in bytes')),
+                ('stored_size', models.IntegerField(default=0, help_text='Size of the encrypted chunk on disk in bytes')),
+                ('ref_count', models.PositiveIntegerField(default=0, help_text='Number of file references to this chunk')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='storage_mode',
+            field=models.CharField(choices=[('blob', 'Single blob'), ('chunked', 'Deduplicated chunks')], default='blob', help_text='Whether the file is one encrypted blob or a manifest of shared chunks', max_length=16),
+        ),
+        migrations.CreateModel(
+            name='FileChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField(help_text='Position of the chunk within the file')),
+                ('offset', models.BigIntegerField(help_text='Offset of the chunk within the file plaintext')),
+                ('chunk', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='file_refs', to='dashboard.chunk')),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunk_refs', to='dashboard.encryptedfile')),
+            ],
+            options={
+                'ordering': ['index'],
+                'constraints': [models.UniqueConstraint(fields=('file', 'index'), name='unique_file_chunk_index')],
+            },
+        ),
+    ]
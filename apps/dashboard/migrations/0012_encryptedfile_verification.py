@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0011_chunk_store'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='last_verified_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When the integrity scrubber last checked the stored file', null=True),
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='verification_status',
+            field=models.CharField(choices=[('UNVERIFIED', 'Unverified'), ('OK', 'OK'), ('CORRUPT', 'Corrupt'), ('MISSING', 'Missing')], default='UNVERIFIED', help_text='Result of the last integrity check', max_length=16),
+        ),
+    ]
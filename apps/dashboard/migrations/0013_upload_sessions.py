@@ -0,0 +1,43 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:26
+
+import django.db.models.deletion
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0012_encryptedfile_verification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('original_filename', models.CharField(max_length=255)),
+                ('total_size', models.BigIntegerField(help_text='Size of the file being uploaded in bytes')),
+                ('chunk_size', models.IntegerField(help_text='Plaintext bytes per uploaded chunk, a multiple of the segment size')),
+                ('encrypted_file', models.CharField(help_text='Path of the container being written, under MEDIA_ROOT', max_length=255)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='When the last chunk was received')),
+                ('directory', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='dashboard.directory')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField(help_text='Position of the chunk within the upload')),
+                ('size', models.IntegerField(help_text='Size of the chunk plaintext in bytes')),
+                ('received_on', models.DateTimeField(auto_now_add=True)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='dashboard.uploadsession')),
+            ],
+            options={
+                'ordering': ['index'],
+                'constraints': [models.UniqueConstraint(fields=('session', 'index'), name='unique_upload_chunk_index')],
+            },
+        ),
+    ]
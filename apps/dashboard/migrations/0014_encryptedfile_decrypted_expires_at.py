@@ -0,0 +1,26 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:30
+
+from django.db import migrations, models
+from django.utils.timezone import now
+
+
+def expire_existing_decrypted_files(apps, schema_editor):
+    # Files decrypted before expiry existed are removed by the first sweep
+    EncryptedFile = apps.get_model('dashboard', 'EncryptedFile')
+    EncryptedFile.objects.filter(decrypted_temp_path__isnull=False).update(decrypted_expires_at=now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0013_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='decrypted_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When the decrypted temporary file is removed', null=True),
+        ),
+        migrations.RunPython(expire_existing_decrypted_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0014_encryptedfile_decrypted_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='decryption_mb_per_s',
+            field=models.FloatField(blank=True, help_text='Average throughput of the last decryption task', null=True),
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='encryption_mb_per_s',
+            field=models.FloatField(blank=True, help_text='Average throughput of the encryption task', null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:41
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def fill_extensions(apps, schema_editor):
+    # Same rule as models.file_extension, which migrations can't import
+    EncryptedFile = apps.get_model('dashboard', 'EncryptedFile')
+    batch = []
+    for file in EncryptedFile.objects.only('id', 'original_filename').iterator(chunk_size=BATCH_SIZE):
+        extension = file.original_filename.rsplit('.', 1)[-1].lower() if '.' in file.original_filename else ''
+        file.extension = extension if 0 < len(extension) <= 16 else 'unknown'
+        batch.append(file)
+        if len(batch) >= BATCH_SIZE:
+            EncryptedFile.objects.bulk_update(batch, ['extension'])
+            batch = []
+    EncryptedFile.objects.bulk_update(batch, ['extension'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0015_encryptedfile_throughput'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='extension',
+            field=models.CharField(blank=True, default='', help_text='Lowercased extension of the original filename, kept for listings', max_length=16),
+        ),
+        migrations.RunPython(fill_extensions, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='encryptedfile',
+            index=models.Index(condition=models.Q(('mark_deleted', False)), fields=['directory', 'original_filename', 'id'], name='file_listing_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='encryptedfile',
+            index=models.Index(condition=models.Q(('mark_deleted', False)), fields=['directory', '-upload_date', '-id'], name='file_listing_date_idx'),
+        ),
+    ]
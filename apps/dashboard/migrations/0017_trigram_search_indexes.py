@@ -0,0 +1,40 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:42
+
+from django.db import migrations
+
+# Django matches icontains on Postgres as UPPER(column::text) LIKE UPPER(pattern), so the trigram
+# indexes are built on that expression to serve both the vault search and the admin's search box.
+# Only live rows are indexed, as only they are ever searched.
+TRIGRAM_INDEXES = (
+    ('dashboard_file_name_trgm_idx', 'dashboard_encryptedfile', 'original_filename'),
+    ('dashboard_directory_name_trgm_idx', 'dashboard_directory', 'name'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # Other databases, such as SQLite in tests, search without an index
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {name} ON {table} '
+            f'USING gin (UPPER({column}::text) gin_trgm_ops) WHERE NOT mark_deleted')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, _, _ in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0016_encryptedfile_extension_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashboard', '0017_trigram_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChunkStoreKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('wrapped_data_key', models.BinaryField(blank=True, help_text='Data key, encrypted with the master key', max_length=60, null=True)),
+                ('master_key_version', models.PositiveIntegerField(blank=True, help_text='Version of the master key that wraps the data key', null=True)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='master_key_version',
+            field=models.PositiveIntegerField(blank=True, help_text='Version of the master key that wraps the data key', null=True),
+        ),
+        migrations.AddField(
+            model_name='encryptedfile',
+            name='wrapped_data_key',
+            field=models.BinaryField(blank=True, help_text='Data key, encrypted with the master key', max_length=60, null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='master_key_version',
+            field=models.PositiveIntegerField(blank=True, help_text='Version of the master key that wraps the data key', null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='wrapped_data_key',
+            field=models.BinaryField(blank=True, help_text='Data key, encrypted with the master key', max_length=60, null=True),
+        ),
+    ]
@@ -1,9 +1,72 @@
 import os
+import base64
+import binascii
 import json
-from django.db import models
+import uuid
+from datetime import datetime
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.core import serializers
 from django.utils.timezone import now
 
+from .chunkstore import STORAGE_BLOB, STORAGE_CHOICES, STORAGE_CHUNKED, iter_chunked_file, release_file_chunks
+from .compression import COMPRESSION_CHOICES, COMPRESSION_NONE
+from .crypto import (FORMAT_CHOICES, FORMAT_V1, FORMAT_V2, KDF_CHOICES, KDF_PBKDF2, iter_decrypted_file,
+                     iter_decrypted_preview, plaintext_size)
+from .keyring import WRAPPED_KEY_LENGTH, chunk_store_key, generate_data_key, legacy_master_key, unwrap_data_key
+from .scrub import VERIFY_CHOICES, VERIFY_UNVERIFIED
+
+EXTENSION_MAX_LENGTH = 16
+LISTING_FIELDS = ('id', 'original_filename', 'extension', 'file_size', 'status', 'upload_date')
+
+# Directory trees are walked by the database in one query. UNION rather than UNION ALL drops rows
+# already visited, so a cycle in corrupted data ends the recursion instead of looping forever.
+DIRECTORY_SUBTREE_SQL = """
+    WITH RECURSIVE subtree(id) AS (
+        SELECT id FROM {table} WHERE {start}{live}
+        UNION
+        SELECT child.id FROM {table} child JOIN subtree ON child.parent_id = subtree.id{live_child}
+    )
+    SELECT id FROM subtree
+"""
+DIRECTORY_ANCESTORS_SQL = """
+    WITH RECURSIVE ancestors(id, parent_id) AS (
+        SELECT id, parent_id FROM {table} WHERE id IN ({ids})
+        UNION
+        SELECT parent.id, parent.parent_id FROM {table} parent JOIN ancestors ON parent.id = ancestors.parent_id
+    )
+    SELECT id FROM ancestors
+"""
+
+
+class WrappedDataKey(models.Model):
+    """
+    A record whose content is encrypted under its own data key, stored wrapped by a master key
+    (see keyring). Records without one predate envelope encryption and use master key version 0.
+    """
+    wrapped_data_key = models.BinaryField(max_length=WRAPPED_KEY_LENGTH, blank=True, null=True,
+                                          help_text="Data key, encrypted with the master key")
+    master_key_version = models.PositiveIntegerField(blank=True, null=True,
+                                                     help_text="Version of the master key that wraps the data key")
+
+    class Meta:
+        abstract = True
+
+    def new_data_key(self) -> bytes:
+        """
+        Gives the record a new random data key and returns it unwrapped. The record still has to be saved.
+        """
+        data_key, self.wrapped_data_key, self.master_key_version = generate_data_key()
+        return data_key
+
+    def data_key(self) -> bytes:
+        if self.wrapped_data_key is None:
+            return legacy_master_key()
+        return unwrap_data_key(self.wrapped_data_key, self.master_key_version)
+
 
 class Directory(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -28,29 +91,52 @@ class Directory(models.Model):
             'subdirectories': subdirs
         }
 
+    def subtree_ids(self, include_self=False, include_deleted=False):
+        """
+        Subquery of the IDs of every directory below this one (and this one with `include_self`),
+        walked by the database with a recursive CTE, for use as `pk__in=` or `directory_id__in=`.
+        Deleted directories, and so everything below them, are skipped unless `include_deleted`.
+        """
+        live = '' if include_deleted else ' AND mark_deleted = %s'
+        live_child = '' if include_deleted else ' AND child.mark_deleted = %s'
+        start = 'id = %s' if include_self else 'parent_id = %s'
+        sql = DIRECTORY_SUBTREE_SQL.format(table=self._meta.db_table, start=start, live=live, live_child=live_child)
+        params = (self.pk,) if include_deleted else (self.pk, False, False)
+        return RawSQL(sql, params)
+
     def get_descendants(self):
         """
         Returns a list of all subdirectories in this directory and its subdirectories.
         """
-        descendants = []
-        subdirs = self.__class__.objects.filter(parent=self, mark_deleted=False)
-        for subdir in subdirs:
-            descendants.append(subdir)
-            descendants.extend(subdir.get_descendants())
-        return descendants
+        return list(self.__class__.objects.filter(pk__in=self.subtree_ids()))
+
+    def get_ancestors(self) -> list:
+        """
+        Returns this directory and its parents, from the top level down, read with one query.
+        """
+        sql = DIRECTORY_ANCESTORS_SQL.format(table=self._meta.db_table, ids='%s')
+        by_id = {d.pk: d for d in self.__class__.objects.filter(pk__in=RawSQL(sql, (self.pk,)))}
+        ancestors = []
+        current = by_id.get(self.pk)
+        while current is not None and len(ancestors) < len(by_id):
+            ancestors.append(current)
+            current = by_id.get(current.parent_id)
+        return ancestors[::-1]
 
     def get_breadcrumbs(self) -> list[dict]:
         """
         Returns a list of directories from the root to this directory.
         """
-        breadcrumbs = []
-        current = self
-        while current:
-            breadcrumbs.append({'name': current.name, 'id': current.pk})
-            current = current.parent
+        breadcrumbs = [{'name': directory.name, 'id': directory.pk} for directory in self.get_ancestors()]
         # Add '/' for the root directory
-        breadcrumbs.append({'name': 'Home', 'id': 0})
-        return breadcrumbs[::-1]
+        return [{'name': 'Home', 'id': 0}] + breadcrumbs
+
+    def get_subtree_paths(self) -> dict:
+        """
+        Returns {directory_id: path} for this directory and all its live subdirectories, paths
+        starting with this directory's name. See get_subtree_paths() below.
+        """
+        return get_subtree_paths(self)
 
     def move_to(self, new_parent):
         if self.parent == new_parent:
@@ -58,7 +144,8 @@ class Directory(models.Model):
         if new_parent is not None and new_parent == self:
             raise ValueError("Cannot move a directory to itself")
         # Check if the new parent is a subdirectory of the current directory
-        if new_parent is not None and new_parent in self.get_descendants():
+        if new_parent is not None and self.__class__.objects.filter(
+                pk=new_parent.pk, id__in=self.subtree_ids(include_deleted=True)).exists():
             raise ValueError("Cannot move a directory into one of its own subdirectories")
         # Update the parent directory
         self.parent = new_parent
@@ -82,32 +169,27 @@ class Directory(models.Model):
     def mark_for_deletion(self):
         self.mark_deleted = True
         self.mark_deleted_date = now()
-        # Also mark all contained files and subdirectories for deletion
-        files = EncryptedFile.objects.filter(directory=self)
-        for file in files:
-            file.mark_for_deletion()
-        subdirs = self.__class__.objects.filter(parent=self)
-        for subdir in subdirs:
-            subdir.mark_for_deletion()
-        self.save()
+        # Also mark all contained files and subdirectories for deletion, with one UPDATE each.
+        # Rows deleted earlier keep their date.
+        subtree = self.subtree_ids(include_self=True, include_deleted=True)
+        with transaction.atomic():
+            self.__class__.objects.filter(id__in=subtree, mark_deleted=False).exclude(pk=self.pk).update(
+                mark_deleted=True, mark_deleted_date=self.mark_deleted_date)
+            EncryptedFile.objects.filter(directory_id__in=subtree, mark_deleted=False).update(
+                mark_deleted=True, mark_deleted_date=self.mark_deleted_date)
+            self.save(update_fields=['mark_deleted', 'mark_deleted_date'])
 
-    def delete(self, *args, **kwargs):
-        """
-        Permanently delete the directory and all its content from database and file system.
-        """
-        # Delete all files in this directory before deleting the directory itself
-        files = EncryptedFile.objects.filter(directory=self)
-        if files.exists():
-            # Delete from FS
-            for file in files:
-                file.delete()
-        files.delete()
-        # Now delete the directory
-        return super().delete(*args, **kwargs)
+
+def file_extension(filename: str) -> str:
+    """Lowercased extension of a filename, used to pick its icon; 'unknown' if it has none."""
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    return extension if 0 < len(extension) <= EXTENSION_MAX_LENGTH else 'unknown'
 
 
-class EncryptedFile(models.Model):
+class EncryptedFile(WrappedDataKey):
     original_filename = models.CharField(max_length=255)
+    extension = models.CharField(max_length=EXTENSION_MAX_LENGTH, blank=True, default='',
+                                 help_text="Lowercased extension of the original filename, kept for listings")
     encrypted_file = models.FileField(upload_to='encrypted_files/', blank=True, null=True)
     upload_date = models.DateTimeField(auto_now_add=True)
     file_size = models.BigIntegerField(help_text="Size of the encrypted file in bytes")
@@ -118,20 +200,53 @@ class EncryptedFile(models.Model):
     # Store salt and nonce for decryption (they are not secret)
     salt = models.BinaryField(max_length=16, blank=True, null=True)  # For PBKDF2
     nonce = models.BinaryField(max_length=16, blank=True, null=True)  # For AES-GCM (PyCryptodome's default)
+    format_version = models.PositiveSmallIntegerField(
+        choices=FORMAT_CHOICES, default=FORMAT_V1, help_text="Container format of the encrypted file on disk")
+    kdf = models.CharField(max_length=16, choices=KDF_CHOICES, default=KDF_PBKDF2,
+                           help_text="Key derivation function used to derive the file key")
+    compression = models.CharField(max_length=16, choices=COMPRESSION_CHOICES, default=COMPRESSION_NONE,
+                                   help_text="Codec the file was compressed with before encryption")
+    compressed_size = models.BigIntegerField(
+        blank=True, null=True, help_text="Size of the file after compression, before encryption")
+    storage_mode = models.CharField(max_length=16, choices=STORAGE_CHOICES, default=STORAGE_BLOB,
+                                    help_text="Whether the file is one encrypted blob or a manifest of shared chunks")
+    last_verified_at = models.DateTimeField(
+        blank=True, null=True, db_index=True, help_text="When the integrity scrubber last checked the stored file")
+    verification_status = models.CharField(max_length=16, choices=VERIFY_CHOICES, default=VERIFY_UNVERIFIED,
+                                           help_text="Result of the last integrity check")
+    encryption_mb_per_s = models.FloatField(blank=True, null=True, help_text="Average throughput of the encryption task")
+    decryption_mb_per_s = models.FloatField(
+        blank=True, null=True, help_text="Average throughput of the last decryption task")
     celery_task_id = models.CharField(max_length=255, blank=True, null=True,
                                       help_text="Celery task ID for encryption/decryption")
     status = models.CharField(max_length=50, default='PENDING',
                               choices=[('PENDING', 'Pending'), ('PROCESSING', 'Processing'),
                                        ('COMPLETED', 'Completed'), ('FAILED', 'Failed'), ('DECRYPTING', 'Decrypting'), ('DECRYPTED', 'Decrypted')])
     decrypted_temp_path = models.CharField(max_length=255, blank=True, null=True)
+    decrypted_expires_at = models.DateTimeField(
+        blank=True, null=True, db_index=True, help_text="When the decrypted temporary file is removed")
     mark_deleted = models.BooleanField(
         default=False, help_text="Mark this file for deletion without removing it immediately")
     mark_deleted_date = models.DateTimeField(
         blank=True, null=True, help_text="Date when the file was marked for deletion")
 
+    class Meta:
+        # Directory listings read one page at a time in name or date order, with the ID breaking ties
+        indexes = [
+            models.Index(fields=['directory', 'original_filename', 'id'], condition=models.Q(mark_deleted=False),
+                         name='file_listing_name_idx'),
+            models.Index(fields=['directory', '-upload_date', '-id'], condition=models.Q(mark_deleted=False),
+                         name='file_listing_date_idx'),
+        ]
+
     def __str__(self):
         return self.original_filename
 
+    def save(self, *args, **kwargs):
+        if not self.extension and self.original_filename:
+            self.extension = file_extension(self.original_filename)
+        super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse('dashboard:download_encrypted', args=[str(self.pk)])
@@ -145,15 +260,59 @@ class EncryptedFile(models.Model):
         self.mark_deleted_date = now()
         self.save()
 
-    def delete(self, *args, **kwargs):
-        # Delete the actual file when the model instance is deleted
-        if self.encrypted_file:
-            if os.path.isfile(self.encrypted_file.path):
-                os.remove(self.encrypted_file.path)
-        # Also delete the temporary decrypted file if it exists and model is deleted
-        if self.decrypted_temp_path and os.path.exists(self.decrypted_temp_path):
-            os.remove(self.decrypted_temp_path)
-        return super().delete(*args, **kwargs)
+    @property
+    def supports_ranges(self):
+        """
+        Whether any byte range can be decrypted and verified without reading the whole file.
+        """
+        return self.storage_mode == STORAGE_CHUNKED or self.format_version == FORMAT_V2
+
+    def has_stored_content(self):
+        if self.storage_mode == STORAGE_CHUNKED:
+            return True
+        return bool(self.encrypted_file) and os.path.isfile(self.encrypted_file.path)
+
+    def has_complete_content(self):
+        """
+        Whether the stored ciphertext is all there: a blob must have the size recorded for it.
+        """
+        if self.storage_mode == STORAGE_CHUNKED:
+            return True
+        return self.has_stored_content() and os.path.getsize(self.encrypted_file.path) == self.file_size
+
+    def get_plaintext_size(self):
+        """
+        Size of the decrypted file. Compressed files can't be sized from the container.
+        """
+        if self.storage_mode == STORAGE_CHUNKED or self.compression != COMPRESSION_NONE:
+            return self.original_file_size
+        return plaintext_size(self.encrypted_file.path, self.format_version)
+
+    def data_key(self) -> bytes:
+        # Chunks are shared between files, so they are all encrypted under the chunk store's key
+        if self.storage_mode == STORAGE_CHUNKED:
+            return chunk_store_key()
+        return super().data_key()
+
+    def iter_plaintext(self, start=0, end=None):
+        """
+        Yields the decrypted content in [start, end), whichever way the file is stored.
+        """
+        if self.storage_mode == STORAGE_CHUNKED:
+            return iter_chunked_file(self, self.data_key(), start, end)
+        return iter_decrypted_file(
+            self.encrypted_file.path, self.data_key(), self.salt, self.nonce, self.format_version,
+            start=start, end=end, kdf=self.kdf, compression=self.compression)
+
+    def iter_preview(self, start, length, max_bytes):
+        """
+        Yields at most `max_bytes` of decrypted content starting at `start`, in bounded memory.
+        """
+        if self.storage_mode == STORAGE_CHUNKED:
+            return iter_chunked_file(self, self.data_key(), start, start + max(min(length, max_bytes), 0))
+        return iter_decrypted_preview(
+            self.encrypted_file.path, self.data_key(), self.salt, self.nonce, self.format_version, self.kdf,
+            start=start, length=length, max_bytes=max_bytes, compression=self.compression)
 
     def serialize(self, format='json'):
         """
@@ -161,22 +320,200 @@ class EncryptedFile(models.Model):
         Default is JSON.
         """
         data = serializers.serialize(format, [self], use_natural_primary_keys=True, fields=(
-            'original_filename', 'upload_date', 'file_size', 'original_file_size', 'is_encrypted', 'directory', 'celery_task_id', 'status'))
+            'original_filename', 'upload_date', 'file_size', 'original_file_size', 'is_encrypted', 'directory', 'celery_task_id', 'status', 'format_version', 'compression',
+            'encryption_mb_per_s', 'decryption_mb_per_s'))
         if format == 'json':
             return json.loads(data)[0]
         return data
 
 
-def get_home_contents(directory: str = '', sort: str = 'date') -> dict:
+@receiver(pre_delete, sender=EncryptedFile)
+def release_file_storage(sender, instance, **kwargs):
+    """
+    Frees what a file holds outside its row. A signal rather than EncryptedFile.delete(), so bulk
+    deletes in the admin, queryset deletes and directory cascades release it too.
+    """
+    # Drop chunk references, removing chunks no other file uses
+    if instance.storage_mode == STORAGE_CHUNKED:
+        release_file_chunks(instance)
+    paths = [instance.decrypted_temp_path]
+    if instance.encrypted_file:
+        paths.append(instance.encrypted_file.path)
+
+    def remove_files():
+        for path in paths:
+            if path and os.path.isfile(path):
+                os.remove(path)
+    # The ciphertext must survive if the deletion is rolled back
+    transaction.on_commit(remove_files)
+
+
+class Chunk(models.Model):
+    digest = models.CharField(max_length=64, unique=True, help_text="Keyed hash of the chunk plaintext")
+    size = models.IntegerField(help_text="Size of the chunk plaintext in bytes")
+    stored_size = models.IntegerField(default=0, help_text="Size of the encrypted chunk on disk in bytes")
+    ref_count = models.PositiveIntegerField(default=0, help_text="Number of file references to this chunk")
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest
+
+
+class ChunkStoreKey(WrappedDataKey):
+    """
+    The single data key all chunks of the chunk store are encrypted under.
+    """
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Chunk store key (master key v{self.master_key_version})"
+
+
+class FileChunk(models.Model):
+    file = models.ForeignKey(EncryptedFile, on_delete=models.CASCADE, related_name='chunk_refs')
+    chunk = models.ForeignKey(Chunk, on_delete=models.PROTECT, related_name='file_refs')
+    index = models.PositiveIntegerField(help_text="Position of the chunk within the file")
+    offset = models.BigIntegerField(help_text="Offset of the chunk within the file plaintext")
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(fields=['file', 'index'], name='unique_file_chunk_index'),
+        ]
+
+
+class UploadSession(WrappedDataKey):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    original_filename = models.CharField(max_length=255)
+    total_size = models.BigIntegerField(help_text="Size of the file being uploaded in bytes")
+    chunk_size = models.IntegerField(help_text="Plaintext bytes per uploaded chunk, a multiple of the segment size")
+    directory = models.ForeignKey(Directory, on_delete=models.CASCADE, related_name='upload_sessions',
+                                  blank=True, null=True)
+    encrypted_file = models.CharField(max_length=255, help_text="Path of the container being written, under MEDIA_ROOT")
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(default=now, db_index=True, help_text="When the last chunk was received")
+
+    def __str__(self):
+        return self.original_filename
+
+
+class UploadChunk(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='chunks')
+    index = models.PositiveIntegerField(help_text="Position of the chunk within the upload")
+    size = models.IntegerField(help_text="Size of the chunk plaintext in bytes")
+    received_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['index']
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'index'], name='unique_upload_chunk_index'),
+        ]
+
+
+def get_subtree_paths(directory: Directory | None = None) -> dict:
+    """Names every directory in a subtree by its path, reading the subtree with a single query.
+
+    Args:
+        directory: Root of the subtree, or None for Home.
+
+    Returns:
+        dict: {directory_id: path} of every live directory in the subtree, parents before children.
+            Paths are joined with '/' and start with the root's name; Home is None and not included.
+    """
+    directories = Directory.objects.filter(mark_deleted=False)
+    if directory is not None:
+        directories = directories.filter(pk__in=directory.subtree_ids())
+    children = {}
+    for pk, parent_id, name in directories.values_list('id', 'parent_id', 'name'):
+        children.setdefault(parent_id, []).append((pk, name))
+    if directory is None:
+        paths, pending = {}, [(None, '')]
+    else:
+        paths, pending = {directory.pk: directory.name}, [(directory.pk, directory.name + '/')]
+    while pending:
+        parent_id, prefix = pending.pop(0)
+        for pk, name in sorted(children.get(parent_id, []), key=lambda child: child[1]):
+            # Guard against a cycle in corrupted data
+            if pk not in paths:
+                paths[pk] = prefix + name
+                pending.append((pk, paths[pk] + '/'))
+    return paths
+
+
+LISTING_ORDER = {
+    'name': ('original_filename', 'id'),
+    'date': ('-upload_date', '-id'),
+}
+
+
+def encode_listing_cursor(file: EncryptedFile, sort: str) -> str:
+    """Opaque cursor pointing just after `file` in a listing sorted by `sort`."""
+    value = file.original_filename if sort == 'name' else file.upload_date.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, file.pk]).encode()).decode()
+
+
+def decode_listing_cursor(cursor: str, sort: str) -> models.Q:
+    """Filter selecting the files after `cursor`, raising ValueError if it is not a valid cursor."""
+    try:
+        value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        pk = int(pk)
+        if sort == 'name':
+            return models.Q(original_filename__gt=value) | models.Q(original_filename=value, id__gt=pk)
+        upload_date = datetime.fromisoformat(value)
+        return models.Q(upload_date__lt=upload_date) | models.Q(upload_date=upload_date, id__lt=pk)
+    except (TypeError, ValueError, UnicodeError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def get_directory_paths(directory_ids) -> dict:
+    """Resolves the full path of several directories at once, reading them and all their
+    parents with a single query.
+
+    Returns:
+        dict: {directory_id: path}, paths joined with '/' from the top level down.
+    """
+    directory_ids = list(set(directory_ids))
+    if not directory_ids:
+        return {}
+    sql = DIRECTORY_ANCESTORS_SQL.format(table=Directory._meta.db_table, ids=', '.join(['%s'] * len(directory_ids)))
+    rows = {pk: (parent_id, name) for pk, parent_id, name in Directory.objects.filter(
+        pk__in=RawSQL(sql, directory_ids)).values_list('id', 'parent_id', 'name')}
+    paths = {}
+    for directory_id in directory_ids:
+        names, current = [], directory_id
+        while current in rows and len(names) < len(rows):
+            parent_id, name = rows[current]
+            names.append(name)
+            current = parent_id
+        paths[directory_id] = '/'.join(reversed(names))
+    return paths
+
+
+def get_home_contents(directory: str = '', sort: str = 'date', cursor: str | None = None,
+                      page_size: int | None = None) -> dict:
     """Get contents of the home directory, which includes all files and subdirectories.
 
+    Files are returned one page at a time with keyset pagination: each page continues after
+    the last file of the previous one, so a page is read straight off the listing indexes
+    however many files the directory holds. Subdirectories come with the first page only.
+
+    Args:
+        directory: ID of the directory, '' or '0' for Home.
+        sort: 'name' or 'date'.
+        cursor: `next_cursor` of the previous page, None for the first page.
+        page_size: Files per page, defaults to LISTING_PAGE_SIZE.
+
     Returns:
         dict: A dictionary containing the subdirectories and files in the home directory.
     """
+    if sort not in LISTING_ORDER:
+        raise ValueError(f"Unknown sort order: {sort}")
+    page_size = page_size or settings.LISTING_PAGE_SIZE
     if directory == '' or directory == '0':
         subdirs = Directory.objects.filter(parent=None, mark_deleted=False)
         files = EncryptedFile.objects.filter(directory=None, mark_deleted=False)
         parent_directory = None
+        breadcrumbs = [{'name': 'Home', 'id': 0}]
     else:
         directory_id_parsed = int(directory)
         directory_obj = Directory.objects.filter(pk=directory_id_parsed, mark_deleted=False).first()
@@ -185,24 +522,25 @@ def get_home_contents(directory: str = '', sort: str = 'date') -> dict:
         contents = directory_obj.get_contents()
         subdirs = contents['subdirectories']
         files = contents['files']
-        parent_directory = directory_obj.parent.pk if directory_obj.parent else '0'
+        parent_directory = directory_obj.parent_id if directory_obj.parent_id else '0'
+        breadcrumbs = directory_obj.get_breadcrumbs()
     # Sort subdirectories and files based on the provided sort parameter
     if sort == 'name':
         subdirs = subdirs.order_by('name')
-        files = files.order_by('original_filename')
     elif sort == 'date':
         subdirs = subdirs.order_by('-created_on')
-        files = files.order_by('-upload_date')
-    # transformations on files
-    files = list(files)
-    result_files = []
-    for file in files:
-        file_row = {'extension': file.original_filename.split(
-            '.')[-1].lower() if '.' in file.original_filename else 'unknown', **file.__dict__}
-        result_files.append(file_row)
+    files = files.only(*LISTING_FIELDS).order_by(*LISTING_ORDER[sort])
+    if cursor:
+        files = files.filter(decode_listing_cursor(cursor, sort))
+    # One extra row tells whether there is a next page
+    files = list(files[:page_size + 1])
+    next_cursor = encode_listing_cursor(files[page_size - 1], sort) if len(files) > page_size else None
     return {
-        'subdirectories': subdirs,
-        'files': result_files,
+        'subdirectories': subdirs if not cursor else [],
+        'files': files[:page_size],
+        'next_cursor': next_cursor,
+        'sort': sort,
+        'breadcrumbs': breadcrumbs,
         'current_directory': directory if directory and len(directory) > 0 and int(directory) > 0 else None,
         'parent_directory': parent_directory
     }
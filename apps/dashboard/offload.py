@@ -0,0 +1,47 @@
+import os
+from urllib.parse import quote
+from django.conf import settings
+from django.http import HttpResponse
+
+# --- Download offload modes
+OFFLOAD_NONE = 'none'  # Django streams the file itself
+OFFLOAD_X_ACCEL = 'x-accel-redirect'  # nginx, through an internal location aliasing MEDIA_ROOT
+OFFLOAD_X_SENDFILE = 'x-sendfile'  # Apache mod_xsendfile, lighttpd, or uWSGI with the routing rules in uwsgi.ini
+OFFLOAD_MODES = (OFFLOAD_NONE, OFFLOAD_X_ACCEL, OFFLOAD_X_SENDFILE)
+
+
+def _media_relative_path(path):
+    """
+    Path of `path` relative to MEDIA_ROOT, or None if it lies outside of it.
+    Only files under MEDIA_ROOT are ever handed to the front server.
+    """
+    root = os.path.realpath(settings.MEDIA_ROOT)
+    real_path = os.path.realpath(path)
+    if os.path.commonpath([root, real_path]) != root:
+        return None
+    return os.path.relpath(real_path, root)
+
+
+def offloaded_file_response(path, filename, content_type='application/octet-stream'):
+    """
+    Builds a response that only carries headers and lets the front server send the file
+    with sendfile(), so no Django worker is tied up for the transfer.
+
+    Returns:
+        HttpResponse, or None when offloading is disabled and the caller should stream the file itself.
+    """
+    mode = settings.DOWNLOAD_OFFLOAD
+    if mode == OFFLOAD_NONE:
+        return None
+    relative_path = _media_relative_path(path)
+    if relative_path is None or not os.path.isfile(path):
+        return None
+    response = HttpResponse(content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    if mode == OFFLOAD_X_ACCEL:
+        response['X-Accel-Redirect'] = settings.DOWNLOAD_OFFLOAD_PREFIX.rstrip('/') + '/' + quote(relative_path)
+    elif mode == OFFLOAD_X_SENDFILE:
+        response['X-Sendfile'] = os.path.realpath(path)
+    else:
+        raise ValueError(f"Unknown download offload mode '{mode}'.")
+    return response
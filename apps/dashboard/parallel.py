@@ -0,0 +1,137 @@
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from Crypto.Random import get_random_bytes
+
+from .compression import COMPRESSION_NONE, DecompressingWriter
+from .crypto import (
+    SALT_LENGTH, SEGMENT_SIZE, TAG_LENGTH, V2_HEADER_LENGTH, V2_NONCE_PREFIX_LENGTH,
+    KDF_HKDF, KDF_PBKDF2, get_file_key, pack_v2_header, unpack_v2_header, v2_sizes, seal_segment, open_segment,
+)
+
+EXECUTOR_THREAD = 'thread'
+EXECUTOR_PROCESS = 'process'
+
+
+def _make_executor(kind, workers):
+    # Celery's prefork children are daemonic and may not start processes of their own,
+    # so fall back to threads there. PyCryptodome drops the GIL inside AES, so threads scale too.
+    if kind == EXECUTOR_PROCESS and not multiprocessing.current_process().daemon:
+        return ProcessPoolExecutor(max_workers=workers), EXECUTOR_PROCESS
+    return ThreadPoolExecutor(max_workers=workers), EXECUTOR_THREAD
+
+
+def _stats(processed_bytes, started, workers, executor):
+    seconds = max(time.perf_counter() - started, 1e-9)
+    return {
+        'bytes': processed_bytes,
+        'seconds': round(seconds, 3),
+        'mb_per_s': round(processed_bytes / seconds / (1024 * 1024), 2),
+        'workers': workers,
+        'executor': executor,
+    }
+
+
+def _run_ordered(executor, jobs, fn, outfile, workers):
+    """
+    Submits fn(*args) for every job, keeping at most 2 x workers segments in flight,
+    and writes the results to outfile in submission order.
+    """
+    in_flight = deque()
+    for args in jobs:
+        in_flight.append(executor.submit(fn, *args))
+        if len(in_flight) >= workers * 2:
+            outfile.write(in_flight.popleft().result())
+    while in_flight:
+        outfile.write(in_flight.popleft().result())
+
+
+def parallel_encrypt_file(input_file, output_path, password, workers=None, executor=EXECUTOR_THREAD,
+                          segment_size=SEGMENT_SIZE, kdf=KDF_HKDF):
+    """
+    Encrypts a file into the v2 format, sealing segments across a pool of workers.
+    The output is identical in layout to save_encrypted_file_to_disk.
+
+    Args:
+        input_file: File-like object to read the plaintext from.
+        output_path: Path where the encrypted file will be saved.
+        password: The password used for encryption.
+        workers: Pool size, defaults to the number of CPUs.
+        executor: 'thread' or 'process'.
+        kdf: Key derivation function, HKDF unless told otherwise.
+
+    Returns:
+        Tuple: (salt, nonce_prefix, file_size_on_disk, stats)
+    """
+    workers = workers or os.cpu_count() or 1
+    salt = get_random_bytes(SALT_LENGTH)
+    nonce_prefix = get_random_bytes(V2_NONCE_PREFIX_LENGTH)
+    header = pack_v2_header(salt, nonce_prefix, segment_size)
+    key = get_file_key(password, salt, kdf)
+    started = time.perf_counter()
+    plaintext_bytes = 0
+
+    def jobs():
+        nonlocal plaintext_bytes
+        # Read one segment ahead so the last one can be flagged as final
+        index, current = 0, input_file.read(segment_size)
+        while True:
+            following = input_file.read(segment_size) if len(current) == segment_size else b''
+            plaintext_bytes += len(current)
+            yield key, header, nonce_prefix, index, current, not following
+            if not following:
+                return
+            index, current = index + 1, following
+
+    pool, kind = _make_executor(executor, workers)
+    try:
+        with pool, open(output_path, 'wb') as outfile:
+            outfile.write(header)
+            _run_ordered(pool, jobs(), seal_segment, outfile, workers)
+        return salt, nonce_prefix, os.path.getsize(output_path), _stats(plaintext_bytes, started, workers, kind)
+    except Exception as e:
+        # Clean up partial file on error
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise e
+
+
+def parallel_decrypt_file(input_path, output_path, password, workers=None, executor=EXECUTOR_THREAD,
+                          kdf=KDF_PBKDF2, compression=COMPRESSION_NONE, progress=None):
+    """
+    Decrypts a v2 file, opening and verifying segments across a pool of workers.
+    Raises ValueError if any segment fails verification; the partial output is removed.
+    Compressed files are decompressed in order as the segments come back.
+    `progress` is called with the number of encrypted bytes handed to the pool for every segment.
+
+    Returns:
+        dict: Throughput stats of the run.
+    """
+    workers = workers or os.cpu_count() or 1
+    started = time.perf_counter()
+    pool, kind = _make_executor(executor, workers)
+    try:
+        with pool, open(input_path, 'rb') as infile, open(output_path, 'wb') as outfile:
+            header = infile.read(V2_HEADER_LENGTH)
+            salt, nonce_prefix, segment_size = unpack_v2_header(header)
+            segment_count, size = v2_sizes(infile, segment_size)
+            key = get_file_key(password, salt, kdf)
+
+            def jobs():
+                for index in range(segment_count):
+                    sealed = infile.read(segment_size + TAG_LENGTH)
+                    if progress:
+                        progress(len(sealed))
+                    yield key, header, nonce_prefix, index, sealed, index == segment_count - 1
+
+            writer = DecompressingWriter(outfile, compression) if compression != COMPRESSION_NONE else outfile
+            _run_ordered(pool, jobs(), open_segment, writer, workers)
+            if writer is not outfile:
+                writer.close()
+        return _stats(size, started, workers, kind)
+    except Exception as e:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise e
@@ -0,0 +1,84 @@
+import time
+from django.conf import settings
+
+_MB = 1024 * 1024
+
+
+class ProgressReporter:
+    """
+    Collects byte counts from a crypto loop and hands `callback` a progress report at most
+    every TASK_PROGRESS_INTERVAL seconds, so a tight loop doesn't flood the result backend.
+    Instances are called with the number of bytes just processed.
+    """
+
+    def __init__(self, total, callback=None, interval=None):
+        self.total = total or 0
+        self.callback = callback
+        self.interval = settings.TASK_PROGRESS_INTERVAL if interval is None else interval
+        self.processed = 0
+        self.started = time.monotonic()
+        self._last_time = self.started
+        self._last_processed = 0
+
+    def __call__(self, count):
+        self.processed += count
+        now = time.monotonic()
+        if self.callback is not None and now - self._last_time >= self.interval:
+            self.callback(self.report(now))
+
+    def report(self, now=None):
+        """
+        Returns:
+            dict: Bytes processed out of the total, MB/s since the last report and overall, and the ETA in seconds.
+        """
+        now = time.monotonic() if now is None else now
+        elapsed = max(now - self.started, 1e-9)
+        average = self.processed / elapsed
+        current = (self.processed - self._last_processed) / max(now - self._last_time, 1e-9)
+        self._last_time, self._last_processed = now, self.processed
+        remaining = max(self.total - self.processed, 0)
+        return {
+            'bytes': self.processed,
+            'total': self.total,
+            'percent': round(min(self.processed / self.total, 1) * 100, 1) if self.total else None,
+            'mb_per_s': round(current / _MB, 2),
+            'avg_mb_per_s': round(average / _MB, 2),
+            'elapsed_seconds': round(elapsed, 1),
+            'eta_seconds': round(remaining / average, 1) if average and self.total else None,
+        }
+
+    def finish(self):
+        """
+        Final report of the run; the average rate is the throughput worth keeping.
+        """
+        self.total = self.processed
+        return self.report()
+
+
+class ProgressReader:
+    """
+    Wraps a file-like object and reports every byte read from it to `progress`.
+    """
+
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.progress(len(data))
+        return data
+
+    def readinto(self, view):
+        reader = getattr(self.fileobj, 'readinto', None)
+        if reader is not None:
+            count = reader(view) or 0
+        else:
+            data = self.fileobj.read(len(view))
+            count = len(data)
+            view[:count] = data
+        self.progress(count)
+        return count
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
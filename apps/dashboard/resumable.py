@@ -0,0 +1,234 @@
+import os
+import uuid
+from datetime import timedelta
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
+
+from .chunkstore import STORAGE_CHUNKED
+from .crypto import (
+    FORMAT_V2, KDF_HKDF, SALT_LENGTH, SEGMENT_SIZE, TAG_LENGTH, V2_HEADER_LENGTH, V2_NONCE_PREFIX_LENGTH,
+    encrypted_size, get_file_key, pack_v2_header, seal_segment_in_place, unpack_v2_header,
+)
+from .fileio import preallocate, readinto
+
+# Resumable uploads write a v2 container out of order: each segment is sealed on its own with a
+# nonce derived from its index, so a chunk can be encrypted and written at its final offset as soon
+# as it lands, in any order. The whole file size is known up front, so the final segment can be flagged.
+ENCRYPTED_FILES_DIR = 'encrypted_files'
+
+
+def accepts_resumable_uploads():
+    """
+    Whether uploads can be resumable. Their chunks are encrypted into a per-file container as they
+    land, so chunked storage, which deduplicates whole files, takes uploads through the form instead.
+    """
+    return settings.STORAGE_MODE != STORAGE_CHUNKED
+
+
+def upload_chunk_size():
+    """
+    Plaintext bytes per upload chunk, rounded down to whole v2 segments.
+    """
+    return max(settings.UPLOAD_CHUNK_SIZE // SEGMENT_SIZE, 1) * SEGMENT_SIZE
+
+
+def chunk_count(total_size, chunk_size):
+    return max(1, -(-total_size // chunk_size))
+
+
+def _blob_path(session):
+    return os.path.join(settings.MEDIA_ROOT, session.encrypted_file)
+
+
+def _lock_session(session):
+    """
+    Re-reads `session` with its row locked until the end of the transaction, so completing,
+    aborting and recording chunks of one upload can't interleave.
+
+    Raises:
+        UploadSession.DoesNotExist: If the upload was completed or aborted meanwhile.
+    """
+    return session.__class__.objects.select_for_update().get(pk=session.pk)
+
+
+def create_upload_session(original_filename, total_size, directory=None):
+    """
+    Starts a resumable upload. The container header is written right away and the rest of
+    the file is preallocated, so chunks can be written to their final place as they arrive.
+    """
+    from .models import UploadSession
+
+    salt = get_random_bytes(SALT_LENGTH)
+    nonce_prefix = get_random_bytes(V2_NONCE_PREFIX_LENGTH)
+    session = UploadSession(
+        original_filename=original_filename,
+        total_size=total_size,
+        chunk_size=upload_chunk_size(),
+        directory=directory,
+        encrypted_file=os.path.join(ENCRYPTED_FILES_DIR, f"{uuid.uuid4().hex}.enc"),
+    )
+    # The chunks are encrypted under a data key of the upload's own, which the file inherits
+    session.new_data_key()
+    path = _blob_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as outfile:
+        preallocate(outfile, encrypted_size(total_size))
+        outfile.write(pack_v2_header(salt, nonce_prefix))
+    session.save()
+    return session
+
+
+def write_chunk(session, index, stream, password):
+    """
+    Encrypts chunk `index` read from `stream` and writes it at its offset in the container.
+    Chunks that were already committed are not written again, so retries are harmless.
+
+    Raises:
+        ValueError: If the index is out of range or the stream does not hold exactly the chunk.
+        UploadSession.DoesNotExist: If the upload was completed or aborted while the chunk was written.
+
+    Returns:
+        bool: True if the chunk was written, False if it had been committed before.
+    """
+    from .models import UploadChunk
+
+    count = chunk_count(session.total_size, session.chunk_size)
+    if not 0 <= index < count:
+        raise ValueError(f"Chunk {index} out of range, the upload has {count} chunks.")
+    if session.chunks.filter(index=index).exists():
+        return False
+
+    start = index * session.chunk_size
+    length = min(session.chunk_size, session.total_size - start)
+    try:
+        blob = open(_blob_path(session), 'r+b')
+    except FileNotFoundError:
+        raise session.DoesNotExist("Upload was aborted.")
+    with blob:
+        header = blob.read(V2_HEADER_LENGTH)
+        salt, nonce_prefix, segment_size = unpack_v2_header(header)
+        key = get_file_key(password, salt, KDF_HKDF)
+        last_segment = chunk_count(session.total_size, segment_size) - 1
+        buffer = memoryview(bytearray(min(segment_size, length)))
+        first_segment = start // segment_size
+        # An empty file still has one (empty) final segment
+        for segment in range(first_segment, first_segment + chunk_count(length, segment_size)):
+            view = buffer[:min(segment_size, start + length - segment * segment_size)]
+            if readinto(stream, view) != len(view):
+                raise ValueError("Chunk is shorter than expected.")
+            tag = seal_segment_in_place(key, header, nonce_prefix, segment, view, final=segment == last_segment)
+            offset = V2_HEADER_LENGTH + segment * (segment_size + TAG_LENGTH)
+            os.pwrite(blob.fileno(), view, offset)
+            os.pwrite(blob.fileno(), tag, offset + len(view))
+        if stream.read(1):
+            raise ValueError("Chunk is longer than expected.")
+
+    # The chunk is encrypted without the lock, so chunks of one upload are still written in
+    # parallel; only recording it has to wait for a complete or abort of the same upload
+    with transaction.atomic():
+        session = _lock_session(session)
+        try:
+            with transaction.atomic():
+                UploadChunk.objects.create(session=session, index=index, size=length)
+        except IntegrityError:
+            # A retry of the same chunk finished first
+            return False
+        session.__class__.objects.filter(pk=session.pk).update(updated_on=now())
+    return True
+
+
+def upload_status(session):
+    """
+    Returns:
+        dict: Committed chunk indices and the offset up to which the file is complete.
+    """
+    received = sorted(session.chunks.values_list('index', flat=True))
+    contiguous = 0
+    while contiguous < len(received) and received[contiguous] == contiguous:
+        contiguous += 1
+    return {
+        'id': str(session.pk),
+        'size': session.total_size,
+        'chunk_size': session.chunk_size,
+        'chunk_count': chunk_count(session.total_size, session.chunk_size),
+        'received': received,
+        'offset': min(contiguous * session.chunk_size, session.total_size),
+    }
+
+
+def complete_upload(session):
+    """
+    Turns a fully received upload into an EncryptedFile, which still has to be finalised by
+    finalize_encrypted_upload_task.
+
+    Raises:
+        ValueError: If chunks are missing.
+        UploadSession.DoesNotExist: If another request completed or aborted the upload first.
+    """
+    from .models import EncryptedFile
+
+    with transaction.atomic():
+        # Two completes of one upload would otherwise both create a file for the same blob
+        session = _lock_session(session)
+        status = upload_status(session)
+        if len(status['received']) != status['chunk_count']:
+            raise ValueError(f"{status['chunk_count'] - len(status['received'])} chunks are still missing.")
+        path = _blob_path(session)
+        with open(path, 'r+b') as blob:
+            salt, nonce_prefix, _ = unpack_v2_header(blob.read(V2_HEADER_LENGTH))
+            # Drop whatever was preallocated beyond the container
+            blob.truncate(encrypted_size(session.total_size))
+        encrypted_file = EncryptedFile.objects.create(
+            original_filename=session.original_filename,
+            original_file_size=session.total_size,
+            status='PENDING',
+            directory=session.directory,
+            encrypted_file=session.encrypted_file,
+            file_size=os.path.getsize(path),
+            salt=salt,
+            nonce=nonce_prefix,
+            format_version=FORMAT_V2,
+            kdf=KDF_HKDF,
+            wrapped_data_key=session.wrapped_data_key,
+            master_key_version=session.master_key_version,
+        )
+        session.delete()
+    return encrypted_file
+
+
+def abort_upload(session):
+    """
+    Drops an upload session along with everything written for it.
+
+    Raises:
+        UploadSession.DoesNotExist: If the upload was completed or aborted meanwhile.
+    """
+    with transaction.atomic():
+        session = _lock_session(session)
+        path = _blob_path(session)
+        session.delete()
+        transaction.on_commit(lambda: os.path.exists(path) and os.remove(path))
+
+
+def purge_abandoned_uploads(max_age=None):
+    """
+    Aborts upload sessions that have not received a chunk within `max_age`.
+
+    Returns:
+        int: Number of sessions removed.
+    """
+    from .models import UploadSession
+
+    max_age = max_age or timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    sessions = UploadSession.objects.filter(updated_on__lt=now() - max_age)
+    count = 0
+    for session in sessions.iterator():
+        try:
+            abort_upload(session)
+        except UploadSession.DoesNotExist:
+            # Completed while the sweep ran
+            continue
+        count += 1
+    return count
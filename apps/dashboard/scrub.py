@@ -0,0 +1,129 @@
+import time
+from datetime import timedelta
+from django.db.models import F, Q
+from django.utils.timezone import now
+
+from .chunkstore import STORAGE_CHUNKED, iter_chunked_file
+from .crypto import iter_decrypted_file
+
+# --- Verification results
+VERIFY_UNVERIFIED = 'UNVERIFIED'
+VERIFY_OK = 'OK'
+VERIFY_CORRUPT = 'CORRUPT'
+VERIFY_MISSING = 'MISSING'
+VERIFY_CHOICES = [(VERIFY_UNVERIFIED, 'Unverified'), (VERIFY_OK, 'OK'),
+                  (VERIFY_CORRUPT, 'Corrupt'), (VERIFY_MISSING, 'Missing')]
+
+
+class Throttle:
+    """
+    Keeps a stream of reads under `bytes_per_second` by sleeping whenever it gets ahead of the budget.
+    A rate of 0 disables throttling.
+    """
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.consumed = 0
+        self.started = time.monotonic()
+
+    def consume(self, size):
+        self.consumed += size
+        if not self.bytes_per_second:
+            return
+        ahead = self.consumed / self.bytes_per_second - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def verify_file(encrypted_file, throttle=None):
+    """
+    Reads a stored file end to end and checks every GCM tag, without keeping any plaintext.
+    Compressed files are verified at the ciphertext level only, decompression would add nothing.
+
+    Returns:
+        str: VERIFY_OK, VERIFY_CORRUPT or VERIFY_MISSING
+    """
+    throttle = throttle or Throttle(0)
+    try:
+        password = encrypted_file.data_key()
+        if encrypted_file.storage_mode == STORAGE_CHUNKED:
+            chunks = iter_chunked_file(encrypted_file, password)
+        else:
+            if not encrypted_file.encrypted_file:
+                return VERIFY_MISSING
+            chunks = iter_decrypted_file(
+                encrypted_file.encrypted_file.path, password, encrypted_file.salt, encrypted_file.nonce,
+                encrypted_file.format_version, kdf=encrypted_file.kdf)
+        for chunk in chunks:
+            throttle.consume(len(chunk))
+    except FileNotFoundError:
+        return VERIFY_MISSING
+    except ValueError:
+        return VERIFY_CORRUPT
+    return VERIFY_OK
+
+
+def files_due_for_scrub(start_id=None, end_id=None, reverify_after=None):
+    """
+    Completed files in the inclusive ID range that were never verified, or not within `reverify_after`,
+    oldest verification first. Results are recorded per file, so an interrupted run resumes where it stopped.
+    """
+    from .models import EncryptedFile
+
+    files = EncryptedFile.objects.filter(status='COMPLETED')
+    if start_id is not None:
+        files = files.filter(pk__gte=start_id)
+    if end_id is not None:
+        files = files.filter(pk__lte=end_id)
+    if reverify_after is not None:
+        files = files.filter(Q(last_verified_at__isnull=True) | Q(last_verified_at__lt=now() - reverify_after))
+    return files.order_by(F('last_verified_at').asc(nulls_first=True), 'pk')
+
+
+def scrub_files(start_id=None, end_id=None, bytes_per_second=0, reverify_after=timedelta(days=30),
+                max_seconds=None, limit=None, log=print):
+    """
+    Verifies files due for a scrub one at a time and records the result on each row.
+
+    Args:
+        start_id, end_id: Inclusive ID range to work on, so shards can run on separate workers.
+        bytes_per_second: Read budget shared by the whole run, 0 for unthrottled.
+        reverify_after: Files verified more recently than this are skipped, None to verify everything.
+        max_seconds: Stop starting new files after this long; the next run picks up the rest.
+        limit: Most files to verify in this run.
+        log: Called with a message for every file that is not OK.
+
+    Returns:
+        dict: Number of files per verification result, plus bytes read and seconds taken.
+    """
+    from .models import EncryptedFile
+
+    throttle = Throttle(bytes_per_second)
+    summary = {VERIFY_OK: 0, VERIFY_CORRUPT: 0, VERIFY_MISSING: 0}
+    file_ids = files_due_for_scrub(start_id, end_id, reverify_after).values_list('pk', flat=True)
+    if limit:
+        file_ids = file_ids[:limit]
+    for file_id in list(file_ids):
+        if max_seconds is not None and time.monotonic() - throttle.started >= max_seconds:
+            break
+        encrypted_file = EncryptedFile.objects.filter(pk=file_id, status='COMPLETED').first()
+        if encrypted_file is None:
+            continue
+        result = verify_file(encrypted_file, throttle)
+        # Update only the scrub columns, the row may have changed while it was being read
+        EncryptedFile.objects.filter(pk=file_id).update(last_verified_at=now(), verification_status=result)
+        summary[result] += 1
+        if result != VERIFY_OK:
+            log(f"Scrub: {encrypted_file.original_filename} (ID {file_id}) is {result.lower()}")
+    summary['bytes'] = throttle.consumed
+    summary['seconds'] = round(time.monotonic() - throttle.started, 3)
+    return summary
+
+
+def split_id_range(first_id, last_id, shards):
+    """
+    Splits [first_id, last_id] into at most `shards` contiguous, inclusive ID ranges.
+    """
+    shards = max(min(shards, last_id - first_id + 1), 1)
+    step = -(-(last_id - first_id + 1) // shards)
+    return [(start, min(start + step - 1, last_id)) for start in range(first_id, last_id + 1, step)]
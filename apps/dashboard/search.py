@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, FloatField, TextField, Value, When
+from django.db.models.functions import Cast, Upper
+
+from .models import LISTING_FIELDS, Directory, EncryptedFile, get_directory_paths
+
+# Trigrams need three characters; shorter queries can't use the index and would match most of the vault
+SEARCH_MIN_LENGTH = 3
+
+
+def _ranked(queryset, field, query):
+    """
+    Rows of `queryset` whose `field` contains `query`, best matches first.
+
+    On Postgres the match is answered by the pg_trgm index on UPPER(field) (migration 0017) and
+    ranked by word similarity, so near-whole-word matches come before fragments. Only matches
+    whose word similarity reaches pg_trgm.word_similarity_threshold (0.6 unless the database sets
+    it) are kept, which the index also answers, so a common fragment can't make every page sort
+    most of the vault. Other databases, such as SQLite in tests, rank exact and prefix matches first.
+    """
+    matches = queryset.filter(**{f'{field}__icontains': query})
+    if connections[queryset.db].vendor == 'postgresql':
+        from django.contrib.postgres.lookups import TrigramWordSimilar
+        from django.contrib.postgres.search import TrigramWordSimilarity
+        # Written as UPPER(field::text) %> UPPER(query), the expression the index is built on
+        matches = matches.filter(TrigramWordSimilar(Upper(Cast(field, TextField())), query.upper()))
+        rank = TrigramWordSimilarity(query, field)
+    else:
+        rank = Case(
+            When(**{f'{field}__iexact': query}, then=Value(1.0)),
+            When(**{f'{field}__istartswith': query}, then=Value(0.75)),
+            default=Value(0.5),
+            output_field=FloatField(),
+        )
+    return matches.annotate(rank=rank).order_by('-rank', field, 'id')
+
+
+def search_vault(query, page=1, page_size=None) -> dict:
+    """
+    Searches file and directory names across the whole vault.
+
+    Args:
+        query: Text to look for in names, at least SEARCH_MIN_LENGTH characters.
+        page: 1-based page of files; matching directories come with the first page only.
+        page_size: Results per page, defaults to SEARCH_PAGE_SIZE.
+
+    Returns:
+        dict: Matching `directories` and `files`, each with a `location` (path of the folder
+            holding it, '' for Home), and `next_page`, None on the last page.
+    """
+    query = query.strip()
+    page_size = page_size or settings.SEARCH_PAGE_SIZE
+    if len(query) < SEARCH_MIN_LENGTH:
+        raise ValueError(f"Search for at least {SEARCH_MIN_LENGTH} characters.")
+    directories = []
+    if page == 1:
+        directories = list(_ranked(Directory.objects.filter(mark_deleted=False), 'name', query)[:page_size])
+    offset = (page - 1) * page_size
+    files = list(_ranked(EncryptedFile.objects.filter(mark_deleted=False).only(*LISTING_FIELDS, 'directory_id'),
+                         'original_filename', query)[offset:offset + page_size + 1])
+    files, has_next = files[:page_size], len(files) > page_size
+    # Deleting a directory marks everything in it, so no result sits in a deleted folder
+    paths = get_directory_paths([d.parent_id for d in directories if d.parent_id] +
+                                [f.directory_id for f in files if f.directory_id])
+    for directory in directories:
+        directory.location = paths.get(directory.parent_id, '')
+    for file in files:
+        file.location = paths.get(file.directory_id, '')
+    return {
+        'query': query,
+        'directories': directories,
+        'files': files,
+        'next_page': page + 1 if has_next else None,
+    }
@@ -2,13 +2,108 @@ import os
 from django.conf import settings
 from celery import shared_task
 from django.db import transaction
+from django.db.models import Max, Min, Sum
 import uuid
-from core.settings import BASE_DIR
+from datetime import timedelta
 
 from .models import EncryptedFile
-from .crypto import save_encrypted_file_to_disk, decrypt_file_from_disk
+from .crypto import save_encrypted_file_to_disk, decrypt_file_from_disk, FORMAT_V2, KDF_HKDF
+from .parallel import parallel_encrypt_file, parallel_decrypt_file
+from .compression import CompressingReader, COMPRESSION_NONE
+from .fileio import adaptive_chunk_size
+from .chunkstore import STORAGE_CHUNKED, save_file_chunks
+from .scrub import files_due_for_scrub, scrub_files, split_id_range
+from .resumable import purge_abandoned_uploads
+from .decryptcache import evict_over_budget, release_decryption
+from .events import publish_file_event, publish_file_progress
+from .progress import ProgressReader, ProgressReporter
+from .expiry import decrypted_file_expiry, decrypted_temp_dir, expire_decrypted_files, remove_orphan_decrypted_files
+from .keyring import chunk_store_key
 
-KEY_PATH = BASE_DIR / 'config' / 'encryption_key.key'
+
+def queue_for_size(size):
+    """
+    Queue for encrypting or decrypting a file of `size` bytes. Large files get workers of their own,
+    so one long job never holds up the small ones.
+    """
+    if size is not None and size >= settings.LARGE_FILE_THRESHOLD:
+        return settings.LARGE_FILE_QUEUE
+    return settings.CELERY_TASK_DEFAULT_QUEUE
+
+
+def _progress_reporter(task, file_id, status, total):
+    """
+    Reports how far a task has got through Celery's result backend (state PROGRESS) and the file's
+    event channel. Reports are a courtesy, so a backend hiccup doesn't fail a long-running task.
+    """
+    def report(stats):
+        try:
+            task.update_state(state='PROGRESS', meta=stats)
+        except Exception as e:
+            print(f"Celery: Could not store progress of task {task.request.id}: {e}")
+        publish_file_progress(file_id, status, stats)
+    return ProgressReporter(total, report)
+
+
+def _encrypt_to_blob(task, encrypted_file_instance, uploaded_file_path, password_raw, progress=None):
+    """
+    Encrypts the uploaded file into a single v2 blob under MEDIA_ROOT/encrypted_files.
+    """
+    # Create a unique filename for the encrypted output
+    encrypted_file_basename = f"{task.request.id}.enc"
+
+    # Get the full path where the encrypted file will be saved
+    encrypted_file_full_path = os.path.join(settings.MEDIA_ROOT, 'encrypted_files', encrypted_file_basename)
+    # Ensure directory exists
+    os.makedirs(os.path.dirname(encrypted_file_full_path), exist_ok=True)
+
+    # Encrypt and save to disk, spreading large files across the worker pool
+    uploaded_file_size = os.path.getsize(uploaded_file_path)
+    with open(uploaded_file_path, 'rb') as temp_infile:
+        if progress:
+            temp_infile = ProgressReader(temp_infile, progress)
+        # Compress on the way in, unless the data turns out to be incompressible
+        temp_infile = CompressingReader(temp_infile, settings.COMPRESSION_CODEC)
+        if uploaded_file_size >= settings.PARALLEL_CRYPTO_THRESHOLD:
+            salt, nonce, encrypted_file_size, stats = parallel_encrypt_file(
+                temp_infile, encrypted_file_full_path, password_raw,
+                workers=settings.PARALLEL_CRYPTO_WORKERS, executor=settings.PARALLEL_CRYPTO_EXECUTOR
+            )
+            print(f"Celery: Encrypted {encrypted_file_instance.original_filename} at {stats['mb_per_s']} MB/s "
+                  f"({stats['workers']} {stats['executor']} workers)")
+        else:
+            salt, nonce, encrypted_file_size = save_encrypted_file_to_disk(
+                temp_infile, encrypted_file_full_path, password_raw,
+                chunk_size=adaptive_chunk_size(uploaded_file_size)
+            )
+
+    encrypted_file_instance.encrypted_file = os.path.join('encrypted_files', encrypted_file_basename)
+    encrypted_file_instance.file_size = encrypted_file_size
+    encrypted_file_instance.salt = salt
+    encrypted_file_instance.nonce = nonce
+    encrypted_file_instance.format_version = FORMAT_V2
+    encrypted_file_instance.kdf = KDF_HKDF
+    encrypted_file_instance.compression = temp_infile.codec
+    encrypted_file_instance.compressed_size = (
+        temp_infile.output_bytes if temp_infile.codec != COMPRESSION_NONE else None)
+
+
+def _encrypt_to_chunks(encrypted_file_instance, uploaded_file_path, password_raw, progress=None):
+    """
+    Stores the uploaded file as deduplicated chunks. Chunks already in the store are
+    referenced instead of being encrypted and written again.
+    """
+    encrypted_file_instance.storage_mode = STORAGE_CHUNKED
+    encrypted_file_instance.encrypted_file = ''
+    encrypted_file_instance.save()
+    with open(uploaded_file_path, 'rb') as temp_infile:
+        if progress:
+            temp_infile = ProgressReader(temp_infile, progress)
+        size, stored_bytes = save_file_chunks(encrypted_file_instance, temp_infile, password_raw)
+    encrypted_file_instance.file_size = encrypted_file_instance.chunk_refs.aggregate(
+        total=Sum('chunk__stored_size'))['total'] or 0
+    print(f"Celery: Stored {encrypted_file_instance.original_filename} as chunks, "
+          f"{stored_bytes} of {size} bytes were new")
 
 
 @shared_task(bind=True)
@@ -22,46 +117,41 @@ def perform_encryption_task(self, uploaded_file_path, encrypted_file_id: int):
     """
     encrypted_file_instance = EncryptedFile.objects.get(id=encrypted_file_id)
     original_filename = encrypted_file_instance.original_filename
-    # Get encryption key
-    if not os.path.exists(KEY_PATH):
-        raise FileNotFoundError("Encryption key file does not exist. Please generate it first.")
-    with open(KEY_PATH, 'rb') as f:
-        password_raw = f.read()
+    # Chunks are encrypted under the chunk store's key, a blob under a new data key of its own
+    if settings.STORAGE_MODE == STORAGE_CHUNKED:
+        password_raw = chunk_store_key()
+    else:
+        password_raw = encrypted_file_instance.new_data_key()
     # Make EncryptedFile object with status='PROCESSING'
     with transaction.atomic():
         encrypted_file_instance.status = 'PROCESSING'
         encrypted_file_instance.celery_task_id = self.request.id
         encrypted_file_instance.save()
+        publish_file_event(encrypted_file_id, encrypted_file_instance.status)
     try:
-        with transaction.atomic():
-            # Create a unique filename for the encrypted output
-            encrypted_file_basename = f"{self.request.id}.enc"
-
-            # Get the full path where the encrypted file will be saved
-            encrypted_file_full_path = os.path.join(settings.MEDIA_ROOT, 'encrypted_files', encrypted_file_basename)
-            # Ensure directory exists
-            os.makedirs(os.path.dirname(encrypted_file_full_path), exist_ok=True)
-
-            # Encrypt and save to disk
-            with open(uploaded_file_path, 'rb') as temp_infile:
-                salt, nonce, encrypted_file_size = save_encrypted_file_to_disk(
-                    temp_infile, encrypted_file_full_path, password_raw
-                )
+        progress = _progress_reporter(self, encrypted_file_id, 'PROCESSING', os.path.getsize(uploaded_file_path))
+        if settings.STORAGE_MODE == STORAGE_CHUNKED:
+            # Chunks are committed batch by batch, not in one long transaction
+            _encrypt_to_chunks(encrypted_file_instance, uploaded_file_path, password_raw, progress)
+        else:
+            with transaction.atomic():
+                _encrypt_to_blob(self, encrypted_file_instance, uploaded_file_path, password_raw, progress)
+        stats = progress.finish()
 
+        with transaction.atomic():
             # Clean up the temporary uploaded file
             if os.path.exists(uploaded_file_path):
                 os.remove(uploaded_file_path)
 
             # Save to database
             encrypted_file_instance.original_filename = original_filename
-            encrypted_file_instance.encrypted_file = os.path.join('encrypted_files', encrypted_file_basename)
-            encrypted_file_instance.file_size = encrypted_file_size
-            encrypted_file_instance.salt = salt
-            encrypted_file_instance.nonce = nonce
             encrypted_file_instance.status = 'COMPLETED'
+            encrypted_file_instance.encryption_mb_per_s = stats['avg_mb_per_s']
             encrypted_file_instance.save()
+            publish_file_event(encrypted_file_id, encrypted_file_instance.status)
 
-        print(f"Celery: Encryption task for {original_filename} completed successfully! Task ID: {self.request.id}")
+        print(f"Celery: Encryption task for {original_filename} completed successfully at {stats['avg_mb_per_s']} MB/s! "
+              f"Task ID: {self.request.id}")
         return {'success': True, 'message': 'File encrypted successfully', 'file': encrypted_file_instance.serialize("json")}
 
     except Exception as e:
@@ -73,11 +163,41 @@ def perform_encryption_task(self, uploaded_file_path, encrypted_file_id: int):
                 if encrypted_file_instance:
                     encrypted_file_instance.status = 'FAILED'
                     encrypted_file_instance.save()
+                    publish_file_event(encrypted_file_id, encrypted_file_instance.status)
         except Exception as update_e:
             print(f"Celery: Failed to update status for task {self.request.id}: {update_e}")
         return {'success': False, 'message': str(e), 'file': encrypted_file_instance.serialize("json") if encrypted_file_instance else None}
 
 
+@shared_task(bind=True)
+def finalize_encrypted_upload_task(self, encrypted_file_id: int):
+    """
+    Celery task to finish a file that was encrypted while it was being uploaded.
+    The ciphertext is already in place, so the entry is only checked and marked as completed.
+
+    Args:
+    encrypted_file_id: ID of the EncryptedFile instance to finalise.
+    """
+    try:
+        with transaction.atomic():
+            encrypted_file_instance = EncryptedFile.objects.select_for_update().get(id=encrypted_file_id)
+            encrypted_file_instance.celery_task_id = self.request.id
+            stored = encrypted_file_instance.has_complete_content()
+            encrypted_file_instance.status = 'COMPLETED' if stored else 'FAILED'
+            encrypted_file_instance.save()
+            publish_file_event(encrypted_file_id, encrypted_file_instance.status)
+    except EncryptedFile.DoesNotExist:
+        print(f"Celery: Finalising upload failed: EncryptedFile with ID {encrypted_file_id} not found.")
+        return {'success': False, 'message': 'File not found.'}
+
+    original_filename = encrypted_file_instance.original_filename
+    if not stored:
+        print(f"Celery: Finalising upload of {original_filename} failed: encrypted file is missing or incomplete.")
+        return {'success': False, 'message': 'Encrypted file is missing or incomplete.', 'file': encrypted_file_instance.serialize("json")}
+    print(f"Celery: Upload of {original_filename} was encrypted on receive. Task ID: {self.request.id}")
+    return {'success': True, 'message': 'File encrypted successfully', 'file': encrypted_file_instance.serialize("json")}
+
+
 @shared_task(bind=True)
 def perform_decryption_task(self, encrypted_file_id):
     """
@@ -88,20 +208,18 @@ def perform_decryption_task(self, encrypted_file_id):
     password_raw: The raw password used for decryption.
     """
     try:
-        # Get encryption key
-        if not os.path.exists(KEY_PATH):
-            raise FileNotFoundError("Encryption key file does not exist. Please generate it first.")
-        with open(KEY_PATH, 'rb') as f:
-            password_raw = f.read()
-
         with transaction.atomic():
             encrypted_file_instance = EncryptedFile.objects.get(id=encrypted_file_id)
             encrypted_file_instance.status = 'DECRYPTING'
             encrypted_file_instance.celery_task_id = self.request.id
             encrypted_file_instance.save()
+            publish_file_event(encrypted_file_id, encrypted_file_instance.status)
+
+        # Get the file's data key
+        password_raw = encrypted_file_instance.data_key()
 
         # Create a temporary path for the decrypted file
-        temp_decrypted_dir = os.path.join(settings.MEDIA_ROOT, 'decrypted_temp')
+        temp_decrypted_dir = decrypted_temp_dir()
         os.makedirs(temp_decrypted_dir, exist_ok=True)
 
         # Use a unique name for the temporary decrypted file
@@ -109,22 +227,61 @@ def perform_decryption_task(self, encrypted_file_id):
         temp_decrypted_filename = f"{uuid.uuid4()}_{original_filename}"
         temp_decrypted_file_path = os.path.join(temp_decrypted_dir, temp_decrypted_filename)
 
-        # Perform decryption
-        decryption_success = decrypt_file_from_disk(
-            encrypted_file_instance.encrypted_file.path,
-            temp_decrypted_file_path,
-            password_raw,
-            encrypted_file_instance.salt,
-            encrypted_file_instance.nonce
-        )
+        # Perform decryption, spreading large v2 files across the worker pool
+        if encrypted_file_instance.storage_mode == STORAGE_CHUNKED:
+            progress = _progress_reporter(self, encrypted_file_id, 'DECRYPTING',
+                                          encrypted_file_instance.original_file_size)
+            try:
+                with open(temp_decrypted_file_path, 'wb') as outfile:
+                    for chunk in encrypted_file_instance.iter_plaintext():
+                        outfile.write(chunk)
+                        progress(len(chunk))
+                decryption_success = True
+            except (ValueError, FileNotFoundError) as e:
+                print(f"Decryption failed for chunked file {original_filename}: {e}")
+                decryption_success = False
+        elif (encrypted_file_instance.format_version == FORMAT_V2
+                and encrypted_file_instance.file_size >= settings.PARALLEL_CRYPTO_THRESHOLD):
+            progress = _progress_reporter(self, encrypted_file_id, 'DECRYPTING', encrypted_file_instance.file_size)
+            stats = parallel_decrypt_file(
+                encrypted_file_instance.encrypted_file.path, temp_decrypted_file_path, password_raw,
+                workers=settings.PARALLEL_CRYPTO_WORKERS, executor=settings.PARALLEL_CRYPTO_EXECUTOR,
+                kdf=encrypted_file_instance.kdf,
+                compression=encrypted_file_instance.compression,
+                progress=progress,
+            )
+            print(f"Celery: Decrypted {original_filename} at {stats['mb_per_s']} MB/s "
+                  f"({stats['workers']} {stats['executor']} workers)")
+            decryption_success = True
+        else:
+            progress = _progress_reporter(self, encrypted_file_id, 'DECRYPTING', encrypted_file_instance.file_size)
+            decryption_success = decrypt_file_from_disk(
+                encrypted_file_instance.encrypted_file.path,
+                temp_decrypted_file_path,
+                password_raw,
+                encrypted_file_instance.salt,
+                encrypted_file_instance.nonce,
+                encrypted_file_instance.format_version,
+                encrypted_file_instance.kdf,
+                encrypted_file_instance.compression,
+                use_mmap=settings.CRYPTO_USE_MMAP,
+                progress=progress,
+            )
 
         with transaction.atomic():
             if decryption_success:
                 encrypted_file_instance.status = 'DECRYPTED'  # File is ready for download
                 encrypted_file_instance.decrypted_temp_path = temp_decrypted_file_path  # Store path
+                encrypted_file_instance.decrypted_expires_at = decrypted_file_expiry()  # Removed by expire_decrypted_files_task
+                encrypted_file_instance.decryption_mb_per_s = progress.finish()['avg_mb_per_s']
                 encrypted_file_instance.save()
+                publish_file_event(encrypted_file_id, encrypted_file_instance.status)
                 print(
-                    f"Celery: Decryption task for {original_filename} completed successfully. Temp file: {temp_decrypted_file_path}")
+                    f"Celery: Decryption task for {original_filename} completed successfully at "
+                    f"{encrypted_file_instance.decryption_mb_per_s} MB/s. Temp file: {temp_decrypted_file_path}")
+                evicted = evict_over_budget(keep=encrypted_file_instance.pk)
+                if evicted:
+                    print(f"Celery: Evicted {evicted} decrypted files to stay within DECRYPTED_CACHE_MAX_BYTES")
                 return {
                     'success': True,
                     'message': 'File decrypted successfully and ready for download.',
@@ -133,6 +290,7 @@ def perform_decryption_task(self, encrypted_file_id):
             else:
                 encrypted_file_instance.status = 'FAILED'
                 encrypted_file_instance.save()
+                publish_file_event(encrypted_file_id, encrypted_file_instance.status)
                 # Clean up incomplete decrypted file
                 if os.path.exists(temp_decrypted_file_path):
                     os.remove(temp_decrypted_file_path)
@@ -153,7 +311,71 @@ def perform_decryption_task(self, encrypted_file_id):
                     if encrypted_file_instance.decrypted_temp_path and os.path.exists(encrypted_file_instance.decrypted_temp_path):
                         os.remove(encrypted_file_instance.decrypted_temp_path)
                         encrypted_file_instance.decrypted_temp_path = None
+                        encrypted_file_instance.decrypted_expires_at = None
                     encrypted_file_instance.save()
+                    publish_file_event(encrypted_file_id, encrypted_file_instance.status)
         except Exception as update_e:
             print(f"Celery: Failed to update status for task {self.request.id}: {update_e}")
         return {'success': False, 'message': str(e), 'file': None}
+    finally:
+        # Later requests for this file start a new decryption or use the decrypted copy
+        release_decryption(encrypted_file_id, self.request.id)
+
+
+@shared_task(ignore_result=True)
+def schedule_integrity_scrub():
+    """
+    Periodic task that splits the files due for verification into SCRUB_SHARDS ID ranges
+    and queues one scrub task per range. The bytes-per-second budget is shared between them.
+    """
+    reverify_after = timedelta(days=settings.SCRUB_REVERIFY_DAYS)
+    bounds = files_due_for_scrub(reverify_after=reverify_after).aggregate(first=Min('pk'), last=Max('pk'))
+    if bounds['first'] is None:
+        return
+    ranges = split_id_range(bounds['first'], bounds['last'], settings.SCRUB_SHARDS)
+    for start_id, end_id in ranges:
+        scrub_integrity_task.delay(start_id, end_id, settings.SCRUB_BYTES_PER_SECOND // len(ranges))
+
+
+@shared_task(ignore_result=True)
+def scrub_integrity_task(start_id, end_id, bytes_per_second):
+    """
+    Celery task to verify the stored files in an ID range, throttled to `bytes_per_second`.
+    Stops before the next scheduled run would start, files left over are picked up then.
+    """
+    summary = scrub_files(
+        start_id, end_id, bytes_per_second=bytes_per_second,
+        reverify_after=timedelta(days=settings.SCRUB_REVERIFY_DAYS), max_seconds=settings.SCRUB_INTERVAL * 0.9,
+    )
+    print(f"Celery: Scrubbed IDs {start_id}-{end_id}: {summary}")
+
+
+@shared_task(ignore_result=True)
+def purge_abandoned_uploads_task():
+    """
+    Periodic task that removes resumable uploads which stopped receiving chunks,
+    along with their partially written encrypted files.
+    """
+    count = purge_abandoned_uploads()
+    if count:
+        print(f"Celery: Removed {count} abandoned upload sessions")
+
+
+@shared_task(ignore_result=True)
+def expire_decrypted_files_task():
+    """
+    Periodic task that removes decrypted files once their DECRYPTED_FILE_TTL_MINUTES have passed.
+    """
+    count = expire_decrypted_files()
+    if count:
+        print(f"Celery: Expired {count} decrypted files")
+
+
+@shared_task(ignore_result=True)
+def remove_orphan_decrypted_files_task():
+    """
+    Periodic task that removes decrypted files no EncryptedFile references any more.
+    """
+    count = remove_orphan_decrypted_files()
+    if count:
+        print(f"Celery: Removed {count} orphaned decrypted files")
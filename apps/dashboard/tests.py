@@ -1,3 +1,651 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils.timezone import now
 
-# Create your tests here.
+from .crypto import (
+    FORMAT_V1, FORMAT_V2, KDF_HKDF, KDF_PBKDF2, decrypt_file_from_disk, iter_decrypted_file, plaintext_size,
+    save_encrypted_file_to_disk,
+)
+from . import chunkstore, keyring, views
+from .chunkstore import STORAGE_BLOB, STORAGE_CHUNKED, chunk_path, iter_cdc_chunks, iter_chunked_file, save_file_chunks
+from .decryptcache import acquire_decryption
+from .events import stream_file_events
+from .models import (
+    LISTING_ORDER, Chunk, Directory, EncryptedFile, FileChunk, UploadSession, decode_listing_cursor,
+    encode_listing_cursor, get_directory_paths, get_home_contents, get_subtree_paths,
+)
+from .offload import OFFLOAD_NONE, OFFLOAD_X_ACCEL, OFFLOAD_X_SENDFILE, offloaded_file_response
+from .resumable import abort_upload, complete_upload, create_upload_session, write_chunk
+from .scrub import VERIFY_MISSING, VERIFY_UNVERIFIED, files_due_for_scrub, scrub_files, split_id_range
+from .views import _guess_content_type, _parse_range_header
+from .ziparchive import ZipMember, iter_zip
+
+SEGMENT = 1024  # small segments, so a few KB of data spans several
+
+
+class TempDirMixin:
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+
+class MediaRootMixin(TempDirMixin):
+    """
+    Stores files under the test's temporary folder.
+    """
+
+    def setUp(self):
+        super().setUp()
+        settings = override_settings(MEDIA_ROOT=self.tmp)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+
+class KeyRingMixin(TempDirMixin):
+    """
+    Points the key ring at a fresh legacy master key under the test's temporary folder.
+    """
+
+    def setUp(self):
+        super().setUp()
+        for name, value in (('LEGACY_KEY_PATH', Path(self.tmp) / 'encryption_key.key'),
+                            ('MASTER_KEY_DIR', Path(self.tmp) / 'master_keys')):
+            patcher = mock.patch.object(keyring, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        with open(keyring.LEGACY_KEY_PATH, 'wb') as f:
+            f.write(os.urandom(keyring.KEY_LENGTH))
+        for cached in (keyring._key_ring, keyring.chunk_store_key):
+            cached.cache_clear()
+            self.addCleanup(cached.cache_clear)
+
+
+class ContainerFormatTests(TempDirMixin, SimpleTestCase):
+    key = bytes(range(32))
+
+    def encrypt(self, data, format_version=FORMAT_V2, kdf=KDF_HKDF):
+        path = self.path(f'v{format_version}.enc')
+        salt, nonce, _ = save_encrypted_file_to_disk(io.BytesIO(data), path, self.key, format_version, kdf,
+                                                     segment_size=SEGMENT)
+        return path, salt, nonce
+
+    def decrypt(self, path, salt, nonce, format_version=FORMAT_V2, kdf=KDF_HKDF):
+        return b''.join(iter_decrypted_file(path, self.key, salt, nonce, format_version, kdf=kdf))
+
+    def test_v2_round_trip(self):
+        for size in (0, 1, SEGMENT - 1, SEGMENT, SEGMENT + 1, 5 * SEGMENT + 17):
+            with self.subTest(size=size):
+                data = os.urandom(size)
+                path, salt, nonce = self.encrypt(data)
+                self.assertEqual(self.decrypt(path, salt, nonce), data)
+                self.assertEqual(plaintext_size(path, FORMAT_V2), size)
+
+    def test_v2_decrypt_to_disk(self):
+        data = os.urandom(3 * SEGMENT + 5)
+        path, salt, nonce = self.encrypt(data)
+        output = self.path('out')
+        self.assertTrue(decrypt_file_from_disk(path, output, self.key, salt, nonce, FORMAT_V2, KDF_HKDF))
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_v2_range_read(self):
+        data = os.urandom(4 * SEGMENT + 100)
+        path, salt, nonce = self.encrypt(data)
+        for start, end in ((0, 1), (SEGMENT - 3, SEGMENT + 3), (SEGMENT, 2 * SEGMENT), (100, len(data)),
+                           (len(data) - 1, len(data))):
+            with self.subTest(start=start, end=end):
+                chunks = iter_decrypted_file(path, self.key, salt, nonce, FORMAT_V2, start=start, end=end, kdf=KDF_HKDF)
+                self.assertEqual(b''.join(chunks), data[start:end])
+
+    def test_v2_tampered_segment_is_rejected(self):
+        data = os.urandom(3 * SEGMENT)
+        path, salt, nonce = self.encrypt(data)
+        with open(path, 'r+b') as f:
+            f.seek(os.path.getsize(path) // 2)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 1]))
+        with self.assertRaises(ValueError):
+            self.decrypt(path, salt, nonce)
+        self.assertFalse(decrypt_file_from_disk(path, self.path('out'), self.key, salt, nonce, FORMAT_V2, KDF_HKDF))
+        self.assertFalse(os.path.exists(self.path('out')))
+
+    def test_v2_truncated_file_is_rejected(self):
+        data = os.urandom(3 * SEGMENT)
+        path, salt, nonce = self.encrypt(data)
+        size = os.path.getsize(path)
+        # Dropping whole trailing segments must fail too, not only a cut through one
+        for cut in (1, SEGMENT // 2, SEGMENT + 16):
+            with self.subTest(cut=cut):
+                truncated = self.path('truncated.enc')
+                with open(path, 'rb') as src, open(truncated, 'wb') as dst:
+                    dst.write(src.read(size - cut))
+                with self.assertRaises(ValueError):
+                    b''.join(iter_decrypted_file(truncated, self.key, salt, nonce, FORMAT_V2, kdf=KDF_HKDF))
+
+    def test_v2_wrong_key_is_rejected(self):
+        path, salt, nonce = self.encrypt(os.urandom(SEGMENT))
+        with self.assertRaises(ValueError):
+            b''.join(iter_decrypted_file(path, bytes(32), salt, nonce, FORMAT_V2, kdf=KDF_HKDF))
+
+    def test_v1_round_trip(self):
+        data = os.urandom(3 * SEGMENT + 7)
+        path, salt, nonce = self.encrypt(data, FORMAT_V1, KDF_PBKDF2)
+        self.assertEqual(self.decrypt(path, salt, nonce, FORMAT_V1, KDF_PBKDF2), data)
+        self.assertEqual(plaintext_size(path, FORMAT_V1), len(data))
+
+    def test_v1_tampered_file_is_rejected(self):
+        path, salt, nonce = self.encrypt(os.urandom(2 * SEGMENT), FORMAT_V1, KDF_PBKDF2)
+        with open(path, 'r+b') as f:
+            f.seek(40)
+            byte = f.read(1)
+            f.seek(40)
+            f.write(bytes([byte[0] ^ 1]))
+        with self.assertRaises(ValueError):
+            self.decrypt(path, salt, nonce, FORMAT_V1, KDF_PBKDF2)
+
+    def test_v1_refuses_ranges(self):
+        path, salt, nonce = self.encrypt(os.urandom(SEGMENT), FORMAT_V1, KDF_PBKDF2)
+        with self.assertRaises(ValueError):
+            b''.join(iter_decrypted_file(path, self.key, salt, nonce, FORMAT_V1, start=10, kdf=KDF_PBKDF2))
+
+
+class StreamHeaderTests(SimpleTestCase):
+    def test_inline_markup_is_served_as_text(self):
+        for name in ('page.html', 'logo.svg', 'notes.txt'):
+            with self.subTest(name=name):
+                self.assertEqual(_guess_content_type(name, inline=True), 'text/plain; charset=utf-8')
+        self.assertEqual(_guess_content_type('page.html'), 'text/html')
+        self.assertEqual(_guess_content_type('photo.png', inline=True), 'image/png')
+
+    def test_ranges(self):
+        self.assertEqual(_parse_range_header('bytes=0-9', 100), (0, 9))
+        self.assertEqual(_parse_range_header('bytes=-10', 100), (90, 99))
+        self.assertEqual(_parse_range_header('bytes=90-', 100), (90, 99))
+        self.assertIsNone(_parse_range_header('bytes=0-1,5-6', 100))
+        for header, size in (('bytes=-10', 0), ('bytes=100-', 100), ('bytes=-0', 100)):
+            with self.subTest(header=header, size=size):
+                with self.assertRaises(ValueError):
+                    _parse_range_header(header, size)
+
+
+class StreamDecryptedFileTests(MediaRootMixin, TestCase):
+    def v1_file(self):
+        path = self.path('v1.enc')
+        salt, nonce, size = save_encrypted_file_to_disk(io.BytesIO(os.urandom(3000)), path, bytes(32), FORMAT_V1,
+                                                        KDF_PBKDF2)
+        encrypted_file = EncryptedFile.objects.create(
+            original_filename='a.bin', original_file_size=3000, file_size=size, status='COMPLETED',
+            encrypted_file='v1.enc', salt=salt, nonce=nonce, format_version=FORMAT_V1, kdf=KDF_PBKDF2)
+        return encrypted_file
+
+    def stream(self, encrypted_file):
+        return views.stream_decrypted_file.__wrapped__(RequestFactory().get('/'), encrypted_file.pk)
+
+    @override_settings(INLINE_CRYPTO_MAX_BYTES=0)
+    def test_large_v1_file_is_not_streamed(self):
+        encrypted_file = self.v1_file()
+        response = self.stream(encrypted_file)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response['Location'], reverse('dashboard:decrypt_file', args=[encrypted_file.pk]))
+
+    @override_settings(INLINE_CRYPTO_MAX_BYTES=1 << 20)
+    def test_small_tampered_v1_file_is_refused(self):
+        encrypted_file = self.v1_file()
+        with open(self.path('v1.enc'), 'r+b') as f:
+            f.seek(40)
+            byte = f.read(1)
+            f.seek(40)
+            f.write(bytes([byte[0] ^ 1]))
+        with mock.patch.object(EncryptedFile, 'data_key', return_value=bytes(32)):
+            response = self.stream(encrypted_file)
+        self.assertEqual(response.status_code, 500)
+
+
+class ChunkStoreTests(MediaRootMixin, TestCase):
+    key = bytes(range(32))
+
+    def chunked_file(self, data, directory=None):
+        encrypted_file = EncryptedFile.objects.create(
+            original_filename='a.bin', original_file_size=len(data), file_size=0, directory=directory,
+            storage_mode=STORAGE_CHUNKED, status='COMPLETED')
+        with self.captureOnCommitCallbacks(execute=True):
+            save_file_chunks(encrypted_file, io.BytesIO(data), self.key)
+        return encrypted_file
+
+    def assertStoreEmpty(self):
+        self.assertEqual(Chunk.objects.count(), 0)
+        self.assertEqual(FileChunk.objects.count(), 0)
+        self.assertEqual(sum(len(files) for _, _, files in os.walk(self.path('chunks'))), 0)
+
+    def test_vectorised_cut_points_match_the_byte_scan(self):
+        if chunkstore.numpy is None:
+            self.skipTest("numpy is not installed")
+        pattern = bytes(range(7)) * 100000
+        for data in (os.urandom(1500000), bytes(700000), pattern, os.urandom(20000)):
+            with self.subTest(size=len(data)):
+                fast = [len(chunk) for chunk in iter_cdc_chunks(io.BytesIO(data))]
+                with mock.patch.object(chunkstore, 'numpy', None):
+                    slow = [len(chunk) for chunk in iter_cdc_chunks(io.BytesIO(data))]
+                self.assertEqual(fast, slow)
+
+    def test_shared_chunks_are_counted_and_read_back(self):
+        data = os.urandom(600000)
+        first, second = self.chunked_file(data), self.chunked_file(data)
+        self.assertEqual(b''.join(iter_chunked_file(second, self.key)), data)
+        self.assertEqual(set(Chunk.objects.values_list('ref_count', flat=True)), {2})
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(b''.join(iter_chunked_file(second, self.key)), data)
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertStoreEmpty()
+
+    def test_queryset_delete_releases_chunks(self):
+        self.chunked_file(os.urandom(300000))
+        self.chunked_file(os.urandom(300000))
+        with self.captureOnCommitCallbacks(execute=True):
+            EncryptedFile.objects.all().delete()
+        self.assertStoreEmpty()
+
+    def test_directory_cascade_releases_chunks(self):
+        parent = Directory.objects.create(name='parent')
+        child = Directory.objects.create(name='child', parent=parent)
+        self.chunked_file(os.urandom(300000), parent)
+        self.chunked_file(os.urandom(300000), child)
+        with self.captureOnCommitCallbacks(execute=True):
+            parent.delete()
+        self.assertStoreEmpty()
+
+    def test_rolled_back_delete_keeps_chunk_files(self):
+        encrypted_file = self.chunked_file(os.urandom(300000))
+        digests = list(Chunk.objects.values_list('digest', flat=True))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    encrypted_file.delete()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertTrue(all(os.path.exists(chunk_path(cid)) for cid in digests))
+
+
+class ResumableUploadTests(KeyRingMixin, MediaRootMixin, TestCase):
+    def uploaded(self, data):
+        session = create_upload_session('a.bin', len(data))
+        write_chunk(session, 0, io.BytesIO(data), session.data_key())
+        return session
+
+    def start(self):
+        request = RequestFactory().post('/', {'filename': 'a.bin', 'size': 1000, 'parent_directory': ''})
+        return views.start_resumable_upload.__wrapped__(request)
+
+    @override_settings(STORAGE_MODE=STORAGE_BLOB)
+    def test_blob_storage_accepts_resumable_uploads(self):
+        response = self.start()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(UploadSession.objects.count(), 1)
+
+    @override_settings(STORAGE_MODE=STORAGE_CHUNKED)
+    def test_chunked_storage_refuses_resumable_uploads(self):
+        response = self.start()
+        self.assertEqual(response.status_code, 409)
+        self.assertIs(json.loads(response.content)['resumable'], False)
+        self.assertEqual(UploadSession.objects.count(), 0)
+
+    def test_second_complete_finds_the_upload_gone(self):
+        data = os.urandom(1000)
+        session = self.uploaded(data)
+        encrypted_file = complete_upload(session)
+        with self.assertRaises(UploadSession.DoesNotExist):
+            complete_upload(session)
+        self.assertEqual(EncryptedFile.objects.count(), 1)
+        self.assertEqual(b''.join(encrypted_file.iter_plaintext()), data)
+
+    def complete(self, session):
+        with mock.patch.object(views.finalize_encrypted_upload_task, 'delay') as delay:
+            response = views.complete_resumable_upload.__wrapped__(RequestFactory().post('/'), session.pk)
+        self.assertEqual(response.status_code, 200)
+        return EncryptedFile.objects.get(), delay
+
+    @override_settings(INLINE_CRYPTO_MAX_BYTES=4096)
+    def test_small_upload_is_finished_in_the_request(self):
+        encrypted_file, delay = self.complete(self.uploaded(os.urandom(1000)))
+        delay.assert_not_called()
+        self.assertEqual(encrypted_file.status, 'COMPLETED')
+
+    @override_settings(INLINE_CRYPTO_MAX_BYTES=512)
+    def test_large_upload_is_finished_by_a_task(self):
+        encrypted_file, delay = self.complete(self.uploaded(os.urandom(1000)))
+        delay.assert_called_once_with(encrypted_file.pk)
+        self.assertEqual(encrypted_file.status, 'PENDING')
+
+    def test_chunk_of_an_aborted_upload_is_refused(self):
+        session = self.uploaded(os.urandom(1000))
+        with self.captureOnCommitCallbacks(execute=True):
+            abort_upload(session)
+        with self.assertRaises(UploadSession.DoesNotExist):
+            write_chunk(session, 0, io.BytesIO(os.urandom(1000)), bytes(32))
+        self.assertEqual(UploadSession.objects.count(), 0)
+
+
+@override_settings(INLINE_CRYPTO_MAX_BYTES=0)
+class DecryptFileTests(TestCase):
+    def test_failed_enqueue_releases_the_file(self):
+        encrypted_file = EncryptedFile.objects.create(
+            original_filename='a.bin', original_file_size=10, file_size=42, status='COMPLETED',
+            format_version=FORMAT_V1, kdf=KDF_PBKDF2)
+        with mock.patch.object(views.perform_decryption_task, 'apply_async', side_effect=OSError("broker down")):
+            response = views.decrypt_file.__wrapped__(RequestFactory().get('/'), encrypted_file.pk)
+        self.assertEqual(response.status_code, 503)
+        encrypted_file.refresh_from_db()
+        self.assertEqual(encrypted_file.status, 'COMPLETED')
+        self.assertIsNone(encrypted_file.celery_task_id)
+        # The next request gets to start the decryption itself
+        self.assertTrue(acquire_decryption(encrypted_file.pk, 'next')[1])
+
+
+class FileEventStreamTests(TestCase):
+    def setUp(self):
+        # No status is ever published, every wait for one times out
+        pubsub = mock.MagicMock()
+        pubsub.subscribe = mock.AsyncMock()
+        pubsub.get_message = mock.AsyncMock(return_value=None)
+        pubsub.aclose = mock.AsyncMock()
+        client = mock.MagicMock(pubsub=mock.Mock(return_value=pubsub), aclose=mock.AsyncMock())
+        patcher = mock.patch('redis.asyncio.Redis.from_url', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stream(self, file_ids, limit=10):
+        async def collect():
+            messages = []
+            async for message in stream_file_events(file_ids):
+                messages.append(message)
+                if len(messages) == limit:
+                    break
+            return messages
+        return async_to_sync(collect)()
+
+    def test_deleted_file_ends_the_stream(self):
+        encrypted_file = EncryptedFile.objects.create(
+            original_filename='a.bin', original_file_size=10, file_size=42, status='PROCESSING')
+        with mock.patch('apps.dashboard.events.file_snapshot', side_effect=[
+                {encrypted_file.pk: {'file_id': encrypted_file.pk, 'status': 'PROCESSING', 'settled': False}}, {}]):
+            messages = self.stream([encrypted_file.pk])
+        self.assertEqual(messages[-1], b"event: done\ndata: {}\n\n")
+
+    @override_settings(EVENTS_STREAM_MAX_SECONDS=0)
+    def test_stream_ends_after_its_lifetime(self):
+        encrypted_file = EncryptedFile.objects.create(
+            original_filename='a.bin', original_file_size=10, file_size=42, status='PROCESSING')
+        messages = self.stream([encrypted_file.pk])
+        self.assertEqual(len(messages), 1)
+
+
+class ZipArchiveTests(SimpleTestCase):
+    def test_pool_threads_close_their_database_connections(self):
+        closed_by = []
+        data = [os.urandom(5000) for _ in range(4)]
+        members = [ZipMember(f'{i}.bin', len(chunk), (2025, 1, 1, 0, 0, 0), lambda chunk=chunk: iter([chunk]))
+                   for i, chunk in enumerate(data)]
+        with mock.patch('apps.dashboard.ziparchive.connection') as connection:
+            connection.close.side_effect = lambda: closed_by.append(threading.current_thread())
+            archive = b''.join(iter_zip(members, compression='store', workers=2, prefetch_chunks=2))
+        with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+            self.assertEqual([zf.read(f'{i}.bin') for i in range(4)], data)
+        self.assertEqual(len(closed_by), 4)
+        self.assertNotIn(threading.main_thread(), closed_by)
+
+
+class KeyRingTests(KeyRingMixin, TestCase):
+    def rotate(self, *args):
+        call_command('rotate_master_key', *args, stdout=io.StringIO())
+
+    def test_wrap_and_unwrap(self):
+        data_key, wrapped_key, version = keyring.generate_data_key()
+        self.assertEqual(version, keyring.LEGACY_KEY_VERSION)
+        self.assertEqual(keyring.unwrap_data_key(wrapped_key, version), data_key)
+        tampered = bytearray(wrapped_key)
+        tampered[-1] ^= 1
+        with self.assertRaises(ValueError):
+            keyring.unwrap_data_key(bytes(tampered), version)
+
+    def test_key_added_by_another_process_is_used_for_new_keys(self):
+        _, wrapped_key, version = keyring.generate_data_key()
+        os.makedirs(keyring.MASTER_KEY_DIR)
+        with open(keyring.master_key_path(1), 'wb') as f:
+            f.write(os.urandom(keyring.KEY_LENGTH))
+        data_key, wrapped_key, version = keyring.generate_data_key()
+        self.assertEqual(version, 1)
+        self.assertEqual(keyring.unwrap_data_key(wrapped_key, version), data_key)
+
+    def test_legacy_file_uses_master_key_version_0(self):
+        encrypted_file = EncryptedFile.objects.create(original_filename='a.bin', file_size=0)
+        with open(keyring.LEGACY_KEY_PATH, 'rb') as f:
+            self.assertEqual(encrypted_file.data_key(), f.read())
+        self.rotate()
+        encrypted_file.refresh_from_db()
+        self.assertEqual(encrypted_file.master_key_version, 1)
+        with open(keyring.LEGACY_KEY_PATH, 'rb') as f:
+            self.assertEqual(encrypted_file.data_key(), f.read())
+
+    def test_rotation_keeps_the_superseded_key_until_a_later_run(self):
+        encrypted_file = EncryptedFile(original_filename='a.bin', file_size=0)
+        data_key = encrypted_file.new_data_key()
+        encrypted_file.save()
+        self.rotate('--retire-old')
+        self.rotate('--retire-old')
+        encrypted_file.refresh_from_db()
+        self.assertEqual(encrypted_file.master_key_version, 2)
+        self.assertEqual(encrypted_file.data_key(), data_key)
+        self.assertTrue(os.path.exists(keyring.master_key_path(1)))
+        self.rotate('--rewrap-only', '--retire-old')
+        self.assertFalse(os.path.exists(keyring.master_key_path(1)))
+        self.assertEqual(sorted(keyring.load_key_ring().keys), [0, 2])
+        self.assertEqual(encrypted_file.data_key(), data_key)
+
+
+class ScrubTests(TestCase):
+    def test_split_id_range(self):
+        self.assertEqual(split_id_range(1, 10, 3), [(1, 4), (5, 8), (9, 10)])
+        self.assertEqual(split_id_range(5, 7, 10), [(5, 5), (6, 6), (7, 7)])
+        self.assertEqual(split_id_range(3, 3, 4), [(3, 3)])
+        self.assertEqual(split_id_range(1, 100, 1), [(1, 100)])
+        for first, last, shards in ((1, 1000, 7), (17, 18, 2), (1, 99, 4)):
+            with self.subTest(first=first, last=last, shards=shards):
+                ranges = split_id_range(first, last, shards)
+                self.assertLessEqual(len(ranges), shards)
+                # Contiguous and covering every ID exactly once
+                self.assertEqual([i for start, end in ranges for i in range(start, end + 1)],
+                                 list(range(first, last + 1)))
+
+    def completed_file(self, verified_days_ago=None):
+        return EncryptedFile.objects.create(
+            original_filename='a.bin', file_size=0, status='COMPLETED',
+            last_verified_at=None if verified_days_ago is None else now() - timedelta(days=verified_days_ago))
+
+    def test_files_due_for_scrub_order(self):
+        old = self.completed_file(40)
+        never = self.completed_file()
+        older = self.completed_file(90)
+        self.completed_file(1)
+        EncryptedFile.objects.create(original_filename='b.bin', file_size=0, status='PROCESSING')
+        due = files_due_for_scrub(reverify_after=timedelta(days=30))
+        self.assertEqual(list(due), [never, older, old])
+        self.assertEqual(list(files_due_for_scrub(start_id=older.pk, end_id=older.pk,
+                                                  reverify_after=timedelta(days=30))), [older])
+
+    def test_interrupted_scrub_resumes_with_the_next_file(self):
+        files = [self.completed_file() for _ in range(3)]
+        reverify_after = timedelta(days=30)
+        self.assertEqual(scrub_files(limit=1, reverify_after=reverify_after, log=lambda message: None)[VERIFY_MISSING], 1)
+        self.assertEqual(list(files_due_for_scrub(reverify_after=reverify_after)), files[1:])
+        scrub_files(limit=1, reverify_after=reverify_after, log=lambda message: None)
+        self.assertEqual(list(files_due_for_scrub(reverify_after=reverify_after)), files[2:])
+        self.assertEqual(set(EncryptedFile.objects.values_list('verification_status', flat=True)),
+                         {VERIFY_MISSING, VERIFY_UNVERIFIED})
+
+
+class DownloadOffloadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        os.makedirs(self.path('encrypted_files'))
+        with open(self.path('encrypted_files/a b.enc'), 'wb') as f:
+            f.write(b'ciphertext')
+
+    @override_settings(DOWNLOAD_OFFLOAD=OFFLOAD_X_ACCEL, DOWNLOAD_OFFLOAD_PREFIX='/protected/')
+    def test_x_accel_redirect_points_into_the_internal_location(self):
+        response = offloaded_file_response(self.path('encrypted_files/a b.enc'), 'a.bin')
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/encrypted_files/a%20b.enc')
+        self.assertEqual(response.content, b'')
+
+    @override_settings(DOWNLOAD_OFFLOAD=OFFLOAD_X_SENDFILE)
+    def test_x_sendfile_sends_the_real_path(self):
+        response = offloaded_file_response(self.path('encrypted_files/../encrypted_files/a b.enc'), 'a.bin')
+        self.assertEqual(response['X-Sendfile'], os.path.realpath(self.path('encrypted_files/a b.enc')))
+
+    @override_settings(DOWNLOAD_OFFLOAD=OFFLOAD_X_SENDFILE)
+    def test_paths_outside_media_root_are_never_offloaded(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside, ignore_errors=True)
+        with open(os.path.join(outside, 'secret'), 'wb') as f:
+            f.write(b'secret')
+        os.symlink(os.path.join(outside, 'secret'), self.path('link'))
+        for path in (os.path.join(outside, 'secret'), self.path('../' + os.path.basename(outside) + '/secret'),
+                     self.path('link'), self.path('missing.enc')):
+            with self.subTest(path=path):
+                self.assertIsNone(offloaded_file_response(path, 'a.bin'))
+
+    def download(self):
+        encrypted_file = EncryptedFile.objects.create(
+            original_filename='a.bin', file_size=10, status='COMPLETED', encrypted_file='encrypted_files/a b.enc')
+        return views.download_encrypted_file.__wrapped__(RequestFactory().get('/'), encrypted_file.pk)
+
+    @override_settings(DOWNLOAD_OFFLOAD=OFFLOAD_NONE)
+    def test_download_falls_back_to_streaming_without_offload(self):
+        response = self.download()
+        self.addCleanup(response.close)
+        self.assertNotIn('X-Sendfile', response)
+        self.assertEqual(b''.join(response.streaming_content), b'ciphertext')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="a.bin.enc"')
+
+    @override_settings(DOWNLOAD_OFFLOAD=OFFLOAD_X_SENDFILE)
+    def test_download_is_offloaded(self):
+        response = self.download()
+        self.assertFalse(response.streaming)
+        self.assertEqual(response['X-Sendfile'], os.path.realpath(self.path('encrypted_files/a b.enc')))
+
+
+class DirectoryTreeTests(TestCase):
+    def setUp(self):
+        # a/b/c, a/d and e
+        self.a = Directory.objects.create(name='a')
+        self.b = Directory.objects.create(name='b', parent=self.a)
+        self.c = Directory.objects.create(name='c', parent=self.b)
+        self.d = Directory.objects.create(name='d', parent=self.a)
+        self.e = Directory.objects.create(name='e')
+
+    def ids(self, subquery):
+        return set(Directory.objects.filter(pk__in=subquery).values_list('pk', flat=True))
+
+    def test_subtree_ids(self):
+        self.assertEqual(self.ids(self.a.subtree_ids()), {self.b.pk, self.c.pk, self.d.pk})
+        self.assertEqual(self.ids(self.a.subtree_ids(include_self=True)), {self.a.pk, self.b.pk, self.c.pk, self.d.pk})
+        self.assertEqual(self.ids(self.c.subtree_ids()), set())
+        Directory.objects.filter(pk=self.b.pk).update(mark_deleted=True)
+        # Everything below a deleted directory is skipped with it
+        self.assertEqual(self.ids(self.a.subtree_ids()), {self.d.pk})
+        self.assertEqual(self.ids(self.a.subtree_ids(include_deleted=True)), {self.b.pk, self.c.pk, self.d.pk})
+
+    def test_mark_for_deletion_marks_the_subtree(self):
+        earlier = now() - timedelta(days=3)
+        Directory.objects.filter(pk=self.c.pk).update(mark_deleted=True, mark_deleted_date=earlier)
+        inside = EncryptedFile.objects.create(original_filename='in.bin', file_size=0, directory=self.c)
+        outside = EncryptedFile.objects.create(original_filename='out.bin', file_size=0, directory=self.e)
+        self.a.mark_for_deletion()
+        deleted = set(Directory.objects.filter(mark_deleted=True).values_list('pk', flat=True))
+        self.assertEqual(deleted, {self.a.pk, self.b.pk, self.c.pk, self.d.pk})
+        self.assertTrue(EncryptedFile.objects.get(pk=inside.pk).mark_deleted)
+        self.assertFalse(EncryptedFile.objects.get(pk=outside.pk).mark_deleted)
+        # Rows deleted before keep their own date
+        self.assertEqual(Directory.objects.get(pk=self.c.pk).mark_deleted_date, earlier)
+        self.assertEqual(Directory.objects.get(pk=self.d.pk).mark_deleted_date, self.a.mark_deleted_date)
+
+    def test_paths(self):
+        self.assertEqual(get_directory_paths([self.c.pk, self.d.pk, self.e.pk, self.c.pk]),
+                         {self.c.pk: 'a/b/c', self.d.pk: 'a/d', self.e.pk: 'e'})
+        self.assertEqual(get_directory_paths([]), {})
+        self.assertEqual(get_subtree_paths(self.a), {self.a.pk: 'a', self.b.pk: 'a/b', self.c.pk: 'a/b/c',
+                                                     self.d.pk: 'a/d'})
+        self.assertEqual(list(get_subtree_paths()), [self.a.pk, self.e.pk, self.b.pk, self.d.pk, self.c.pk])
+
+    def test_cycle_in_corrupted_data_ends_the_walk(self):
+        Directory.objects.filter(pk=self.a.pk).update(parent=self.c)
+        self.assertEqual(self.ids(self.a.subtree_ids(include_self=True)), {self.a.pk, self.b.pk, self.c.pk, self.d.pk})
+        paths = get_directory_paths([self.c.pk])
+        self.assertEqual(len(paths[self.c.pk].split('/')), 3)
+        self.assertEqual(len(self.c.get_ancestors()), 3)
+        self.assertEqual(set(get_subtree_paths(self.a)), {self.a.pk, self.b.pk, self.c.pk, self.d.pk})
+
+
+class ListingPaginationTests(TestCase):
+    def setUp(self):
+        # Names and upload times repeat, so only the ID tells many rows apart
+        moment = now()
+        for i in range(7):
+            encrypted_file = EncryptedFile.objects.create(original_filename=f'{"ab"[i % 2]}.txt', file_size=0)
+            EncryptedFile.objects.filter(pk=encrypted_file.pk).update(upload_date=moment - timedelta(hours=i // 3))
+
+    def pages(self, sort, page_size):
+        ids, cursor = [], None
+        while True:
+            page = get_home_contents(sort=sort, cursor=cursor, page_size=page_size)
+            ids.extend(f.pk for f in page['files'])
+            cursor = page['next_cursor']
+            if cursor is None:
+                return ids
+
+    def test_pages_neither_repeat_nor_skip_files(self):
+        for sort in ('name', 'date'):
+            expected = list(EncryptedFile.objects.order_by(*LISTING_ORDER[sort]).values_list('pk', flat=True))
+            for page_size in (1, 2, 3, 7, 50):
+                with self.subTest(sort=sort, page_size=page_size):
+                    self.assertEqual(self.pages(sort, page_size), expected)
+
+    def test_cursor_round_trip(self):
+        first = EncryptedFile.objects.order_by('original_filename', 'id').first()
+        cursor = encode_listing_cursor(first, 'name')
+        after = EncryptedFile.objects.filter(decode_listing_cursor(cursor, 'name'))
+        self.assertEqual(after.count(), EncryptedFile.objects.count() - 1)
+
+    def test_bad_cursors_are_rejected(self):
+        def b64(value):
+            return base64.urlsafe_b64encode(value.encode()).decode()
+        for cursor, sort in (('not a cursor', 'name'), (b64('{"a": 1}'), 'name'), (b64('[1, 2, 3]'), 'name'),
+                             (b64('["a.txt", "x"]'), 'name'), (b64('["yesterday", 1]'), 'date'),
+                             (b64('not json'), 'date'), ('\u00e9', 'date')):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    decode_listing_cursor(cursor, sort)
+        with self.assertRaises(ValueError):
+            get_home_contents(sort='name', cursor='not a cursor')
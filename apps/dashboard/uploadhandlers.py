@@ -0,0 +1,128 @@
+import os
+import uuid
+from Crypto.Random import get_random_bytes
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+
+from .chunkstore import STORAGE_CHUNKED
+from .compression import COMPRESSION_NONE, CompressingWriter
+from .crypto import FORMAT_V2, KDF_HKDF, SALT_LENGTH, SegmentedEncryptor, get_file_key
+from .keyring import generate_data_key
+
+ENCRYPTED_FILES_DIR = 'encrypted_files'
+
+
+def encrypts_on_receive():
+    """
+    Whether uploads are encrypted as they arrive. Chunked storage needs the whole file to
+    deduplicate it, so it still goes through a temporary file and the encryption task.
+    """
+    return settings.ENCRYPT_ON_RECEIVE and settings.STORAGE_MODE != STORAGE_CHUNKED
+
+
+class EncryptedUploadedFile(UploadedFile):
+    """
+    An upload that was encrypted while it was received. Only its ciphertext exists, as a v2
+    container at `encrypted_name` under MEDIA_ROOT; `size` is the size of the plaintext.
+    """
+
+    def __init__(self, name, content_type, size, charset, content_type_extra, encrypted_name, encrypted_size,
+                 salt, nonce, compression, compressed_size, wrapped_data_key, master_key_version):
+        super().__init__(None, name, content_type, size, charset, content_type_extra)
+        self.encrypted_name = encrypted_name
+        self.encrypted_size = encrypted_size
+        self.salt = salt
+        self.nonce = nonce
+        self.compression = compression
+        self.compressed_size = compressed_size
+        self.wrapped_data_key = wrapped_data_key
+        self.master_key_version = master_key_version
+
+    def encryption_fields(self):
+        """
+        EncryptedFile fields describing the ciphertext.
+        """
+        return {
+            'encrypted_file': self.encrypted_name,
+            'file_size': self.encrypted_size,
+            'salt': self.salt,
+            'nonce': self.nonce,
+            'format_version': FORMAT_V2,
+            'kdf': KDF_HKDF,
+            'compression': self.compression,
+            'compressed_size': self.compressed_size,
+            'wrapped_data_key': self.wrapped_data_key,
+            'master_key_version': self.master_key_version,
+        }
+
+
+class EncryptingUploadHandler(FileUploadHandler):
+    """
+    Encrypts uploaded files chunk by chunk as they arrive from the request body, writing the
+    ciphertext straight to its final place under MEDIA_ROOT/encrypted_files. The plaintext
+    never touches the disk, and the encryption task only has to finalise the row.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.file = None
+        self.encrypted_names = []
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.encrypted_name = os.path.join(ENCRYPTED_FILES_DIR, f"{uuid.uuid4().hex}.enc")
+        self.encrypted_names.append(self.encrypted_name)
+        path = os.path.join(settings.MEDIA_ROOT, self.encrypted_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.salt = get_random_bytes(SALT_LENGTH)
+        data_key, self.wrapped_data_key, self.master_key_version = generate_data_key()
+        self.file = open(path, 'wb')
+        self.encryptor = SegmentedEncryptor(self.file, get_file_key(data_key, self.salt, KDF_HKDF), self.salt)
+        # Compress on the way in, unless the data turns out to be incompressible
+        self.writer = CompressingWriter(self.encryptor, settings.COMPRESSION_CODEC)
+        # This handler takes care of the file, the default ones must not spool it to memory or disk
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.writer.write(raw_data)
+        # Returning None keeps the plaintext from being passed to any other handler
+
+    def file_complete(self, file_size):
+        self.writer.close()
+        self.encryptor.close()
+        self.file.close()
+        return EncryptedUploadedFile(
+            self.file_name, self.content_type, file_size, self.charset, self.content_type_extra,
+            encrypted_name=self.encrypted_name,
+            encrypted_size=self.encryptor.bytes_written,
+            salt=self.salt,
+            nonce=self.encryptor.nonce_prefix,
+            compression=self.writer.codec,
+            compressed_size=self.writer.output_bytes if self.writer.codec != COMPRESSION_NONE else None,
+            wrapped_data_key=self.wrapped_data_key,
+            master_key_version=self.master_key_version,
+        )
+
+    def upload_interrupted(self):
+        if self.file:
+            self.file.close()
+            path = os.path.join(settings.MEDIA_ROOT, self.encrypted_name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def discard_unclaimed(self):
+        """
+        Removes ciphertext written during this request that no EncryptedFile ended up
+        referencing, e.g. because the form was invalid or the upload broke off.
+        """
+        from .models import EncryptedFile
+
+        if self.file:
+            self.file.close()
+        claimed = set(EncryptedFile.objects.filter(
+            encrypted_file__in=self.encrypted_names).values_list('encrypted_file', flat=True))
+        for name in self.encrypted_names:
+            path = os.path.join(settings.MEDIA_ROOT, name)
+            if name not in claimed and os.path.exists(path):
+                os.remove(path)
@@ -7,15 +7,27 @@ urlpatterns = [
     path('', views.index, name='index'),
     re_path('files/(?P<directory>.*)$', views.list_encrypted_files, name='list_encrypted_files'),
     path('file/<int:file_id>/', views.list_file_item, name='list_file_item'),
+    path('search/', views.search, name='search'),
     path('download/encrypted/<int:file_id>/', views.download_encrypted_file, name='download_encrypted'),
     path('decrypt/<int:file_id>/', views.decrypt_file, name='decrypt_file'),
     path('task_status/<int:file_id>/', views.check_task_status, name='check_task_status'),
+    path('status/', views.file_statuses, name='file_statuses'),
+    path('decrypt/cache_stats/', views.decrypt_cache_stats, name='decrypt_cache_stats'),
     path('download/<int:file_id>/', views.download_decrypted_file, name='download_decrypted_file'),
+    path('stream/<int:file_id>/', views.stream_decrypted_file, name='stream_decrypted_file'),
+    path('preview/<int:file_id>/', views.preview_file, name='preview_file'),
+    path('download/directory/<int:directory_id>/', views.download_directory, name='download_directory'),
 
     # forms
     path('create_directory_form/', views.create_directory_form, name='create_directory_form'),
     path('upload_file_form/', views.upload_file_form, name='upload_file_form'),
 
+    # resumable uploads
+    path('uploads/', views.start_resumable_upload, name='start_resumable_upload'),
+    path('uploads/<uuid:session_id>/', views.resumable_upload, name='resumable_upload'),
+    path('uploads/<uuid:session_id>/chunks/<int:index>/', views.put_upload_chunk, name='put_upload_chunk'),
+    path('uploads/<uuid:session_id>/complete/', views.complete_resumable_upload, name='complete_resumable_upload'),
+
     # file actions
     path('mark_file_for_deletion/<int:file_id>/', views.mark_file_for_deletion, name='mark_file_for_deletion'),
     path('mark_directory_for_deletion/<int:directory_id>/',
@@ -1,31 +1,89 @@
 # file_manager/views.py
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, Http404, JsonResponse, FileResponse
+from django.http import HttpResponse, Http404, JsonResponse, FileResponse, StreamingHttpResponse
 from django.conf import settings
 from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+import mimetypes
 import os
+import re
 import uuid  # For unique temporary filenames
 
-from .forms import EncryptFileForm, CreateDirectoryForm
-from .models import EncryptedFile, get_home_contents, Directory
-from .tasks import perform_encryption_task, perform_decryption_task  # Import our Celery tasks
+from .forms import EncryptFileForm, CreateDirectoryForm, CreateUploadSessionForm
+from .models import EncryptedFile, get_home_contents, Directory, UploadSession
+from .offload import offloaded_file_response
+from .events import file_snapshot, parse_file_ids
+from .decryptcache import (
+    STAT_HITS, STAT_JOINED, STAT_MISSES, acquire_decryption, cache_stats, cached_decryption, record, release_decryption,
+)
+from .search import search_vault
+from .inline import (
+    decrypt_inline, encrypt_upload_inline, finalize_resumable_upload_inline, finalize_upload_inline, runs_inline,
+)
+from .resumable import (
+    abort_upload, accepts_resumable_uploads, complete_upload, create_upload_session, upload_status, write_chunk,
+)
+from .tasks import perform_encryption_task, perform_decryption_task, finalize_encrypted_upload_task, queue_for_size  # Import our Celery tasks
+from .uploadhandlers import EncryptedUploadedFile, EncryptingUploadHandler, encrypts_on_receive
+from .ziparchive import ZIP_COMPRESSION_METHODS, directory_members, iter_zip
 from celery.result import AsyncResult  # To check task status
 from apps.security.permissions import is_authenticated
 
 
 @is_authenticated()
 def index(request):
-    return render(request, 'dashboard.html')
+    return render(request, 'dashboard.html', {'events_url': settings.EVENTS_URL})
 
 
+@csrf_exempt
 @is_authenticated()
 def upload_file_form(request):
+    # Upload handlers can only be changed before the request body is read, and the CSRF check
+    # reads it, so the check runs in _upload_file_form once the encrypting handler is in place
+    if request.method != 'POST' or not encrypts_on_receive():
+        return _upload_file_form(request)
+    handler = EncryptingUploadHandler(request)
+    request.upload_handlers.insert(0, handler)
+    try:
+        return _upload_file_form(request)
+    finally:
+        handler.discard_unclaimed()
+
+
+@csrf_protect
+def _upload_file_form(request):
     errors = []
     if request.method == 'POST':
         form = EncryptFileForm(request.POST, request.FILES)
         if form.is_valid():
             uploaded_file = form.cleaned_data['file']
             parent_directory = form.cleaned_data['parent_directory']
+            directory = Directory.objects.get(pk=parent_directory) if parent_directory else None
+
+            # Small files are finished in the request, sparing them the round trip through a worker
+            if isinstance(uploaded_file, EncryptedUploadedFile) and runs_inline(uploaded_file.size):
+                finalize_upload_inline(uploaded_file, directory)
+                return redirect('dashboard:list_encrypted_files', directory=parent_directory if parent_directory else '')
+            if not isinstance(uploaded_file, EncryptedUploadedFile) and runs_inline(uploaded_file.size):
+                try:
+                    encrypt_upload_inline(uploaded_file, directory)
+                except Exception as e:
+                    print(f"Inline encryption of {uploaded_file.name} failed: {e}")
+                    return JsonResponse({'success': False, 'message': 'File could not be encrypted.'}, status=500)
+                return redirect('dashboard:list_encrypted_files', directory=parent_directory if parent_directory else '')
+
+            if isinstance(uploaded_file, EncryptedUploadedFile):
+                # Encrypted while it was received, the task only has to finalise the entry
+                pending_file_entry = EncryptedFile.objects.create(
+                    original_filename=uploaded_file.name,
+                    original_file_size=uploaded_file.size,
+                    status='PENDING',
+                    directory=directory,
+                    **uploaded_file.encryption_fields(),
+                )
+                finalize_encrypted_upload_task.delay(pending_file_entry.pk)
+                return redirect('dashboard:list_encrypted_files', directory=parent_directory if parent_directory else '')
 
             # 1. Save the uploaded file temporarily to disk
             # Generate a unique temp filename to avoid clashes
@@ -50,11 +108,12 @@ def upload_file_form(request):
                 file_size=0,
                 salt=b'',
                 nonce=b'',
-                directory=Directory.objects.get(pk=parent_directory) if parent_directory else None,
+                directory=directory,
             )
 
-            # 3. Enqueue the encryption task to Celery
-            perform_encryption_task.delay(temp_file_path_absolute, pending_file_entry.pk)
+            # 3. Enqueue the encryption task to Celery, on the queue for the file's size
+            perform_encryption_task.apply_async((temp_file_path_absolute, pending_file_entry.pk),
+                                                queue=queue_for_size(uploaded_file.size))
 
             return redirect('dashboard:list_encrypted_files', directory=parent_directory if parent_directory else '')
         else:
@@ -62,6 +121,93 @@ def upload_file_form(request):
     return JsonResponse({'success': False, 'message': 'Invalid form submission.', 'errors': errors}, status=400)
 
 
+@is_authenticated()
+def start_resumable_upload(request):
+    """
+    Starts a resumable upload. The client then PUTs every chunk, in any order and in parallel,
+    can ask which chunks were committed after a dropped connection, and completes the upload.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method.'}, status=400)
+    if not accepts_resumable_uploads():
+        # The client falls back to the upload form, which stores the file as chunks
+        return JsonResponse({'success': False, 'resumable': False,
+                             'message': 'Resumable uploads are not available with chunked storage.'}, status=409)
+    form = CreateUploadSessionForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'success': False, 'message': 'Invalid form submission.', 'errors': form.errors}, status=400)
+    parent_directory = form.cleaned_data['parent_directory']
+    directory = get_object_or_404(Directory, pk=parent_directory) if parent_directory else None
+    session = create_upload_session(os.path.basename(form.cleaned_data['filename']), form.cleaned_data['size'],
+                                    directory)
+    response = JsonResponse({'success': True, **upload_status(session)}, status=201)
+    response['Location'] = reverse('dashboard:resumable_upload', args=[session.pk])
+    return response
+
+
+@is_authenticated()
+def resumable_upload(request, session_id):
+    """
+    GET reports the committed chunks and offset of an upload, DELETE aborts it.
+    """
+    session = get_object_or_404(UploadSession, pk=session_id)
+    if request.method == 'DELETE':
+        try:
+            abort_upload(session)
+        except UploadSession.DoesNotExist:
+            pass
+        return HttpResponse('', status=204)
+    if request.method in ('GET', 'HEAD'):
+        status = upload_status(session)
+        response = JsonResponse({'success': True, **status})
+        response['Upload-Offset'] = str(status['offset'])
+        response['Upload-Length'] = str(session.total_size)
+        response['Cache-Control'] = 'no-store'
+        return response
+    return JsonResponse({'success': False, 'message': 'Invalid request method.'}, status=400)
+
+
+@is_authenticated()
+def put_upload_chunk(request, session_id, index):
+    """
+    Receives one chunk of a resumable upload as the raw request body and encrypts it as it is read.
+    """
+    if request.method != 'PUT':
+        return JsonResponse({'success': False, 'message': 'Invalid request method.'}, status=400)
+    session = get_object_or_404(UploadSession, pk=session_id)
+    try:
+        written = write_chunk(session, index, request, session.data_key())
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+    except UploadSession.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'Upload was completed or aborted.'}, status=409)
+    return JsonResponse({'success': True, 'index': index, 'written': written}, status=201 if written else 200)
+
+
+@is_authenticated()
+def complete_resumable_upload(request, session_id):
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'message': 'Invalid request method.'}, status=400)
+    session = get_object_or_404(UploadSession, pk=session_id)
+    try:
+        encrypted_file = complete_upload(session)
+    except ValueError as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=409)
+    except UploadSession.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'Upload was completed or aborted.'}, status=409)
+    # Small files are finished in the request, sparing them the round trip through a worker
+    if runs_inline(encrypted_file.original_file_size):
+        finalize_resumable_upload_inline(encrypted_file)
+    else:
+        finalize_encrypted_upload_task.delay(encrypted_file.pk)
+    return JsonResponse({
+        'success': True,
+        'file': encrypted_file.serialize('json'),
+        'redirect': reverse('dashboard:list_encrypted_files',
+                            kwargs={'directory': encrypted_file.directory_id or ''}),
+    })
+
+
 @is_authenticated()
 def create_directory_form(request):
     if request.method == 'POST':
@@ -86,23 +232,46 @@ def create_directory_form(request):
 @is_authenticated()
 def list_encrypted_files(request, directory=None):
     try:
-        create_directory_form = CreateDirectoryForm()
-        upload_file_form = EncryptFileForm()
-        if directory:
-            create_directory_form.fields['parent_directory'].initial = directory
-            upload_file_form.fields['parent_directory'].initial = directory
-        return render(
-            request,
-            'file_manager/list_files.html',
-            {
-                'create_directory_form': create_directory_form,
-                'upload_file_form': upload_file_form,
-                'directory': directory,
-                'breadcrumbs': Directory.objects.get(pk=directory).get_breadcrumbs() if directory and int(directory) > 0 else [Directory(name='/', parent=None)],
-                **get_home_contents(directory=directory if directory is not None else '', sort='name')
-            })
-    except Directory.DoesNotExist:
+        contents = get_home_contents(directory=directory if directory is not None else '',
+                                     sort=request.GET.get('sort', 'name'), cursor=request.GET.get('cursor'))
+    except ValueError:
         raise Http404("Directory not found.")
+    if request.GET.get('cursor'):
+        # Infinite scroll asking for the next page of files
+        return render(request, 'file_manager/list_files_page.html', contents)
+    create_directory_form = CreateDirectoryForm()
+    upload_file_form = EncryptFileForm()
+    if directory:
+        create_directory_form.fields['parent_directory'].initial = directory
+        upload_file_form.fields['parent_directory'].initial = directory
+    return render(
+        request,
+        'file_manager/list_files.html',
+        {
+            'create_directory_form': create_directory_form,
+            'upload_file_form': upload_file_form,
+            'directory': directory,
+            **contents
+        })
+
+
+@is_authenticated()
+def search(request):
+    """
+    Finds files and directories by name anywhere in the vault. `?page=` loads further results
+    for infinite scroll; an empty query goes back to Home.
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        return list_encrypted_files(request, '0')
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        results = search_vault(query, page=page)
+    except ValueError as e:
+        return render(request, 'file_manager/search_results.html', {'query': query, 'error': str(e)})
+    if page > 1:
+        return render(request, 'file_manager/search_results_page.html', results)
+    return render(request, 'file_manager/search_results.html', results)
 
 
 @is_authenticated()
@@ -114,6 +283,13 @@ def list_file_item(request, file_id):
 @is_authenticated()
 def download_encrypted_file(request, file_id):
     encrypted_file_obj = get_object_or_404(EncryptedFile, id=file_id)
+    if not encrypted_file_obj.encrypted_file:
+        # Chunked files have no single encrypted blob to hand out
+        raise Http404("Encrypted file not found on disk.")
+    response = offloaded_file_response(encrypted_file_obj.encrypted_file.path,
+                                       f"{encrypted_file_obj.original_filename}.enc")
+    if response is not None:
+        return response
     try:
         response = FileResponse(open(encrypted_file_obj.encrypted_file.path, 'rb'))
         response['Content-Type'] = 'application/octet-stream'
@@ -127,16 +303,48 @@ def download_encrypted_file(request, file_id):
 def decrypt_file(request, file_id):
     encrypted_file_obj = get_object_or_404(EncryptedFile, id=file_id)
 
-    # Enqueue the decryption task
-    task = perform_decryption_task.delay(encrypted_file_obj.id)
-
-    # Update the file's Celery task ID and status for tracking
-    encrypted_file_obj.celery_task_id = task.id
-    encrypted_file_obj.status = 'PENDING_DECRYPTION'  # Or PROCESSING
-    encrypted_file_obj.save()
+    # v2 and chunked files are decrypted on the fly while downloading, no task or temp file needed,
+    # and so are files small enough to be decrypted in the request
+    if encrypted_file_obj.supports_ranges or runs_inline(encrypted_file_obj.file_size):
+        return render(request, 'file_manager/decrypt_status.html', {
+            'file_id': encrypted_file_obj.pk,
+            'stream_url': reverse('dashboard:stream_decrypted_file', args=[encrypted_file_obj.pk]),
+        })
+
+    # Hand out the copy decrypted earlier, if it is still around
+    if cached_decryption(encrypted_file_obj):
+        record(STAT_HITS)
+        return render(request, 'file_manager/decrypt_status.html', {
+            'file_id': encrypted_file_obj.pk,
+            'download_url': reverse('dashboard:download_decrypted_file', args=[encrypted_file_obj.pk]),
+        })
+
+    # Follow the decryption already running for this file, or enqueue one
+    task_id, started = acquire_decryption(encrypted_file_obj.pk, str(uuid.uuid4()))
+    if started:
+        record(STAT_MISSES)
+        previous_status, previous_task_id = encrypted_file_obj.status, encrypted_file_obj.celery_task_id
+        # Update the file's Celery task ID and status for tracking
+        encrypted_file_obj.celery_task_id = task_id
+        encrypted_file_obj.status = 'PENDING_DECRYPTION'  # Or PROCESSING
+        encrypted_file_obj.save()
+        try:
+            perform_decryption_task.apply_async((encrypted_file_obj.id,), task_id=task_id,
+                                                queue=queue_for_size(encrypted_file_obj.file_size))
+        except Exception as e:
+            # Nothing will ever run the task, so don't leave the file claimed and pending
+            print(f"Could not enqueue decryption of {encrypted_file_obj.original_filename}: {e}")
+            release_decryption(encrypted_file_obj.pk, task_id)
+            encrypted_file_obj.status, encrypted_file_obj.celery_task_id = previous_status, previous_task_id
+            encrypted_file_obj.save(update_fields=['status', 'celery_task_id'])
+            return JsonResponse({'success': False, 'message': 'Decryption could not be started, try again later.'},
+                                status=503)
+    else:
+        record(STAT_JOINED)
 
     return render(request, 'file_manager/decrypt_status.html', {
-        'task_id': task.id,
+        'events_url': settings.EVENTS_URL,
+        'task_id': task_id,
         'file_id': encrypted_file_obj.pk
     })
 
@@ -171,6 +379,10 @@ def check_task_status(request, file_id):
                 return JsonResponse({'status': task.state, 'message': result.get('message', 'Task failed'), 'success': False, 'file': file})
         elif task.state == 'FAILURE':
             return JsonResponse({'status': task.state, 'message': str(task.info), 'success': False, 'file': file})
+        elif task.state == 'PROGRESS':
+            # Bytes processed, MB/s and ETA reported by the task
+            return JsonResponse({'status': task.state, 'message': 'Processing...', 'success': None, 'file': None,
+                                 'progress': task.info})
         else:
             # PENDING, STARTED, RETRY, etc.
             return JsonResponse({'status': task.state, 'message': 'Processing...', 'success': None, 'file': file})
@@ -178,6 +390,23 @@ def check_task_status(request, file_id):
         return JsonResponse({'status': task.state, 'message': 'Task is still processing.', 'success': None, 'file': None})
 
 
+@is_authenticated()
+def decrypt_cache_stats(request):
+    """
+    Hit and miss counts of the decrypted-file cache, and how much of its budget is in use.
+    """
+    return JsonResponse(cache_stats())
+
+
+@is_authenticated()
+def file_statuses(request):
+    """
+    Status of every file in `?ids=1,2,3`, read with one query. Pages that can't keep an event
+    stream open refresh all of their pending files with it.
+    """
+    return JsonResponse({'files': list(file_snapshot(parse_file_ids(request.GET.get('ids'))).values())})
+
+
 @is_authenticated()
 def download_decrypted_file(request, file_id):
     encrypted_file_instance = get_object_or_404(EncryptedFile, id=file_id)
@@ -188,39 +417,155 @@ def download_decrypted_file(request, file_id):
         # File not decrypted yet, or already cleaned up, or never existed
         return HttpResponse("File not ready for download or already removed.", status=404)
 
+    # The file stays for repeated downloads until expire_decrypted_files_task removes it
+    response = offloaded_file_response(decrypted_file_path, encrypted_file_instance.original_filename)
+    if response is not None:
+        return response
+
     # Use FileResponse for efficient serving of large files
     response = FileResponse(open(decrypted_file_path, 'rb'))
     response['Content-Type'] = 'application/octet-stream'  # Or guess based on filename
     response['Content-Disposition'] = f'attachment; filename="{encrypted_file_instance.original_filename}"'
+    return response
+
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _guess_content_type(filename, inline=False):
+    """
+    Content type for a decrypted file. Shown inline, markup and scripts are served as plain text
+    so an uploaded page can never run on our origin.
+    """
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if inline and (content_type.startswith('text/') or content_type == 'image/svg+xml'):
+        return 'text/plain; charset=utf-8'
+    return content_type
+
+
+def _parse_range_header(range_header, size):
+    """
+    Parses a single-range `Range` header into an inclusive (start, end) byte pair.
+
+    Returns None when the header should be ignored (missing, malformed or multi-range),
+    and raises ValueError when the range cannot be satisfied.
+    """
+    match = _RANGE_RE.match(range_header.strip()) if range_header else None
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: the last N bytes
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            raise ValueError("Unsatisfiable range.")
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range.")
+    return start, end
 
-    # Optional: Clean up the temporary decrypted file immediately after serving
-    # Be cautious with this if a user might try to download multiple times quickly
-    # A better approach for cleanup might be a Celery Beat task.
-    # For now, this ensures it's deleted after the first download attempt.
-    # (Note: FileResponse might keep the file handle open for a while,
-    # so deletion here might fail or happen later. A post-response hook or Celery Beat is more robust)
-
-    # You might want to update the model status here to indicate download started/completed
-    # encrypted_file_instance.status = 'DOWNLOADED' # Or some other final status
-    # encrypted_file_instance.decrypted_temp_path = None # Clear the path
-    # encrypted_file_instance.save()
-
-    # For robust cleanup: Use a callback or a separate task.
-    # A simple way for immediate cleanup after the response is sent:
-    # This requires `django.core.servers.basehttp.WSGIRequestHandler` to handle `close()`
-    # For production, consider `mod_xsendfile` or similar server-level solutions.
-    def file_cleanup():
-        if os.path.exists(decrypted_file_path):
-            os.remove(decrypted_file_path)
-            # You might want to update the model status and clear path here too
-            # This runs *after* the response is sent and file read
-            encrypted_file_instance.decrypted_temp_path = None
-            encrypted_file_instance.status = 'COMPLETED'  # Assuming download marks completion
-            encrypted_file_instance.save()
-
-    response.streaming = True  # Ensure it's streamed
-    response.close = file_cleanup  # Attach cleanup callback
 
+@is_authenticated()
+def stream_decrypted_file(request, file_id):
+    """
+    Decrypts a file on the fly and streams it to the client, honouring Range/If-Range for v2
+    and chunked files. No plaintext is written to disk.
+    """
+    encrypted_file_obj = get_object_or_404(EncryptedFile, id=file_id)
+    if not encrypted_file_obj.has_stored_content():
+        raise Http404("Encrypted file not found on disk.")
+    supports_ranges = encrypted_file_obj.supports_ranges
+    if not supports_ranges and not runs_inline(encrypted_file_obj.file_size):
+        # A large v1 file is only authenticated once all of it has been read, so it must never be
+        # streamed; the decryption task verifies it before it can be downloaded
+        return redirect('dashboard:decrypt_file', file_id=encrypted_file_obj.pk)
+    size = encrypted_file_obj.get_plaintext_size()
+    etag = f'"{encrypted_file_obj.pk}-{bytes(encrypted_file_obj.nonce or b"").hex()}"'
+
+    byte_range = None
+    if supports_ranges and request.META.get('HTTP_IF_RANGE', etag) == etag:
+        try:
+            byte_range = _parse_range_header(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    start, end = byte_range if byte_range else (0, size - 1)
+    if not supports_ranges:
+        # Decrypted whole first, so a v1 file is authenticated before any of it is sent
+        try:
+            stream = [decrypt_inline(encrypted_file_obj)]
+        except ValueError:
+            return HttpResponse("File failed its integrity check.", status=500)
+    else:
+        stream = encrypted_file_obj.iter_plaintext(
+            start=start,
+            end=end + 1 if byte_range else None,
+        )
+    inline = bool(request.GET.get('inline'))
+    response = StreamingHttpResponse(stream, status=206 if byte_range else 200)
+    response['Content-Type'] = _guess_content_type(encrypted_file_obj.original_filename, inline)
+    response['Content-Length'] = str(end - start + 1)
+    disposition = 'inline' if inline else 'attachment'
+    response['Content-Disposition'] = f'{disposition}; filename="{encrypted_file_obj.original_filename}"'
+    response['X-Content-Type-Options'] = 'nosniff'
+    response['Accept-Ranges'] = 'bytes' if supports_ranges else 'none'
+    if supports_ranges:
+        response['ETag'] = etag
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
+
+
+@is_authenticated()
+def preview_file(request, file_id):
+    """
+    Streams the first bytes (or a `start`/`length` window) of a text, image or PDF file
+    for display in the browser, decrypting at most PREVIEW_MAX_BYTES.
+    """
+    encrypted_file_obj = get_object_or_404(EncryptedFile, id=file_id)
+    if not encrypted_file_obj.has_stored_content():
+        raise Http404("Encrypted file not found on disk.")
+    # Never let the browser render uploaded markup or scripts on our origin
+    content_type = _guess_content_type(encrypted_file_obj.original_filename, inline=True)
+    if (not content_type.startswith('text/plain') and not content_type.startswith('image/')
+            and content_type != 'application/pdf'):
+        return JsonResponse({'success': False, 'message': 'Preview is not available for this file type.'}, status=415)
+    try:
+        start = max(int(request.GET.get('start', 0)), 0)
+        length = min(max(int(request.GET.get('length', settings.PREVIEW_MAX_BYTES)), 0), settings.PREVIEW_MAX_BYTES)
+    except ValueError:
+        return JsonResponse({'success': False, 'message': 'Invalid preview window.'}, status=400)
+
+    size = encrypted_file_obj.get_plaintext_size()
+    stream = encrypted_file_obj.iter_preview(start, length, settings.PREVIEW_MAX_BYTES)
+    response = StreamingHttpResponse(stream, content_type=content_type)
+    response['Content-Length'] = str(max(min(size, start + length) - start, 0))
+    response['Content-Disposition'] = f'inline; filename="{encrypted_file_obj.original_filename}"'
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+
+@is_authenticated()
+def download_directory(request, directory_id):
+    """
+    Streams a ZIP of a directory and everything below it, decrypted on the fly.
+    Directory 0 is Home, i.e. the whole vault. `?compression=store|deflate` overrides ZIP_COMPRESSION.
+    """
+    compression = request.GET.get('compression', settings.ZIP_COMPRESSION)
+    if compression not in ZIP_COMPRESSION_METHODS:
+        return JsonResponse({'success': False, 'message': 'Invalid compression.'}, status=400)
+    directory_obj = None
+    if directory_id != 0:
+        directory_obj = get_object_or_404(Directory, id=directory_id, mark_deleted=False)
+    members = directory_members(directory_obj)
+    response = StreamingHttpResponse(iter_zip(members, compression), content_type='application/zip')
+    response['Content-Disposition'] = f'attachment; filename="{directory_obj.name if directory_obj else "Home"}.zip"'
+    # Keep nginx from buffering the archive to disk
+    response['X-Accel-Buffering'] = 'no'
     return response
 
 
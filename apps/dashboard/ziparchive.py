@@ -0,0 +1,214 @@
+import queue
+import threading
+import zipfile
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connection
+from django.utils.timezone import localtime
+
+ZIP_STORE = 'store'
+ZIP_DEFLATE = 'deflate'
+ZIP_COMPRESSION_METHODS = {
+    ZIP_STORE: zipfile.ZIP_STORED,
+    ZIP_DEFLATE: zipfile.ZIP_DEFLATED,
+}
+ZIP_READY_STATUSES = ('COMPLETED', 'DECRYPTING', 'DECRYPTED')  # the encrypted content is complete
+
+# A file or directory in the archive. `chunks` is a callable returning an iterator of the
+# member's bytes, or None for a directory entry. `size` may be None when it isn't known up front.
+ZipMember = namedtuple('ZipMember', ['name', 'size', 'date_time', 'chunks'])
+
+_END = object()
+
+
+class _ArchiveBuffer:
+    """
+    Write-only sink for zipfile. Having no seek() or tell(), it makes zipfile write sizes in data
+    descriptors after each member instead of seeking back, so the archive can be sent as it is built.
+    """
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+class _Prefetch:
+    """
+    Decrypts one member on a pool thread into a queue of at most `max_chunks` chunks, so it can
+    run ahead of the archive without holding more than that in memory.
+    """
+
+    def __init__(self, executor, member, max_chunks, cancelled):
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.cancelled = cancelled
+        self.future = executor.submit(self._run, member)
+
+    def _put(self, item):
+        # Time out now and then, so a producer blocked on a full queue notices the download was dropped
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, member):
+        chunks = None
+        try:
+            if self.cancelled.is_set():
+                return
+            chunks = member.chunks()
+            for chunk in chunks:
+                if not self._put(chunk):
+                    return
+            self._put(_END)
+        except Exception as e:
+            self._put(e)
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+            # Chunked files read their chunk list from the database; pool threads are never
+            # recycled by Django, so their connections would stay open for good
+            connection.close()
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def _zip_info(member, compress_type):
+    info = zipfile.ZipInfo(member.name, date_time=member.date_time)
+    info.compress_type = compress_type if member.chunks is not None else zipfile.ZIP_STORED
+    if member.chunks is None:
+        info.external_attr = 0o40755 << 16 | 0x10  # MS-DOS directory flag
+    else:
+        info.external_attr = 0o644 << 16
+        info.file_size = member.size or 0
+    return info
+
+
+def iter_zip(members, compression=None, workers=None, prefetch_chunks=None):
+    """
+    Yields a ZIP archive of `members` piece by piece, without building it in memory or on disk.
+    While one member is written, the next `workers` members are already being decrypted on a
+    thread pool, each holding at most `prefetch_chunks` chunks, so memory stays flat however
+    large the archive. Closing the generator (the client went away) stops the pool.
+
+    Args:
+        members: Iterable of ZipMember, in archive order.
+        compression: 'store' or 'deflate', defaults to ZIP_COMPRESSION.
+        workers: Members decrypted ahead, defaults to ZIP_WORKERS.
+        prefetch_chunks: Chunks buffered per member, defaults to ZIP_PREFETCH_CHUNKS.
+    """
+    compress_type = ZIP_COMPRESSION_METHODS[compression or settings.ZIP_COMPRESSION]
+    workers = workers or settings.ZIP_WORKERS
+    prefetch_chunks = prefetch_chunks or settings.ZIP_PREFETCH_CHUNKS
+    members = iter(members)
+    pending = deque()
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    buffer = _ArchiveBuffer()
+
+    def fill():
+        while len(pending) < workers + 1:
+            member = next(members, None)
+            if member is None:
+                return
+            pending.append((member, _Prefetch(executor, member, prefetch_chunks, cancelled)
+                            if member.chunks is not None else None))
+
+    try:
+        archive = zipfile.ZipFile(buffer, 'w', compression=compress_type, allowZip64=True)
+        fill()
+        while pending:
+            member, prefetch = pending.popleft()
+            fill()
+            info = _zip_info(member, compress_type)
+            if prefetch is None:
+                archive.writestr(info, b'')
+            else:
+                # Without a known size the entry has to be ZIP64 up front, in case it passes 4 GB
+                with archive.open(info, 'w', force_zip64=member.size is None) as entry:
+                    for chunk in prefetch:
+                        entry.write(chunk)
+                        data = buffer.drain()
+                        if data:
+                            yield data
+            yield buffer.drain()
+        # The central directory is only sent once every member went through, so a member that
+        # failed to decrypt leaves an archive that won't open rather than one silently truncated
+        archive.close()
+        yield buffer.drain()
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _unique_name(name, used):
+    if name not in used:
+        used.add(name)
+        return name
+    stem, dot, extension = name.rpartition('.')
+    if not stem or '/' in extension:
+        stem, dot, extension = name, '', ''
+    count = 1
+    while f"{stem} ({count}){dot}{extension}" in used:
+        count += 1
+    name = f"{stem} ({count}){dot}{extension}"
+    used.add(name)
+    return name
+
+
+def _zip_date_time(value):
+    # ZIP timestamps can't go before 1980
+    return max(localtime(value).timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+def directory_members(directory):
+    """
+    ZIP members for a directory subtree (None for the whole vault): one directory entry per
+    directory, so empty ones survive, and every file whose encrypted content is complete.
+    Directories and files are each read with a single query; nothing is decrypted until the
+    members are iterated.
+
+    Returns:
+        list: ZipMember objects, directories before their contents.
+    """
+    from .models import EncryptedFile, get_subtree_paths
+
+    paths = get_subtree_paths(directory)
+    members = [ZipMember(path + '/', 0, (1980, 1, 1, 0, 0, 0), None) for path in paths.values()]
+    files = EncryptedFile.objects.filter(mark_deleted=False, status__in=ZIP_READY_STATUSES)
+    if directory is None:
+        files = files.filter(directory__isnull=True) | files.filter(directory_id__in=paths.keys())
+    else:
+        files = files.filter(directory_id__in=paths.keys())
+    used = {member.name for member in members}
+    for file in files.order_by('directory_id', 'original_filename', 'pk'):
+        prefix = paths[file.directory_id] + '/' if file.directory_id else ''
+        members.append(ZipMember(
+            _unique_name(prefix + file.original_filename.replace('/', '_'), used),
+            file.original_file_size,
+            _zip_date_time(file.upload_date),
+            lambda file=file: file.iter_plaintext(),
+        ))
+    return members
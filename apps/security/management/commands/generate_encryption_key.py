@@ -1,5 +1,6 @@
 from Crypto.Random import get_random_bytes
 from django.core.management.base import BaseCommand, CommandParser
+from django.db.models import Q
 from core.settings import BASE_DIR
 
 
@@ -22,6 +23,22 @@ class Command(BaseCommand):
         if KEY_PATH.exists() and not kwargs['force']:
             self.stdout.write("Encryption key file already exists.")
             return
+        if KEY_PATH.exists() and self.files_using_key():
+            # This key is master key version 0: replacing it would make those files unreadable
+            self.stdout.write("Encryption key is still in use by stored files. "
+                              "Use `rotate_master_key` to move them to a new master key.")
+            return
         with open(KEY_PATH, 'wb') as f:
             f.write(get_random_bytes(32))
         self.stdout.write("Key generated successfully.")
+
+    def files_using_key(self):
+        from apps.dashboard.chunkstore import STORAGE_CHUNKED
+        from apps.dashboard.models import ChunkStoreKey, EncryptedFile, UploadSession
+
+        legacy = Q(wrapped_data_key__isnull=True) | Q(master_key_version=0)
+        chunk_store_legacy = (ChunkStoreKey.objects.filter(master_key_version=0).exists()
+                              or not ChunkStoreKey.objects.exists())
+        return (EncryptedFile.objects.filter(legacy).exclude(storage_mode=STORAGE_CHUNKED).exists()
+                or UploadSession.objects.filter(legacy).exists()
+                or (chunk_store_legacy and EncryptedFile.objects.filter(storage_mode=STORAGE_CHUNKED).exists()))
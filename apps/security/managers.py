@@ -5,6 +5,8 @@ from django.utils.timezone import now
 import hashlib
 from secrets import token_urlsafe
 
+from .sessioncache import cache_session, cached_session, invalidate_sessions
+
 
 class SessionManager(models.Manager):
     """Manages the session
@@ -29,13 +31,15 @@ class SessionManager(models.Manager):
                 tuple(key: str, session: Session)
         """
         # Disable previous sessions
-        self.filter(is_valid=True).update(is_valid=False)
+        self.filter(is_valid=True).update(is_valid=False, updated_at=now())
         # Create a new session
         key = token_urlsafe(64)
         session = self.create(
             key=hash_this(key),
             expire_at=now() + timedelta(seconds=self.KEY_EXPIRE_IN_SECONDS)
         )
+        # Previous sessions may still be cached as valid
+        invalidate_sessions()
         return urlsafe_base64_encode(key.encode("ascii")), session
 
     def delete_session(self, session_id):
@@ -50,13 +54,15 @@ class SessionManager(models.Manager):
                 session.is_valid = False
                 session.updated_at = now()
                 session.save()
+                invalidate_sessions()
                 return True
         except Exception as e:
             return False
         return False
 
     def authenticate_session(self, key):
-        """This function authenticates a user request
+        """This function authenticates a user request.
+        Sessions found valid are cached for SESSION_CACHE_SECONDS, see sessioncache.
 
         Args:
                 key (str): Session key
@@ -65,9 +71,12 @@ class SessionManager(models.Manager):
                 Session or None
         """
         try:
-            key = urlsafe_base64_decode(key).decode("ascii")
+            hashed_key = hash_this(urlsafe_base64_decode(key).decode("ascii"))
+            session, generation = cached_session(hashed_key)
+            if session is not None:
+                return session
             session = self.get(
-                key=hash_this(key),
+                key=hashed_key,
                 is_valid=True
             )
             if session.expire_at < now():
@@ -75,10 +84,22 @@ class SessionManager(models.Manager):
                 session.updated_at = now()
                 session.save()
                 return None
+            cache_session(hashed_key, session, generation)
             return session
         except Exception as e:
             return None
 
+    def purge_dead_sessions(self, older_than_days):
+        """Deletes sessions that were invalidated or expired more than `older_than_days` ago.
+
+        Returns:
+                int: Number of sessions deleted
+        """
+        cutoff = now() - timedelta(days=older_than_days)
+        count, _ = self.filter(
+            models.Q(is_valid=False, updated_at__lt=cutoff) | models.Q(expire_at__lt=cutoff)).delete()
+        return count
+
     def get_session_if_valid(self, session_id):
         """Get session if it is valid and not expired.
 
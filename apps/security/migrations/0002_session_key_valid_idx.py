@@ -0,0 +1,17 @@
+# Generated by Django 5.2.9 on 2026-10-18 20:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('security', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['key', 'is_valid'], name='session_key_valid_idx'),
+        ),
+    ]
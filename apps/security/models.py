@@ -14,6 +14,9 @@ class Session(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['key', 'is_valid'], name='session_key_valid_idx'),
+        ]
 
     manage = SessionManager()
 
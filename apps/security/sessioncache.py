@@ -0,0 +1,68 @@
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+
+# Sessions that passed authentication are kept in the cache for SESSION_CACHE_SECONDS, so most
+# requests are authenticated with one cache read instead of a database query. Every entry records
+# the generation it was cached in; logging in or out starts a new generation, which turns all
+# earlier entries into misses at once. The cache only saves queries: if it is unreachable, sessions
+# are authenticated against the database alone rather than everyone being logged out.
+SESSION_KEY = 'session:{}'
+GENERATION_KEY = 'session-generation'
+
+
+def _new_generation():
+    return uuid.uuid4().hex
+
+
+def cached_session(hashed_key):
+    """
+    The session cached for `hashed_key` in the current generation, or None.
+
+    Returns:
+        tuple: (session, generation). Pass the generation to cache_session() after a miss.
+    """
+    entry_key = SESSION_KEY.format(hashed_key)
+    try:
+        values = cache.get_many([GENERATION_KEY, entry_key])
+        generation = values.get(GENERATION_KEY)
+        if generation is None:
+            # Never cache against a missing generation, or an entry could outlive an invalidation
+            cache.add(GENERATION_KEY, _new_generation(), timeout=None)
+            return None, None
+    except Exception as e:
+        print(f"Session cache unavailable, authenticating against the database: {e}")
+        return None, None
+    entry = values.get(entry_key)
+    if entry is None or entry[0] != generation:
+        return None, generation
+    session = entry[1]
+    if session.expire_at < now():
+        return None, generation
+    return session, generation
+
+
+def cache_session(hashed_key, session, generation):
+    """
+    Caches a session that was just authenticated against the database, never past its expiry.
+    """
+    if generation is None:
+        return
+    timeout = min(settings.SESSION_CACHE_SECONDS, int((session.expire_at - now()).total_seconds()))
+    if timeout > 0:
+        try:
+            cache.set(SESSION_KEY.format(hashed_key), (generation, session), timeout=timeout)
+        except Exception as e:
+            print(f"Could not cache session: {e}")
+
+
+def invalidate_sessions():
+    """
+    Drops every cached session. Called whenever a session is created or invalidated.
+    If the cache is unreachable, entries it still holds lapse within SESSION_CACHE_SECONDS.
+    """
+    try:
+        cache.set(GENERATION_KEY, _new_generation(), timeout=None)
+    except Exception as e:
+        print(f"Could not invalidate cached sessions: {e}")
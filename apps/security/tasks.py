@@ -0,0 +1,14 @@
+from celery import shared_task
+from django.conf import settings
+
+from .models import Session
+
+
+@shared_task(ignore_result=True)
+def purge_dead_sessions_task():
+    """
+    Periodic task that deletes sessions invalidated or expired more than SESSION_RETENTION_DAYS ago.
+    """
+    count = Session.manage.purge_dead_sessions(settings.SESSION_RETENTION_DAYS)
+    if count:
+        print(f"Celery: Purged {count} dead sessions")
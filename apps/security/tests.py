@@ -1,3 +1,22 @@
+from unittest import mock
 from django.test import TestCase
 
-# Create your tests here.
+from .models import Session
+
+
+class SessionCacheOutageTests(TestCase):
+    def setUp(self):
+        cache = mock.patch('apps.security.sessioncache.cache')
+        self.cache = cache.start()
+        self.addCleanup(cache.stop)
+        for method in ('get_many', 'add', 'set'):
+            getattr(self.cache, method).side_effect = ConnectionError("cache is down")
+
+    def test_login_and_requests_fall_back_to_the_database(self):
+        key, session = Session.manage.create_session(None)
+        self.assertEqual(Session.manage.authenticate_session(key), session)
+
+    def test_logout_still_takes_effect(self):
+        key, session = Session.manage.create_session(None)
+        self.assertTrue(Session.manage.delete_session(session.pk))
+        self.assertIsNone(Session.manage.authenticate_session(key))
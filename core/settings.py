@@ -18,6 +18,124 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = config('TIMEZONE', default='America/Vancouver')  # Or your local timezone
 
+# Tasks are spread over queues, each served by its own workers (docker/supervisor.conf), so small jobs never wait
+# behind large ones: files of LARGE_FILE_THRESHOLD bytes or more go to 'large', scrubbing and purging to 'maintenance'.
+# The decrypted file sweeps stay on 'small', as they are due every few minutes and would wait behind a scrub
+CELERY_TASK_DEFAULT_QUEUE = 'small'
+LARGE_FILE_QUEUE = 'large'
+MAINTENANCE_QUEUE = 'maintenance'
+LARGE_FILE_THRESHOLD = config('LARGE_FILE_THRESHOLD', default=64 * 1024 * 1024, cast=int)
+CELERY_TASK_ROUTES = {
+    'apps.dashboard.tasks.schedule_integrity_scrub': {'queue': MAINTENANCE_QUEUE},
+    'apps.dashboard.tasks.scrub_integrity_task': {'queue': MAINTENANCE_QUEUE},
+    'apps.dashboard.tasks.purge_abandoned_uploads_task': {'queue': MAINTENANCE_QUEUE},
+    'apps.security.tasks.purge_dead_sessions_task': {'queue': MAINTENANCE_QUEUE},
+}
+# Set per worker: with acks_late a task interrupted by a restart is run again instead of lost
+CELERY_TASK_ACKS_LATE = config('CELERY_TASK_ACKS_LATE', default=False, cast=bool)
+# Redis hands an unacknowledged task to another worker after this many seconds, so it must outlast the longest task
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'visibility_timeout': config('CELERY_VISIBILITY_TIMEOUT', default=12 * 60 * 60, cast=int),
+}
+
+# Shared between web processes, holds the decryption locks and cache counters
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': str(config('REDIS', default=os.environ.get('REDIS'))) + "/2",
+    }
+}
+
+# Task status is pushed to browsers over Server-Sent Events from the ASGI app (core/asgi.py, run by uvicorn).
+# Route EVENTS_URL to it in the front server; pages fall back to polling the batch status endpoint without it
+EVENTS_URL = config('EVENTS_URL', default='/dashboard/events/')
+EVENTS_REDIS_URL = str(config('REDIS', default=os.environ.get('REDIS'))) + "/3"
+EVENTS_MAX_FILES = config('EVENTS_MAX_FILES', default=200, cast=int)  # files one stream or status request may watch
+EVENTS_STREAM_MAX_SECONDS = config('EVENTS_STREAM_MAX_SECONDS', default=600, cast=int)  # browsers reconnect after this
+TASK_PROGRESS_INTERVAL = config('TASK_PROGRESS_INTERVAL', default=1.0, cast=float)  # seconds between progress reports of a task
+
+# Files at least this large (in bytes) are encrypted/decrypted across a pool of workers
+PARALLEL_CRYPTO_THRESHOLD = config('PARALLEL_CRYPTO_THRESHOLD', default=256 * 1024 * 1024, cast=int)
+PARALLEL_CRYPTO_WORKERS = config('PARALLEL_CRYPTO_WORKERS', default=os.cpu_count() or 1, cast=int)
+PARALLEL_CRYPTO_EXECUTOR = config('PARALLEL_CRYPTO_EXECUTOR', default='thread')  # 'thread' or 'process'
+
+# Files up to this size (in bytes) are encrypted and decrypted in the request instead of by a Celery task, 0 to always use tasks
+INLINE_CRYPTO_MAX_BYTES = config('INLINE_CRYPTO_MAX_BYTES', default=1024 * 1024, cast=int)
+
+# Encrypt uploads as they arrive, so plaintext is never written to disk (not used with chunked storage)
+ENCRYPT_ON_RECEIVE = config('ENCRYPT_ON_RECEIVE', default=True, cast=bool)
+
+# Resumable uploads: plaintext bytes per chunk (rounded to 1 MB segments), and how long an idle session is kept
+UPLOAD_CHUNK_SIZE = config('UPLOAD_CHUNK_SIZE', default=8 * 1024 * 1024, cast=int)
+UPLOAD_SESSION_TTL_HOURS = config('UPLOAD_SESSION_TTL_HOURS', default=24, cast=int)
+
+# Map encrypted files into memory when decrypting them to disk, instead of reading them into a buffer
+CRYPTO_USE_MMAP = config('CRYPTO_USE_MMAP', default=False, cast=bool)
+
+# Let the front server send downloads with sendfile() once Django has authorised them: 'none' (Django streams),
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache mod_xsendfile, lighttpd, or uWSGI through docker/uwsgi.ini)
+DOWNLOAD_OFFLOAD = config('DOWNLOAD_OFFLOAD', default='none')
+DOWNLOAD_OFFLOAD_PREFIX = config('DOWNLOAD_OFFLOAD_PREFIX', default='/protected/')  # internal nginx location aliasing MEDIA_ROOT
+
+# Compress files before encryption: 'none', 'zlib' or 'lzma'. Already-compressed data is detected and stored as is
+COMPRESSION_CODEC = config('COMPRESSION_CODEC', default='none')
+
+# Store files as one encrypted blob ('blob') or as deduplicated, content-defined chunks ('chunked'). Chunked storage
+# saves space on repeated data but costs CPU to find chunk boundaries, far more without numpy installed
+STORAGE_MODE = config('STORAGE_MODE', default='blob')
+
+# Most plaintext (in bytes) a single preview request may decrypt and hold in memory
+PREVIEW_MAX_BYTES = config('PREVIEW_MAX_BYTES', default=8 * 1024 * 1024, cast=int)
+
+# Files shown per page of a directory listing or search results; further pages load as the list is scrolled
+LISTING_PAGE_SIZE = config('LISTING_PAGE_SIZE', default=100, cast=int)
+SEARCH_PAGE_SIZE = config('SEARCH_PAGE_SIZE', default=50, cast=int)
+
+# Folder downloads are streamed as ZIP archives: 'store' or 'deflate'. The next ZIP_WORKERS files are decrypted
+# ahead of the one being sent, each holding at most ZIP_PREFETCH_CHUNKS decrypted chunks in memory
+ZIP_COMPRESSION = config('ZIP_COMPRESSION', default='store')
+ZIP_WORKERS = config('ZIP_WORKERS', default=2, cast=int)
+ZIP_PREFETCH_CHUNKS = config('ZIP_PREFETCH_CHUNKS', default=4, cast=int)
+
+# Background integrity scrub: every stored file is re-read and its GCM tags verified
+SCRUB_BYTES_PER_SECOND = config('SCRUB_BYTES_PER_SECOND', default=16 * 1024 * 1024, cast=int)  # shared by all shards
+SCRUB_REVERIFY_DAYS = config('SCRUB_REVERIFY_DAYS', default=30, cast=int)
+SCRUB_SHARDS = config('SCRUB_SHARDS', default=1, cast=int)  # ID ranges verified in parallel, one maintenance process each
+SCRUB_INTERVAL = config('SCRUB_INTERVAL', default=60 * 60, cast=int)  # seconds between scrub runs
+
+# Decrypted files are removed this long after decryption; the sweep runs every DECRYPTED_SWEEP_INTERVAL seconds
+DECRYPTED_FILE_TTL_MINUTES = config('DECRYPTED_FILE_TTL_MINUTES', default=60, cast=int)
+DECRYPTED_SWEEP_INTERVAL = config('DECRYPTED_SWEEP_INTERVAL', default=5 * 60, cast=int)
+# Decrypted files are reused until they expire; least recently used ones are evicted beyond this many bytes
+DECRYPTED_CACHE_MAX_BYTES = config('DECRYPTED_CACHE_MAX_BYTES', default=10 * 1024 * 1024 * 1024, cast=int)
+DECRYPT_LOCK_TIMEOUT = config('DECRYPT_LOCK_TIMEOUT', default=60 * 60, cast=int)  # seconds before a stuck decryption is retried
+
+# Authenticated sessions are cached this many seconds; logging in or out drops them right away
+SESSION_CACHE_SECONDS = config('SESSION_CACHE_SECONDS', default=60, cast=int)
+SESSION_RETENTION_DAYS = config('SESSION_RETENTION_DAYS', default=30, cast=int)  # dead sessions are deleted after this
+CELERY_BEAT_SCHEDULE = {
+    'scrub-encrypted-files': {
+        'task': 'apps.dashboard.tasks.schedule_integrity_scrub',
+        'schedule': SCRUB_INTERVAL,
+    },
+    'purge-abandoned-uploads': {
+        'task': 'apps.dashboard.tasks.purge_abandoned_uploads_task',
+        'schedule': 60 * 60,
+    },
+    'expire-decrypted-files': {
+        'task': 'apps.dashboard.tasks.expire_decrypted_files_task',
+        'schedule': DECRYPTED_SWEEP_INTERVAL,
+    },
+    'remove-orphan-decrypted-files': {
+        'task': 'apps.dashboard.tasks.remove_orphan_decrypted_files_task',
+        'schedule': 24 * 60 * 60,
+    },
+    'purge-dead-sessions': {
+        'task': 'apps.security.tasks.purge_dead_sessions_task',
+        'schedule': 24 * 60 * 60,
+    },
+}
+
 
 # Application definition
 
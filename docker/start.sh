@@ -30,6 +30,9 @@ else
   echo "-- Encryption key found, using existing key."
 fi
 
+# One maintenance process per scrub shard, plus one so purges don't wait for a scrub to finish
+export MAINTENANCE_CONCURRENCY=$(python manage.py shell -c "from django.conf import settings; print(settings.SCRUB_SHARDS + 1)")
+
 # Start the application (supervisord)
 echo "\nStarting supervisord..."
 exec /usr/bin/supervisord -n -c /etc/supervisor/conf.d/supervisor.conf
\ No newline at end of file